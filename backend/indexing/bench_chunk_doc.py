@@ -0,0 +1,55 @@
+import sys
+import time
+import random
+import argparse
+from datetime import timedelta
+
+import srt
+
+from .chunk_doc import group_subs_list, group_split_paras
+from .test_chunk_doc import random_paras, ref_group_subs_list, ref_group_split_paras
+
+# Roughly like a drama episode: short lines, mostly small gaps, the occasional scene break
+def episode_subs(rng, count):
+    subs = []
+    t = timedelta(seconds=10)
+    for i in range(count):
+        if rng.random() < 0.02:
+            t += timedelta(seconds=rng.uniform(5, 20))
+        else:
+            t += timedelta(milliseconds=int(rng.expovariate(1/800)))
+        duration = timedelta(milliseconds=rng.randint(800, 4000))
+        content = 'あ'*rng.randint(4, 40)
+        subs.append(srt.Subtitle(index=i+1, start=t, end=t+duration, content=content))
+        t += duration
+    return subs
+
+# best of several runs, to cut down on noise
+def time_call(f, arg, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = f(arg)
+        dt = time.perf_counter() - t0
+        best = dt if (best is None) else min(best, dt)
+    return (best, result)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,2000,5000,10000')
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(100000) # reference versions recurse once per split
+
+    rng = random.Random('massif')
+    print('\t'.join(['kind', 'items', 'ref_secs', 'new_secs', 'speedup']))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        for (kind, make_items, new_f, ref_f) in [
+            ('subs', episode_subs, group_subs_list, ref_group_subs_list),
+            ('paras', random_paras, group_split_paras, ref_group_split_paras),
+        ]:
+            items = make_items(rng, size)
+            (ref_secs, ref_result) = time_call(ref_f, items)
+            (new_secs, new_result) = time_call(new_f, items)
+            assert new_result == ref_result
+            print('\t'.join([kind, str(size), f'{ref_secs:.3f}', f'{new_secs:.3f}', f'{ref_secs/new_secs:.1f}x']))
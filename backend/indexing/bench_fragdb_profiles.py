@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+
+from . import fragdb
+from .fragment_docs_s3 import fragment_doc
+from .bench_fragdb_shards import synthetic_docs
+
+def log_reject(text, sent, reason):
+    pass
+
+def load(dbfn, sources, profile):
+    t0 = time.perf_counter()
+    fragdb.open(dbfn, profile=profile)
+    fragdb.create_tables()
+    if profile == 'bulk_load':
+        fragdb.begin_bulk_load()
+    for (source, located_fragments) in sources:
+        fragdb.insert_source_fragments(source, located_fragments)
+    if profile == 'bulk_load':
+        fragdb.end_bulk_load()
+    fragdb.close()
+    return time.perf_counter() - t0
+
+def add_scores(dbfn):
+    fragdb.open(dbfn)
+    rng = random.Random(0)
+    fragdb.insert_fragment_scores('bench', '1', [(row[0], rng.random()) for row in fragdb.cxn.execute('SELECT id FROM fragment').fetchall()])
+    fragdb.close()
+
+# the query iter_fragments_plus used before, for comparison
+OLD_ITER_SQL = '''SELECT f.text, f.logprob, f.count_chars, f.count_mchars, json_group_array(json_object('source_id', h.source_id, 'loc', h.loc, 'tags', s.tags)), f.score_ev_20230516, fs.score FROM fragment f INNER JOIN hit h ON f.id = h.fragment_id, source s ON s.id = h.source_id LEFT JOIN fragment_score fs ON fs.fragment_id = f.id AND fs.name = ? GROUP BY f.text'''
+
+def read(dbfn, profile, old_query=False):
+    fragdb.open(dbfn, profile=profile)
+    t0 = time.perf_counter()
+    count = 0
+    if old_query:
+        for row in fragdb.cxn.execute(OLD_ITER_SQL, ('bench', )):
+            count += len(json.loads(row[4]))
+    else:
+        for row in fragdb.iter_fragments_plus('bench'):
+            count += len(row['hits'])
+    dt = time.perf_counter() - t0
+    fragdb.close()
+    return (dt, count)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=2000)
+    parser.add_argument('--lines-per-doc', type=int, default=200)
+    parser.add_argument('--tmpdir', help='where to put the dbs (default is the system temp dir, which may be in memory)')
+    args = parser.parse_args()
+
+    # fragment up front, so we're only timing the db
+    sources = [fragment_doc(s3key, doc, 0, 1000, log_reject) for (s3key, doc) in synthetic_docs(range(args.docs), args.lines_per_doc)]
+    print(f'{len(sources)} sources, {sum(len(lf) for (_, lf) in sources)} hits')
+
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+        print('\t'.join(['load profile', 'secs', 'MB']))
+        dbfns = {}
+        for profile in [None, 'bulk_load']:
+            dbfn = os.path.join(tmpdir, f'{profile}.db')
+            dt = load(dbfn, sources, profile)
+            dbfns[profile] = dbfn
+            print('\t'.join([str(profile or 'default'), f'{dt:.2f}', f'{os.path.getsize(dbfn)/1e6:.1f}']))
+
+        dbfn = dbfns['bulk_load']
+        add_scores(dbfn)
+        print('\t'.join(['read profile', 'secs', 'hits']))
+        for (name, profile, old_query) in [('default, old query', None, True), ('default', None, False), ('read', 'read', False)]:
+            (dt, count) = min(read(dbfn, profile, old_query) for _ in range(3))
+            print('\t'.join([name, f'{dt:.2f}', str(count)]))
@@ -0,0 +1,87 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+from multiprocessing import Pool
+
+from . import fragdb
+from .fragment_docs_s3 import fragment_docs_to_db, shard_filename
+
+SAMPLE_LINES = [
+    'はい。',
+    'そうですね。',
+    'ちょっと待って！',
+    '何を言ってるんだ？',
+    'ありがとうございます。',
+    '明日は学校に行かなければならない。',
+    'どうやら相当の思い入れがあったらしい。',
+    '飛ばねぇ豚はただの豚だ',
+]
+
+def srt_time(secs):
+    return f'00:{secs // 60:02}:{secs % 60:02},000'
+
+# a subtitle doc where most lines are common, and some are unique to the doc
+def synthetic_doc(i, lines_per_doc):
+    rng = random.Random(i)
+    subs = []
+    for j in range(lines_per_doc):
+        if rng.random() < 0.3:
+            line = f'第{i}話の{j}番目の台詞です。'
+        else:
+            line = rng.choice(SAMPLE_LINES)
+        subs.append(f'{j+1}\r\n{srt_time(j*3)} --> {srt_time(j*3+2)}\r\n{line}\r\n')
+    s3key = f'ja/jpsubbers/Japanese-Subtitles/@Mains/@2020/synthetic/{i}.zip/{i}.srt'
+    return (s3key, {'type': 'application/x-subrip', 'title': f'synthetic {i}', 'text': '\r\n'.join(subs)})
+
+def synthetic_docs(doc_idxs, lines_per_doc):
+    for i in doc_idxs:
+        yield synthetic_doc(i, lines_per_doc)
+
+def build_shard(dbfn, reject_fn, doc_idxs, lines_per_doc):
+    fragment_docs_to_db(dbfn, reject_fn, synthetic_docs(doc_idxs, lines_per_doc), 0, 1000, verbose=False)
+
+def build_shard_star(args):
+    return build_shard(*args)
+
+# returns (fragment secs, merge secs)
+def build(dbfn, shard_count, doc_count, lines_per_doc, processes):
+    t0 = time.perf_counter()
+    if shard_count == 1:
+        build_shard(dbfn, dbfn + '.rejects', range(doc_count), lines_per_doc)
+        return (time.perf_counter() - t0, 0)
+
+    shard_idxs = [[] for _ in range(shard_count)]
+    for i in range(doc_count):
+        shard_idxs[fragdb.shard_index(synthetic_doc(i, 0)[0], shard_count)].append(i)
+    shard_dbfns = [shard_filename(dbfn, i) for i in range(shard_count)]
+    with Pool(processes) as pool:
+        pool.map(build_shard_star, [(shard_dbfns[i], shard_filename(dbfn + '.rejects', i), shard_idxs[i], lines_per_doc) for i in range(shard_count)])
+    t1 = time.perf_counter()
+
+    fragdb.open(dbfn)
+    fragdb.create_tables(indexes=False)
+    fragdb.merge_shards(shard_dbfns)
+    fragdb.close()
+    return (t1 - t0, time.perf_counter() - t1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=2000)
+    parser.add_argument('--lines-per-doc', type=int, default=200)
+    parser.add_argument('--shards', default='1,4,16')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    print(f'{args.processes} processes')
+    print('\t'.join(['shards', 'fragment secs', 'merge secs', 'total secs', 'fragments', 'hits']))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for shard_count in [int(x) for x in args.shards.split(',')]:
+            dbfn = os.path.join(tmpdir, f'frags{shard_count}.db')
+            (fragment_dt, merge_dt) = build(dbfn, shard_count, args.docs, args.lines_per_doc, min(args.processes, shard_count))
+            fragdb.open(dbfn)
+            count_fragments = fragdb.cxn.execute('SELECT COUNT(*) FROM fragment').fetchone()[0]
+            count_hits = fragdb.cxn.execute('SELECT COUNT(*) FROM hit').fetchone()[0]
+            fragdb.close()
+            print('\t'.join([str(shard_count), f'{fragment_dt:.2f}', f'{merge_dt:.2f}', f'{fragment_dt + merge_dt:.2f}', str(count_fragments), str(count_hits)]))
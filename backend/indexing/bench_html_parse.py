@@ -0,0 +1,46 @@
+import time
+import argparse
+
+from .fragment_doc import fragment_html_paras, fragment_syosetu
+from .chunk_doc import chunk_html_paras, chunk_syosetu
+from .test_html_parse import PARSERS, syosetu_chapter, ref_p_children
+
+def synthetic_chapter(paras):
+    return syosetu_chapter([
+        ['　その日、<ruby><rb>王都</rb><rp>(</rp><rt>おうと</rt><rp>)</rp></ruby>は雨だった。', '<br/>', '「待って！　……待ってってば！」と彼女は叫んだ。', '　彼は振り返らずに、ただ前だけを見て歩き続けた。'][i % 4]
+        for i in range(paras)
+    ])
+
+def docs_per_sec(f, docs, min_secs=2):
+    count = 0
+    t0 = time.perf_counter()
+    while True:
+        for doc in docs:
+            f(doc)
+        count += len(docs)
+        dt = time.perf_counter() - t0
+        if dt >= min_secs:
+            return count/dt
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paras', type=int, default=300, help='paragraphs per synthetic chapter')
+    parser.add_argument('html_files', nargs='*', help='syosetu chapter HTML to use instead of synthetic chapters')
+    args = parser.parse_args()
+
+    if args.html_files:
+        docs = [open(fn).read() for fn in args.html_files]
+    else:
+        docs = [synthetic_chapter(args.paras)]
+
+    cases = [
+        ('fragment', 'html.parser (full tree)', lambda doc: fragment_html_paras(ref_p_children(doc), None)),
+        ('chunk', 'html.parser (full tree)', lambda doc: chunk_html_paras(ref_p_children(doc))),
+    ]
+    for p in PARSERS:
+        cases.append(('fragment', p, lambda doc, p=p: fragment_syosetu(doc, None, p)))
+        cases.append(('chunk', p, lambda doc, p=p: chunk_syosetu(doc.strip(), p)))
+
+    print('\t'.join(['stage', 'parser', 'docs/sec']))
+    for (stage, name, f) in sorted(cases, key=lambda c: c[0]):
+        print('\t'.join([stage, name, f'{docs_per_sec(f, docs):.1f}']))
@@ -0,0 +1,68 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import fragdb
+from .es_bulk import BulkSender
+from .rescore_fragments import rescore
+
+# Client side throughput of rescore_fragments.py: reading scores from fragdb, building the _bulk
+# bodies, and sending them. The server here accepts every update without doing anything, so a real
+# cluster will be slower; this is the ceiling on what the tool can push.
+
+class NullBulkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # otherwise small responses wait on delayed ACKs
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        item = b'{"update":{"status":200,"result":"updated"}}'
+        resp = b'{"errors":false,"items":[' + b','.join([item]*(body.count(b'\n')//2)) + b']}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def log_message(self, *args):
+        pass
+
+def make_db(dbfn, count):
+    fragdb.open(dbfn, profile='bulk_load')
+    fragdb.create_tables()
+    rng = random.Random(0)
+    fragdb.insert_fragment_scores('bench', '1', [(rng.getrandbits(63), rng.random()) for _ in range(count)])
+    fragdb.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fragments', type=int, default=1000000)
+    parser.add_argument('--concurrency', default='1,4')
+    parser.add_argument('--batch-size', default='1000,5000')
+    parser.add_argument('--tmpdir', help='where to put the db (default is the system temp dir, which may be in memory)')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NullBulkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+        dbfn = os.path.join(tmpdir, 'scores.db')
+        make_db(dbfn, args.fragments)
+
+        print('\t'.join(['concurrency', 'batch size', 'secs', 'updates/s']))
+        for concurrency in [int(x) for x in args.concurrency.split(',')]:
+            for batch_size in [int(x) for x in args.batch_size.split(',')]:
+                fragdb.open(dbfn, profile='read')
+                t0 = time.perf_counter()
+                counts = rescore(BulkSender('bench', concurrency, base_url=base_url), 'mscore', fragdb.iter_fragment_scores('bench'), batch_size)
+                dt = time.perf_counter() - t0
+                fragdb.close()
+                assert counts['updated'] == args.fragments
+                print('\t'.join([str(concurrency), str(batch_size), f'{dt:.2f}', f'{args.fragments/dt:.0f}']))
+
+    server.shutdown()
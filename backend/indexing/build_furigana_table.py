@@ -0,0 +1,37 @@
+import sys
+import argparse
+from collections import Counter
+
+from . import fragdb
+from ..common.ja import ja_open_analysis_cache, ja_close_analysis_cache, ja_get_text_morphemes, ja_wants_furigana, ja_match_furigana_uncached
+
+# Builds a table of furigana for the most common (surface, reading) pairs in a fragment DB,
+# for common/ja.py to load at startup via MASSIF_JA_FURIGANA_TABLE.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top', type=int, default=100000)
+    parser.add_argument('--analysis-cache', help='SQLite file to cache morphological analyses in (see index_fragments.py)')
+    parser.add_argument('sqlite_db')
+    parser.add_argument('output_file')
+    args = parser.parse_args()
+
+    fragdb.open(args.sqlite_db)
+    if args.analysis_cache:
+        ja_open_analysis_cache(args.analysis_cache)
+
+    pair_counts = Counter()
+    for (i, text) in enumerate(fragdb.iter_fragment_texts()):
+        for m in ja_get_text_morphemes(text):
+            if ja_wants_furigana(m.surface(), m.reading_form()):
+                pair_counts[(m.surface(), m.reading_form())] += 1
+        if (i % 100000) == 0:
+            print(i, 'fragments', len(pair_counts), 'pairs', file=sys.stderr)
+
+    if args.analysis_cache:
+        ja_close_analysis_cache()
+
+    with open(args.output_file, 'w', encoding='utf-8') as f:
+        for ((surface, reading), _) in pair_counts.most_common(args.top):
+            if any(('\t' in x) or ('\n' in x) for x in (surface, reading)):
+                continue
+            f.write('\t'.join([surface, reading, ja_match_furigana_uncached(surface, reading, False), ja_match_furigana_uncached(surface, reading, True)]) + '\n')
@@ -4,13 +4,15 @@ import json
 import html
 import re
 import sys
+from bisect import bisect_left, bisect_right
 
 import boto3
 import srt
 import jaconv
 from bs4 import BeautifulSoup
 
-from count_chars import count_meaty_chars, remove_spaces_punctuation
+from ..util.count_chars import count_meaty_chars, remove_spaces_punctuation
+from ..util.html_parse import parse_p_children
 
 # Subtitles will be chunked at gaps of this time or greater, even if they wouldn't otherwise need to
 # be because the chunks have little enough text.
@@ -22,8 +24,39 @@ SUBTITLE_MAX_CHUNK_CHARS = 80
 HTML_MAX_CHUNK_CHARS = 80
 HTML_REJECT_CHUNK_CHARS = 2*HTML_MAX_CHUNK_CHARS
 
-def flatten_list_of_lists(l):
-    return [item for sublist in l for item in sublist]
+def prefix_sums(counts):
+    cumul = [0]
+    for c in counts:
+        cumul.append(cumul[-1] + c)
+    return cumul
+
+# Sparse table answering "max of values[lo:hi]" in constant time after an O(n log n) build
+class RangeMax:
+    def __init__(self, values):
+        self.levels = [list(values)]
+        width = 1
+        while 2*width <= len(values):
+            prev = self.levels[-1]
+            self.levels.append([max(prev[i], prev[i + width]) for i in range(len(prev) - width)])
+            width *= 2
+
+    def query(self, lo, hi):
+        assert hi > lo
+        level = (hi - lo).bit_length() - 1
+        row = self.levels[level]
+        return max(row[lo], row[hi - (1 << level)])
+
+# Find the index in [lo+1, hi) that splits items[lo:hi] into two halves with character counts as
+# even as possible, where cumul is the prefix sums of item char counts. Ties go to the lower index.
+def balanced_split_idx(cumul, lo, hi):
+    target = cumul[lo] + 0.5*(cumul[hi] - cumul[lo])
+    j = bisect_left(cumul, target, lo + 1, hi) # first idx with cumul at or past the center
+    if j == lo + 1:
+        return j
+    left_idx = bisect_left(cumul, cumul[j - 1], lo + 1, hi) # earliest idx with the same count as j-1
+    if (j == hi) or ((target - cumul[left_idx]) <= (cumul[j] - target)):
+        return left_idx
+    return j
 
 # Takes list of Subtitle, returns list of lists
 # We force a chunk split for any time gap above a certain threshold.
@@ -32,50 +65,61 @@ def flatten_list_of_lists(l):
 # We split chunks at the largest time gap between subtitles. We treat subtitles with "continuation"
 # arrows as negative to make them even less likely to split.
 # If there is a tie with time gaps (as often happens if all the gaps are zero), then we try to
-# split to make the resulting character counts as even as possible.
+# split to make the resulting character counts as even as possible (and past that, prefer the later
+# split point).
+# Gaps and character counts are computed once up front, so that each split only costs a range-max
+# query plus a couple of binary searches.
 def group_subs_list(subs):
     assert len(subs) > 0
-    if len(subs) == 1:
-        return [subs]
 
-    potential_breaks = [] # (time_gap, cumul_chars, before_idx) tuples
-
-    prev_sub = None
-    total_chars = 0
-    for (idx, sub) in enumerate(subs):
-        if prev_sub:
-            prev_sub_stripped = prev_sub.content.strip()
-            prev_sub_continuation = prev_sub_stripped and (prev_sub_stripped[-1] in SUBTITLE_CONTINUATION_CHARS)
-            time_gap = -1 if prev_sub_continuation else (sub.start - prev_sub.end).total_seconds()
-            potential_breaks.append((time_gap, total_chars, idx))
-        total_chars += count_meaty_chars(sub.content)
-        prev_sub = sub
-
-    potential_breaks.sort(reverse=True)
-
-    biggest_gap = potential_breaks[0][0]
-
-    if biggest_gap < SUBTITLE_FORCED_CHUNK_TIME_GAP and total_chars <= SUBTITLE_MAX_CHUNK_CHARS:
-        # don't need to split any further
-        return [subs]
-
-    ties = [b for b in potential_breaks if b[0] == biggest_gap]
-
-    center_char_count = 0.5*total_chars
-    ties.sort(key=lambda b: abs(b[1] - center_char_count))
+    # gaps[i] is the gap before subs[i] (gaps[0] is unused)
+    gaps = [float('-inf')]
+    for (prev_sub, sub) in zip(subs, subs[1:]):
+        prev_sub_stripped = prev_sub.content.strip()
+        prev_sub_continuation = prev_sub_stripped and (prev_sub_stripped[-1] in SUBTITLE_CONTINUATION_CHARS)
+        gaps.append(-1 if prev_sub_continuation else (sub.start - prev_sub.end).total_seconds())
+    cumul = prefix_sums(count_meaty_chars(sub.content) for sub in subs)
+    gap_max = RangeMax(gaps)
+
+    # map from gap value to ascending list of break indexes with that gap, and their cumul counts
+    gap_breaks = {}
+    for idx in range(1, len(subs)):
+        (idxs, idx_cumuls) = gap_breaks.setdefault(gaps[idx], ([], []))
+        idxs.append(idx)
+        idx_cumuls.append(cumul[idx])
+
+    grouped_subs = []
+    pending = [(0, len(subs))] # stack of (lo, hi) ranges, leftmost on top
+    while pending:
+        (lo, hi) = pending.pop()
+        if (hi - lo) == 1:
+            grouped_subs.append(subs[lo:hi])
+            continue
 
-    split_before_idx = ties[0][2]
+        biggest_gap = gap_max.query(lo + 1, hi)
+        total_chars = cumul[hi] - cumul[lo]
 
-    subs_before = subs[:split_before_idx]
-    subs_after = subs[split_before_idx:]
+        if biggest_gap < SUBTITLE_FORCED_CHUNK_TIME_GAP and total_chars <= SUBTITLE_MAX_CHUNK_CHARS:
+            # don't need to split any further
+            grouped_subs.append(subs[lo:hi])
+            continue
 
-    grouped_subs = group_subs_list(subs_before) + group_subs_list(subs_after)
+        # among breaks tied for the biggest gap, find the one closest to the center by char count
+        (idxs, idx_cumuls) = gap_breaks[biggest_gap]
+        a = bisect_left(idxs, lo + 1)
+        b = bisect_left(idxs, hi)
+        target = cumul[lo] + 0.5*total_chars
+        j = bisect_left(idx_cumuls, target, a, b)
+        if j == b:
+            k = j - 1
+        else:
+            k = bisect_right(idx_cumuls, idx_cumuls[j], a, b) - 1 # latest break with the same count as j
+            if (j > a) and ((target - idx_cumuls[j - 1]) < (idx_cumuls[j] - target)):
+                k = j - 1
 
-    # sanity check: flatten groups and make sure it matches original
-    flattened_groups = flatten_list_of_lists(grouped_subs)
-    assert len(flattened_groups) == len(subs)
-    for (i, s) in enumerate(flattened_groups):
-        assert s is subs[i]
+        split_before_idx = idxs[k]
+        pending.append((split_before_idx, hi))
+        pending.append((lo, split_before_idx))
 
     return grouped_subs
 
@@ -114,75 +158,64 @@ def chunk_srt(text):
 # takes a list of sentences. returns a list of list of sentences
 def group_sents(sents):
     assert len(sents) > 0
-    if len(sents) == 1:
-        if sents[0]['chars'] > HTML_REJECT_CHUNK_CHARS:
-            # print('SENT REJECT', repr(sents[0]['text']))
-            return []
-        return [sents]
-
-    potential_breaks = [] # (cumul_chars, before_idx) tuples
-    prev_sent = None
-    total_chars = 0
-    for (idx, sent) in enumerate(sents):
-        if prev_sent:
-            potential_breaks.append((total_chars, idx))
-        total_chars += sent['chars']
-        prev_sent = sent
-
-    if total_chars <= HTML_MAX_CHUNK_CHARS:
-        return [sents]
-
-    center_char_count = 0.5*total_chars
-    potential_breaks.sort(key=lambda b: abs(b[0] - center_char_count))
-
-    split_before_idx = potential_breaks[0][1]
+    cumul = prefix_sums(sent['chars'] for sent in sents)
+
+    grouped_sents = []
+    pending = [(0, len(sents))] # stack of (lo, hi) ranges, leftmost on top
+    while pending:
+        (lo, hi) = pending.pop()
+        if (hi - lo) == 1:
+            if sents[lo]['chars'] > HTML_REJECT_CHUNK_CHARS:
+                # print('SENT REJECT', repr(sents[lo]['text']))
+                continue
+            grouped_sents.append(sents[lo:hi])
+            continue
 
-    sents_before = sents[:split_before_idx]
-    sents_after = sents[split_before_idx:]
+        if (cumul[hi] - cumul[lo]) <= HTML_MAX_CHUNK_CHARS:
+            grouped_sents.append(sents[lo:hi])
+            continue
 
-    grouped_sents = group_sents(sents_before) + group_sents(sents_after)
+        split_before_idx = balanced_split_idx(cumul, lo, hi)
+        pending.append((split_before_idx, hi))
+        pending.append((lo, split_before_idx))
 
     return grouped_sents
 
+def split_para(para):
+    if para['chars'] <= HTML_MAX_CHUNK_CHARS:
+        return [[para]]
+    sent_groups = group_sents(para['sents'])
+    para_groups = []
+    for sent_group in sent_groups:
+        split = {
+            'sents': sent_group,
+            'chars': sum(sent['chars'] for sent in sent_group),
+        }
+        if para.get('anchor'):
+            split['anchor'] = para['anchor']
+        para_groups.append([split])
+    return para_groups
+
 # takes a list of paragraphs, returns a list of list of paragraphs (or potentially, sub-paragraph fragments if we have to split paras)
 def group_split_paras(paras):
     assert len(paras) > 0
-    if len(paras) == 1:
-        if paras[0]['chars'] <= HTML_MAX_CHUNK_CHARS:
-            return [[paras[0]]]
-        sent_groups = group_sents(paras[0]['sents'])
-        para_groups = []
-        for sent_group in sent_groups:
-            para = {
-                'sents': sent_group,
-                'chars': sum(sent['chars'] for sent in sent_group),
-            }
-            if paras[0].get('anchor'):
-                para['anchor'] = paras[0]['anchor']
-            para_groups.append([para])
-        return para_groups
-
-    potential_breaks = [] # (cumul_chars, before_idx) tuples
-    prev_para = None
-    total_chars = 0
-    for (idx, para) in enumerate(paras):
-        if prev_para:
-            potential_breaks.append((total_chars, idx))
-        total_chars += para['chars']
-        prev_para = para
-
-    if total_chars <= HTML_MAX_CHUNK_CHARS:
-        return [paras]
-
-    center_char_count = 0.5*total_chars
-    potential_breaks.sort(key=lambda b: abs(b[0] - center_char_count))
-
-    split_before_idx = potential_breaks[0][1]
+    cumul = prefix_sums(para['chars'] for para in paras)
+
+    grouped_paras = []
+    pending = [(0, len(paras))] # stack of (lo, hi) ranges, leftmost on top
+    while pending:
+        (lo, hi) = pending.pop()
+        if (hi - lo) == 1:
+            grouped_paras.extend(split_para(paras[lo]))
+            continue
 
-    paras_before = paras[:split_before_idx]
-    paras_after = paras[split_before_idx:]
+        if (cumul[hi] - cumul[lo]) <= HTML_MAX_CHUNK_CHARS:
+            grouped_paras.append(paras[lo:hi])
+            continue
 
-    grouped_paras = group_split_paras(paras_before) + group_split_paras(paras_after)
+        split_before_idx = balanced_split_idx(cumul, lo, hi)
+        pending.append((split_before_idx, hi))
+        pending.append((lo, split_before_idx))
 
     return grouped_paras
 
@@ -222,36 +255,85 @@ def assert_safe_ruby(elem):
     for child in elem.children:
         assert_safe_ruby(child)
 
-# takes a BS element, returns an HTML string that has most tags removed,
-# with the notable exception of <ruby> stuff
-def simplified_inner_html(elem):
-    if elem.name is None:
-        return html.escape(str(elem))
-
-    pieces = []
+# takes a BS element, returns a list of (html, text, splittable) pieces of its "insides", with most
+# tags removed, with the notable exception of <ruby> stuff (which is kept whole, unsplittable)
+def simplified_pieces(elem, pieces):
     for e in elem.children:
-        if e.name == 'ruby':
-            pieces.append(str(e))
+        if e.name is None:
+            pieces.append((html.escape(str(e)), str(e), True))
+        elif e.name == 'ruby':
+            pieces.append((str(e), e.get_text(), False))
         else:
-            pieces.append(simplified_inner_html(e))
-
-    return ''.join(pieces)
+            simplified_pieces(e, pieces)
+    return pieces
 
+SENT_END_CHARS = '。！…？'
 SENT_RE = re.compile(r'[^。！…？]*[。！…？]?')
 
+def make_sentence(html_pieces, text_pieces):
+    raw_html = ''.join(html_pieces)
+    shtml = raw_html.strip()
+    if not shtml:
+        return None
+    # whitespace stripped from the ends of the HTML always comes from plain text pieces, and escaping
+    # doesn't touch whitespace, so we can strip the same number of chars from the text
+    lead = len(raw_html) - len(raw_html.lstrip())
+    trail = len(raw_html) - len(raw_html.rstrip())
+    text = ''.join(text_pieces)
+    text = text[lead:len(text)-trail]
+    return {
+        'html': shtml,
+        'text': text,
+        'chars': count_meaty_chars(text),
+    }
+
 # takes a BS element, returns a list of sentence dicts of its "insides".
 # note that we simplify HTML, removing everything except for ruby tags.
+# we walk the element once, building up the HTML and text of each sentence side by side.
 def break_into_sentences(elem):
-    simple_html = simplified_inner_html(elem)
+    pieces = simplified_pieces(elem, [])
 
-    split_html = SENT_RE.findall(simple_html)
+    if any((not splittable) and any(c in SENT_END_CHARS for c in piece_html) for (piece_html, _, splittable) in pieces):
+        # a sentence ends inside a <ruby>, which we can't split cleanly
+        return break_into_sentences_reparse(pieces)
 
     sentences = []
-    for html in split_html:
-        shtml = html.strip()
+    html_pieces = []
+    text_pieces = []
+    for (piece_html, piece_text, splittable) in pieces:
+        if not splittable:
+            html_pieces.append(piece_html)
+            text_pieces.append(piece_text)
+            continue
+        for seg in SENT_RE.findall(piece_text):
+            if not seg:
+                continue
+            html_pieces.append(html.escape(seg))
+            text_pieces.append(seg)
+            if seg[-1] in SENT_END_CHARS:
+                sentence = make_sentence(html_pieces, text_pieces)
+                if sentence:
+                    sentences.append(sentence)
+                html_pieces = []
+                text_pieces = []
+
+    sentence = make_sentence(html_pieces, text_pieces)
+    if sentence:
+        sentences.append(sentence)
+
+    return sentences
+
+# slow path for break_into_sentences, which splits the simplified HTML as a string, and so must
+# re-parse each piece to get its text
+def break_into_sentences_reparse(pieces):
+    simple_html = ''.join(piece_html for (piece_html, _, _) in pieces)
+
+    sentences = []
+    for sent_html in SENT_RE.findall(simple_html):
+        shtml = sent_html.strip()
         if not shtml:
             continue
-        text = BeautifulSoup(shtml, 'html.parser').get_text() # hacky but works!
+        text = BeautifulSoup(shtml, 'html.parser').get_text()
         sentences.append({
             'html': shtml,
             'text': text,
@@ -260,37 +342,35 @@ def break_into_sentences(elem):
 
     return sentences
 
-def chunk_html_p_children(elem):
+# takes a list of <p> elements, returns a list of chunks
+def chunk_html_paras(p_elems):
     accum_paras = []
     accum_chunks = []
-    for child in elem.children:
-        # only consider <p> elements
-        # NOTE: we could recurse to find deeper <p> elements, but it doesn't seem necessary so far. could just do elem.descendants
-        if child.name == 'p':
-            meaty_count = count_meaty_chars(child.get_text())
-            if meaty_count == 0:
-                # force a break between chunks when we encounter paragraphs with no meaty characters,
-                # which for syosetu may be just a <br> (empty line) or something like ~~~~
-                accum_chunks.extend(chunks_from_paras(accum_paras))
-                accum_paras = []
-            else:
-                para = {
-                    'sents': break_into_sentences(child),
-                    'chars': meaty_count,
-                }
-                assert sum(sent['chars'] for sent in para['sents']) == meaty_count
-                if child.has_attr('id'):
-                    para['anchor'] = child['id']
-                accum_paras.append(para)
+    for child in p_elems:
+        meaty_count = count_meaty_chars(child.get_text())
+        if meaty_count == 0:
+            # force a break between chunks when we encounter paragraphs with no meaty characters,
+            # which for syosetu may be just a <br> (empty line) or something like ~~~~
+            accum_chunks.extend(chunks_from_paras(accum_paras))
+            accum_paras = []
+        else:
+            para = {
+                'sents': break_into_sentences(child),
+                'chars': meaty_count,
+            }
+            assert sum(sent['chars'] for sent in para['sents']) == meaty_count
+            if child.has_attr('id'):
+                para['anchor'] = child['id']
+            accum_paras.append(para)
 
     accum_chunks.extend(chunks_from_paras(accum_paras))
     accum_paras = []
 
     return accum_chunks
 
-def chunk_syosetu(text):
-    soup = BeautifulSoup(text, 'html.parser')
-    return chunk_html_p_children(soup.contents[0])
+# parser may be any BeautifulSoup tree builder, defaulting to the fastest one installed
+def chunk_syosetu(text, parser=None):
+    return chunk_html_paras(parse_p_children(text, parser))
 
 def chunk_doc(s3key, doc):
     mode = None
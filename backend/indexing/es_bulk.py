@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ES_BASE_URL = os.getenv('MASSIF_ES_URL') or 'http://localhost:9200'
+
+TRY_COUNT = 5
+RETRY_PAUSE = 1 # doubled after each try
+
+class BulkError(Exception):
+    pass
+
+def jdump(obj):
+    return json.dumps(obj, ensure_ascii=False)
+
+def ndjson(actions):
+    lines = []
+    for (meta, doc) in actions:
+        lines.append(jdump(meta) + '\n')
+        if doc is not None:
+            lines.append(jdump(doc) + '\n')
+    return ''.join(lines)
+
+# Sends _bulk requests to an index from a pool of threads, with at most concurrency requests in flight
+# (send blocks while they all are). Actions that ES rejects for being overloaded (429) are retried with
+# backoff. Other failed actions raise BulkError (from a later send or close), unless their status is
+# in ignore_statuses, e.g. 404 for updates of docs that aren't in the index.
+#
+# An action is a pair of the action metadata, e.g. {'update': {'_id': '1'}}, and the doc line that
+# goes with it (None for deletes).
+class BulkSender:
+    def __init__(self, index, concurrency=4, ignore_statuses=(), base_url=ES_BASE_URL, retry_pause=RETRY_PAUSE):
+        self.url = f'{base_url}/{index}/_bulk'
+        self.ignore_statuses = set(ignore_statuses)
+        self.retry_pause = retry_pause
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.thread_local = threading.local()
+        self.lock = threading.Lock()
+        self.counts = Counter() # by result, e.g. updated, or status for ignored failures
+        self.error = None
+
+    def send(self, actions):
+        self.raise_error()
+        self.slots.acquire()
+        future = self.executor.submit(self.post_actions, actions)
+        future.add_done_callback(self.post_done)
+
+    def post_done(self, future):
+        self.slots.release()
+        if future.exception():
+            with self.lock:
+                self.error = self.error or future.exception()
+
+    def raise_error(self):
+        if self.error:
+            raise self.error
+
+    # waits for everything sent to be done, and returns counts by result
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.raise_error()
+        return self.counts
+
+    # runs in a worker thread
+    def post_actions(self, actions):
+        session = getattr(self.thread_local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.thread_local.session = session
+
+        for attempt in range(TRY_COUNT):
+            resp = session.post(self.url, headers={'Content-Type': 'application/x-ndjson'}, data=ndjson(actions).encode('utf-8'))
+            if resp.status_code == 429:
+                retry_actions = actions
+            else:
+                resp.raise_for_status()
+                retry_actions = []
+                counts = Counter()
+                for (action, item) in zip(actions, resp.json()['items']):
+                    result = next(iter(item.values()))
+                    if 'error' not in result:
+                        counts[result['result']] += 1
+                    elif result['status'] == 429:
+                        retry_actions.append(action)
+                    elif result['status'] in self.ignore_statuses:
+                        counts[result['status']] += 1
+                    else:
+                        raise BulkError(f'{action[0]!r} failed: {result["error"]!r}')
+                with self.lock:
+                    self.counts.update(counts)
+
+            if not retry_actions:
+                return
+            print(f'ES overloaded, retrying {len(retry_actions)} actions', file=sys.stderr)
+            actions = retry_actions
+            time.sleep(self.retry_pause*(2**attempt))
+        raise BulkError(f'{len(actions)} actions still rejected after {TRY_COUNT} tries')
+
+def refresh_index(index, base_url=ES_BASE_URL):
+    resp = requests.post(f'{base_url}/{index}/_refresh')
+    resp.raise_for_status()
@@ -0,0 +1,59 @@
+import os
+import json
+import argparse
+
+import requests
+
+from .es_bulk import ES_BASE_URL
+
+# Index settings and mappings are in es_index_defs/KIND.json. Any change to one should bump its
+# massif_version (in the mappings _meta), which is how index_fragments.py tells that an existing index
+# was made from an older definition. Indexes made by hand before this (see git history of the README)
+# have no version, which counts as 1.
+#
+# The fragment index is sorted on mscore, which is what search sorts by, so searches that only count
+# hits up to a limit (track_total_hits) can stop early instead of scoring and sorting every match.
+
+INDEX_DEFS_DIR = os.path.join(os.path.dirname(__file__), 'es_index_defs')
+KINDS = ['fragment', 'source']
+
+def load_index_def(kind):
+    with open(os.path.join(INDEX_DEFS_DIR, kind + '.json')) as f:
+        return json.load(f)
+
+def index_def_version(kind):
+    return load_index_def(kind)['mappings']['_meta']['massif_version']
+
+def create_index(kind, index, base_url=ES_BASE_URL):
+    resp = requests.put(f'{base_url}/{index}', json=load_index_def(kind))
+    resp.raise_for_status()
+
+# the massif_version of an existing index, or None if there is no such index
+def get_index_version(index, base_url=ES_BASE_URL):
+    resp = requests.get(f'{base_url}/{index}/_mapping')
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    # the response is keyed by the real index name, which may differ if index is an alias
+    (mapping, ) = [v['mappings'] for v in resp.json().values()]
+    return mapping.get('_meta', {}).get('massif_version', 1)
+
+# Creates the index if it isn't there, otherwise checks that it's from the current definition. Returns
+# True if it created it
+def ensure_index(kind, index, base_url=ES_BASE_URL):
+    version = get_index_version(index, base_url)
+    if version is None:
+        create_index(kind, index, base_url)
+        print('CREATED', index, 'VERSION', index_def_version(kind))
+        return True
+    elif version != index_def_version(kind):
+        raise ValueError(f'{index} is from version {version} of the {kind} index definition, but the current one is {index_def_version(kind)}, so index into a new suffix')
+    return False
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index-suffix', required=True)
+    args = parser.parse_args()
+
+    for kind in KINDS:
+        ensure_index(kind, f'{kind}_{args.index_suffix}')
@@ -1,62 +1,264 @@
 import json
+import hashlib
+import argparse
 
 import sqlite3
 
-'''
-CREATE TABLE fragment (
-  id INTEGER PRIMARY KEY,
-  text TEXT NOT NULL UNIQUE,
+# Uniqueness is enforced by separate indexes (INDEXES) rather than inline UNIQUE constraints, so that
+# bulk loads can create the indexes after the data is in. DBs created before this have the constraints
+# inline, which works the same for everything here.
+#
+# A fragment's id is a hash of its text (see fragment_id), and a source's id is a hash of its s3key
+# (source_id), rather than autoincrement ids looked up through unique indexes on text and s3key. So
+# the same fragment or source has the same id in every db (and in Elasticsearch). DBs with the old
+# ids can be converted with rekey.
+#
+# Every write transaction takes the next change sequence number (the 'seq' in meta). Fragments and
+# sources have the seq that last changed them (for a fragment, its hits or scores) in modified, and
+# deleted ones leave a tombstone with the seq they were deleted at. So index_fragments.py can send
+# Elasticsearch just what changed since the seq it last indexed up to (its watermark, also in meta).
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fragment (
+  id INTEGER PRIMARY KEY, -- fragment_id(text)
+  text TEXT NOT NULL,
   count_chars INTEGER NOT NULL,
   count_mchars INTEGER NOT NULL,
   logprob REAL,
   count_toks INTEGER,
-  score_ev_20230516 REAL
+  score_ev_20230516 REAL,
+  modified INTEGER
 );
 
-CREATE TABLE source (
-  id INTEGER PRIMARY KEY,
-  s3key TEXT NOT NULL UNIQUE,
+CREATE TABLE IF NOT EXISTS source (
+  id INTEGER PRIMARY KEY, -- source_id(s3key)
+  s3key TEXT NOT NULL,
   title TEXT,
   pubdate TEXT,
   url TEXT,
-  tags TEXT
+  tags TEXT,
+  modified INTEGER
 );
 
-CREATE TABLE hit (
+CREATE TABLE IF NOT EXISTS hit (
   fragment_id INTEGER NOT NULL,
   source_id INTEGER NOT NULL,
-  loc TEXT NOT NULL,
-  UNIQUE(fragment_id, source_id, loc)
+  loc TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS fragment_score (
+  fragment_id INTEGER NOT NULL,
+  name TEXT NOT NULL,
+  version TEXT NOT NULL,
+  score REAL NOT NULL,
+  PRIMARY KEY (fragment_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS tombstone (
+  kind TEXT NOT NULL, -- fragment or source
+  id INTEGER NOT NULL,
+  seq INTEGER NOT NULL,
+  PRIMARY KEY (kind, id)
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY NOT NULL,
+  value
 );
 '''
 
+INDEXES = {
+    'hit_unique': 'CREATE UNIQUE INDEX IF NOT EXISTS hit_unique ON hit (fragment_id, source_id, loc)',
+    'hit_source': 'CREATE INDEX IF NOT EXISTS hit_source ON hit (source_id)',
+    'fragment_modified': 'CREATE INDEX IF NOT EXISTS fragment_modified ON fragment (modified)',
+}
+
+# only needed to replace or delete sources already in the db, and for incremental indexing, so
+# dropped during bulk loads into a db with no sources yet
+BULK_DEFERRED_INDEXES = ['hit_unique', 'hit_source', 'fragment_modified']
+
+# the unique indexes that dbs from before fragment_id/source_id have, by table
+LEGACY_ID_INDEXES = {
+    'fragment': ['fragment_text', 'sqlite_autoindex_fragment_1'],
+    'source': ['source_s3key', 'sqlite_autoindex_source_1'],
+}
+
+# Connection settings for the two main ways we use a db. bulk_load gives up durability (a crash
+# during a load can corrupt the db, but it can just be rebuilt), read is for big scans.
+PROFILES = {
+    'bulk_load': [
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = OFF',
+        'PRAGMA cache_size = -1048576', # 1GB
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA mmap_size = 1073741824',
+    ],
+    'read': [
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA cache_size = -262144', # 256MB
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA mmap_size = 17179869184',
+    ],
+}
+
+class FragmentIdCollision(Exception):
+    pass
+
 cxn = None
 
-def open(dbfn):
+# 63 bits, so it fits in an SQLite integer (and a Java long in Elasticsearch) without going negative
+def _hash_id(s):
+    return int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'big') >> 1
+
+def fragment_id(text):
+    return _hash_id(text)
+
+def source_id(s3key):
+    return _hash_id(s3key)
+
+def open(dbfn, timeout=5, profile=None):
     global cxn
-    cxn = sqlite3.connect(dbfn)
+    cxn = sqlite3.connect(dbfn, timeout=timeout)
+    cxn.create_function('fragment_id', 1, fragment_id, deterministic=True)
+    cxn.create_function('source_id', 1, source_id, deterministic=True)
+    if profile:
+        for sql in PROFILES[profile]:
+            cxn.execute(sql)
+
+# Drops indexes that aren't needed during a load, to be rebuilt by end_bulk_load. DBs created before
+# SCHEMA/INDEXES have these as inline constraints, which can't be dropped, so they're left as is. So
+# are the indexes of a db that already has sources, since replacing one (e.g. refragmenting into an
+# existing db) scans the whole hit table without them.
+def has_inline_constraints():
+    return bool(cxn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'sqlite_autoindex_hit_1'").fetchone())
+
+def begin_bulk_load():
+    if has_inline_constraints():
+        return
+    if cxn.execute('SELECT 1 FROM source LIMIT 1').fetchone():
+        return
+    for name in BULK_DEFERRED_INDEXES:
+        cxn.execute(f'DROP INDEX IF EXISTS {name}')
+    cxn.commit()
+
+def end_bulk_load():
+    if has_inline_constraints():
+        return
+    cur = cxn.cursor()
+    if not cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'hit_unique'").fetchone():
+        # without the index, a source can have been given the same hit twice
+        cur.execute('BEGIN')
+        cur.execute('DELETE FROM hit WHERE rowid NOT IN (SELECT MIN(rowid) FROM hit GROUP BY fragment_id, source_id, loc)')
+        cur.execute('COMMIT')
+    create_indexes()
+
+# True if the table (or either table, if not given) still has autoincrement ids from before
+# fragment_id/source_id
+def has_legacy_ids(table=None):
+    names = [name for (t, names) in LEGACY_ID_INDEXES.items() if table in (None, t) for name in names]
+    return bool(cxn.execute(f"SELECT 1 FROM sqlite_master WHERE type = 'index' AND name IN ({', '.join('?'*len(names))})", names).fetchone())
+
+# For a new db. If the tables are already there, just adds any tables and columns added since it was made
+def create_tables(indexes=True):
+    if cxn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fragment'").fetchone():
+        assert not has_legacy_ids(), 'db has old fragment/source ids, convert it with: python -m backend.indexing.fragdb rekey'
+        cxn.executescript(SCHEMA)
+        for table in ['fragment', 'source']:
+            if 'modified' not in [row[1] for row in cxn.execute(f'PRAGMA table_info({table})')]:
+                cxn.execute(f'ALTER TABLE {table} ADD COLUMN modified INTEGER')
+        cxn.commit()
+        return
+    cxn.executescript(SCHEMA)
+    if indexes:
+        create_indexes()
+
+def create_indexes():
+    for sql in INDEXES.values():
+        cxn.execute(sql)
+    cxn.commit()
+
+# which of shard_count shards a source goes in, so that each source's hits are all in one shard
+def shard_index(s3key, shard_count):
+    return int.from_bytes(hashlib.blake2b(s3key.encode('utf-8'), digest_size=8).digest(), 'big') % shard_count
 
 def close():
     global cxn
     if cxn:
         cxn.close()
     cxn = None
+    source_id_cache.clear()
 
-def iter_fragments_plus():
+# must be called in a write transaction, which then owns the returned seq
+def _next_seq(cur):
+    return cur.execute("INSERT INTO meta (key, value) VALUES ('seq', 1) ON CONFLICT (key) DO UPDATE SET value = value + 1 RETURNING value").fetchone()[0]
+
+# the seq of the last committed change (0 for a db with no changes since seqs were added)
+def get_seq():
+    row = cxn.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()
+    return row[0] if row else 0
+
+# the seq that the named consumer (e.g. an Elasticsearch index) has seen everything up to, or None
+def get_watermark(name):
+    row = cxn.execute('SELECT value FROM meta WHERE key = ?', ('watermark:' + name, )).fetchone()
+    return row[0] if row else None
+
+def set_watermark(name, seq):
+    cxn.execute('INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value', ('watermark:' + name, seq))
+    cxn.commit()
+
+# If score_name is given, each row also has the 'score' from fragment_score with that name (or None).
+# If modified_after is given, only fragments changed after that seq are included.
+# Rows come in id order. The CROSS JOINs make SQLite scan fragment in order and look up hits with the
+# (covering) unique index on hit, rather than scanning hit and sorting everything to group it.
+def iter_fragments_plus(score_name=None, modified_after=None):
     cur = cxn.cursor()
-    for row in cur.execute('''SELECT f.text, f.logprob, f.count_chars, f.count_mchars, json_group_array(json_object('source_id', h.source_id, 'loc', h.loc, 'tags', s.tags)), f.score_ev_20230516 FROM fragment f INNER JOIN hit h ON f.id = h.fragment_id, source s ON s.id = h.source_id GROUP BY f.text'''):
+    params = []
+    if score_name is None:
+        score_select = 'NULL'
+        score_join = ''
+    else:
+        score_select = 'fs.score'
+        score_join = 'LEFT JOIN fragment_score fs ON fs.fragment_id = f.id AND fs.name = ?'
+        params.append(score_name)
+    where = ''
+    if modified_after is not None:
+        where = 'WHERE f.modified > ?'
+        params.append(modified_after)
+    rows = cur.execute(f'''SELECT f.id, f.text, f.logprob, f.count_chars, f.count_mchars, json_group_array(json_object('source_id', h.source_id, 'loc', h.loc, 'tags', s.tags)), f.score_ev_20230516, {score_select} FROM fragment f CROSS JOIN hit h ON f.id = h.fragment_id CROSS JOIN source s ON s.id = h.source_id {score_join} {where} GROUP BY f.id''', params)
+    for row in rows:
         yield {
-            'text': row[0],
-            'logprob': row[1],
-            'count_chars': row[2],
-            'count_mchars': row[3],
-            'hits': json.loads(row[4]), # has fields source_id, loc, tags
-            'score_ev_20230516': row[5],
+            'id': row[0],
+            'text': row[1],
+            'logprob': row[2],
+            'count_chars': row[3],
+            'count_mchars': row[4],
+            'hits': json.loads(row[5]), # has fields source_id, loc, tags
+            'score_ev_20230516': row[6],
+            'score': row[7],
         }
 
-def iter_sources():
+# (fragment_id, score) for every fragment with a score of the given name (or score_ev_20230516 if None)
+def iter_fragment_scores(score_name=None):
+    cur = cxn.cursor()
+    if score_name is None:
+        rows = cur.execute('SELECT id, score_ev_20230516 FROM fragment WHERE score_ev_20230516 IS NOT NULL')
+    else:
+        rows = cur.execute('SELECT fragment_id, score FROM fragment_score WHERE name = ?', (score_name, ))
+    for row in rows:
+        yield (row[0], row[1])
+
+def iter_fragment_texts():
     cur = cxn.cursor()
-    for row in cur.execute('SELECT id, s3key, title, pubdate, url, tags FROM source'):
+    for row in cur.execute('SELECT text FROM fragment'):
+        yield row[0]
+
+def iter_sources(modified_after=None):
+    cur = cxn.cursor()
+    if modified_after is None:
+        rows = cur.execute('SELECT id, s3key, title, pubdate, url, tags FROM source')
+    else:
+        rows = cur.execute('SELECT id, s3key, title, pubdate, url, tags FROM source WHERE modified > ?', (modified_after, ))
+    for row in rows:
         yield {
             'id': row[0],
             's3key': row[1],
@@ -66,20 +268,259 @@ def iter_sources():
             'tags': row[5],
         }
 
+# ids of fragments or sources (by kind) deleted after the given seq, and not added back since
+def iter_deleted_ids(kind, deleted_after):
+    assert kind in ('fragment', 'source')
+    cur = cxn.cursor()
+    for row in cur.execute(f'SELECT t.id FROM tombstone t WHERE t.kind = ? AND t.seq > ? AND NOT EXISTS (SELECT 1 FROM {kind} x WHERE x.id = t.id)', (kind, deleted_after)):
+        yield row[0]
+
+# fragments is a list of (id, text, count_chars, count_mchars). Checks (in one query for the batch)
+# that those already there have the same text.
+def _check_fragment_ids(cur, fragments):
+    collision = cur.execute("SELECT f.id, f.text, json_extract(j.value, '$[1]') FROM json_each(?) j INNER JOIN fragment f ON f.id = json_extract(j.value, '$[0]') WHERE f.text != json_extract(j.value, '$[1]') LIMIT 1", (json.dumps([(fid, text) for (fid, text, _, _) in fragments]), )).fetchone()
+    if collision:
+        raise FragmentIdCollision(f'{collision[2]!r} and {collision[1]!r} have the same id {collision[0]}')
+
+# Inserts those of fragments that are new, and marks all of them modified at seq. Check them with
+# _check_fragment_ids afterwards (which also catches two texts in the batch with the same id).
+def _upsert_fragments(cur, fragments, seq):
+    cur.executemany('INSERT INTO fragment (id, text, count_chars, count_mchars, modified) VALUES (?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET modified = excluded.modified', ((fid, text, count_chars, count_mchars, seq) for (fid, text, count_chars, count_mchars) in fragments))
+
+def _tombstone(cur, kind, ids, seq):
+    cur.executemany('INSERT INTO tombstone (kind, id, seq) VALUES (?, ?, ?) ON CONFLICT (kind, id) DO UPDATE SET seq = excluded.seq', ((kind, i, seq) for i in ids))
+
+# Removes the given (fragment_id, loc) hits of the source. Fragments left with no hits are deleted,
+# the rest are marked modified.
+def _remove_hits(cur, sid, hits, seq):
+    cur.executemany('DELETE FROM hit WHERE fragment_id = ? AND source_id = ? AND loc = ?', ((fid, sid, loc) for (fid, loc) in hits))
+    deleted = []
+    for fid in set(fid for (fid, _) in hits):
+        cur.execute('DELETE FROM fragment WHERE id = ? AND NOT EXISTS (SELECT 1 FROM hit WHERE fragment_id = ?)', (fid, fid))
+        if cur.rowcount:
+            deleted.append(fid)
+        else:
+            cur.execute('UPDATE fragment SET modified = ? WHERE id = ?', (seq, fid))
+    _tombstone(cur, 'fragment', deleted, seq)
+
+def _get_source_hits(cur, sid):
+    return set(cur.execute('SELECT fragment_id, loc FROM hit WHERE source_id = ?', (sid, )))
+
+# If the source is already in the db, its hits are replaced with these. Only what actually changed is
+# marked modified (the source if its fields did, and fragments that gained or lost hits), so
+# refragmenting unchanged docs leaves nothing for incremental indexing to send.
 def insert_source_fragments(source, located_fragments):
     cur = cxn.cursor()
 
     cur.execute('BEGIN')
 
-    cur.execute('INSERT INTO source (s3key, title, pubdate, url, tags) VALUES (?, ?, ?, ?, ?) ON CONFLICT (s3key) DO UPDATE SET title=excluded.title, pubdate=excluded.pubdate, url=excluded.url', (source['s3key'], source['title'], source['pubdate'], source['url'], source['tags']))
+    sid = source_id(source['s3key'])
+    fragments = [(fragment_id(lf['text']), lf['text'], lf['count_chars'], lf['count_mchars']) for lf in located_fragments]
+    hits = set((fragment[0], lf['loc']) for (fragment, lf) in zip(fragments, located_fragments))
+    fields = (source['title'], source['pubdate'], source['url'])
+    existing = cur.execute('SELECT s3key, title, pubdate, url FROM source WHERE id = ?', (sid, )).fetchone()
+    if existing is None:
+        old_hits = set()
+    elif existing[0] != source['s3key']:
+        raise FragmentIdCollision(f'sources {source["s3key"]!r} and {existing[0]!r} have the same id {sid}')
+    else:
+        old_hits = _get_source_hits(cur, sid)
+
+    added_hits = hits - old_hits
+    removed_hits = old_hits - hits
+    source_changed = (existing is None) or (tuple(existing[1:]) != fields)
+    if not (source_changed or added_hits or removed_hits):
+        _check_fragment_ids(cur, fragments)
+        cur.execute('COMMIT')
+        return
+
+    seq = _next_seq(cur)
+    if existing is None:
+        cur.execute('INSERT INTO source (id, s3key, title, pubdate, url, tags, modified) VALUES (?, ?, ?, ?, ?, ?, ?)', (sid, source['s3key'], *fields, source['tags'], seq))
+    elif source_changed:
+        cur.execute('UPDATE source SET title = ?, pubdate = ?, url = ?, modified = ? WHERE id = ?', (*fields, seq, sid))
+
+    # new hits go in first, so fragments that only moved within the source aren't orphaned by removing the old ones
+    added_fids = set(fid for (fid, _) in added_hits)
+    _upsert_fragments(cur, [fragment for fragment in fragments if fragment[0] in added_fids], seq)
+    cur.executemany('INSERT INTO hit (fragment_id, source_id, loc) VALUES (?, ?, ?) ON CONFLICT DO NOTHING', ((fid, sid, loc) for (fid, loc) in added_hits))
+    _remove_hits(cur, sid, removed_hits, seq)
+    _check_fragment_ids(cur, fragments)
+
+    cur.execute('COMMIT')
+
+# e.g. for docs that have been removed from S3. Fragments only they had hits in are deleted too.
+def delete_sources(s3keys):
+    cur = cxn.cursor()
+
+    cur.execute('BEGIN')
+    seq = _next_seq(cur)
+
+    deleted = []
+    for s3key in s3keys:
+        sid = source_id(s3key)
+        _remove_hits(cur, sid, _get_source_hits(cur, sid), seq)
+        cur.execute('DELETE FROM source WHERE id = ?', (sid, ))
+        if cur.rowcount:
+            deleted.append(sid)
+    _tombstone(cur, 'source', deleted, seq)
+
+    cur.execute('COMMIT')
+
+# For merge_sorted_frags.py, which only knows sources by their src id and tags. Those not already
+# in the source table get a row with just those. fragments are dicts with fields
+# text, count_chars, count_mchars, refs (list of dicts with src, tags, maybe loc).
+source_id_cache = {}
+
+def insert_merged_fragments(fragments):
+    cur = cxn.cursor()
+
+    cur.execute('BEGIN')
+    seq = _next_seq(cur)
+
+    fids = [fragment_id(fragment['text']) for fragment in fragments]
+    rows = [(fid, f['text'], f['count_chars'], f['count_mchars']) for (fid, f) in zip(fids, fragments)]
+    _upsert_fragments(cur, rows, seq)
+    _check_fragment_ids(cur, rows)
+
+    for (fid, fragment) in zip(fids, fragments):
+        for ref in fragment['refs']:
+            sid = source_id_cache.get(ref['src'])
+            if sid is None:
+                sid = source_id(ref['src'])
+                cur.execute('INSERT INTO source (id, s3key, tags, modified) VALUES (?, ?, ?, ?) ON CONFLICT (id) DO NOTHING', (sid, ref['src'], ref['tags'], seq))
+                existing_s3key = cur.execute('SELECT s3key FROM source WHERE id = ?', (sid, )).fetchone()[0]
+                if existing_s3key != ref['src']:
+                    raise FragmentIdCollision(f'sources {ref["src"]!r} and {existing_s3key!r} have the same id {sid}')
+                source_id_cache[ref['src']] = sid
+            cur.execute('INSERT INTO hit (fragment_id, source_id, loc) VALUES (?, ?, ?) ON CONFLICT DO NOTHING', (fid, sid, ref.get('loc', '')))
+
+    cur.execute('COMMIT')
+
+# Builds the open db (which should be new, from create_tables(indexes=False)) from shard dbs written
+# by separate workers, e.g. fragment_docs_s3.py --shards. Each source must be in only one shard (see
+# shard_index), but fragments are deduplicated across shards (they have the same ids in every shard).
+# Rows are copied in bulk with attached dbs, and the indexes are only created once everything is loaded.
+# It's all one change, so every fragment and source gets the same seq.
+def merge_shards(shard_dbfns):
+    cur = cxn.cursor()
+    cur.execute('CREATE TEMP TABLE staged_fragment (id INTEGER NOT NULL, text TEXT NOT NULL, count_chars INTEGER NOT NULL, count_mchars INTEGER NOT NULL, logprob REAL, count_toks INTEGER, score_ev_20230516 REAL)')
+
+    cur.execute('BEGIN')
+    seq = _next_seq(cur)
+    cur.execute('COMMIT')
 
-    cur.execute('SELECT id FROM source WHERE s3key = ?', (source['s3key'], ))
-    source_id = cur.fetchone()[0]
+    for shard_dbfn in shard_dbfns:
+        cur.execute('ATTACH DATABASE ? AS shard', (shard_dbfn, ))
+        cur.execute('BEGIN')
+        cur.execute('INSERT INTO temp.staged_fragment SELECT id, text, count_chars, count_mchars, logprob, count_toks, score_ev_20230516 FROM shard.fragment')
+        # a source id collision fails here, on the primary key
+        cur.execute('INSERT INTO main.source (id, s3key, title, pubdate, url, tags, modified) SELECT id, s3key, title, pubdate, url, tags, ? FROM shard.source', (seq, ))
+        cur.execute('INSERT INTO main.hit (fragment_id, source_id, loc) SELECT fragment_id, source_id, loc FROM shard.hit')
+        cur.execute('COMMIT')
+        cur.execute('DETACH DATABASE shard')
 
-    for located_fragment in located_fragments:
-        cur.execute('INSERT INTO fragment (text, count_chars, count_mchars) VALUES (?, ?, ?) ON CONFLICT (text) DO NOTHING', (located_fragment['text'], located_fragment['count_chars'], located_fragment['count_mchars']))
-        # https://www.mail-archive.com/sqlite-users@mailinglists.sqlite.org/msg118667.html
-        # I am a little skeptical that the performance won't be bad, but let's see.
-        cur.execute('INSERT INTO hit (fragment_id, source_id, loc) VALUES ((SELECT id FROM fragment WHERE text = ?), ?, ?) ON CONFLICT DO NOTHING', (located_fragment['text'], source_id, located_fragment['loc']))
+    collision = cur.execute('SELECT id, MIN(text), MAX(text) FROM temp.staged_fragment GROUP BY id HAVING MIN(text) != MAX(text) LIMIT 1').fetchone()
+    if collision:
+        raise FragmentIdCollision(f'{collision[1]!r} and {collision[2]!r} have the same id {collision[0]}')
 
+    cur.execute('BEGIN')
+    cur.execute('INSERT INTO main.fragment (id, text, count_chars, count_mchars, logprob, count_toks, score_ev_20230516, modified) SELECT id, MIN(text), MIN(count_chars), MIN(count_mchars), MAX(logprob), MAX(count_toks), MAX(score_ev_20230516), ? FROM temp.staged_fragment GROUP BY id ORDER BY id', (seq, ))
+    cur.execute('DROP TABLE temp.staged_fragment')
     cur.execute('COMMIT')
+    create_indexes()
+
+# the tables that rekey converts: (table, column the id is a hash of, the hash function, columns that refer to the id)
+REKEYED_TABLES = [
+    ('fragment', 'text', 'fragment_id', [('hit', 'fragment_id'), ('fragment_score', 'fragment_id')]),
+    ('source', 's3key', 'source_id', [('hit', 'source_id')]),
+]
+
+# Converts a db from before fragment_id/source_id in place: fragments and sources get their hash ids
+# (with the tables rebuilt without the unique indexes on text and s3key), and everything that refers
+# to them is updated to match. The hit table is rebuilt too if it has its unique index as an inline
+# constraint, which would otherwise be left alongside hit_unique.
+def rekey():
+    cur = cxn.cursor()
+    tables = set(row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+
+    cur.execute('BEGIN')
+    for (table, key_column, hash_function, refs) in REKEYED_TABLES:
+        if not has_legacy_ids(table):
+            continue
+        columns = ', '.join(row[1] for row in cur.execute(f'PRAGMA table_info({table})') if row[1] != 'id')
+
+        cur.execute('CREATE TEMP TABLE rekey (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)')
+        cur.execute(f'INSERT INTO temp.rekey SELECT id, {hash_function}({key_column}) FROM {table}')
+        collision = cur.execute('SELECT new_id FROM temp.rekey GROUP BY new_id HAVING COUNT(*) > 1 LIMIT 1').fetchone()
+        if collision:
+            keys = [row[0] for row in cur.execute(f'SELECT t.{key_column} FROM {table} t INNER JOIN temp.rekey r ON r.old_id = t.id WHERE r.new_id = ?', (collision[0], ))]
+            cur.execute('ROLLBACK')
+            raise FragmentIdCollision(f'{keys!r} have the same id {collision[0]}')
+
+        cur.execute(f'ALTER TABLE {table} RENAME TO legacy_{table}')
+        cur.execute(next(sql for sql in SCHEMA.split(';') if f'TABLE IF NOT EXISTS {table} (' in sql))
+        cur.execute(f'INSERT INTO {table} (id, {columns}) SELECT {hash_function}({key_column}), {columns} FROM legacy_{table} ORDER BY 1')
+        cur.execute(f'DROP TABLE legacy_{table}')
+        for (ref_table, ref_column) in refs:
+            if ref_table in tables:
+                cur.execute(f'UPDATE {ref_table} SET {ref_column} = (SELECT new_id FROM temp.rekey WHERE old_id = {ref_table}.{ref_column})')
+        cur.execute('DROP TABLE temp.rekey')
+    if has_inline_constraints():
+        cur.execute('ALTER TABLE hit RENAME TO legacy_hit')
+        cur.execute(next(sql for sql in SCHEMA.split(';') if 'TABLE IF NOT EXISTS hit (' in sql))
+        cur.execute('INSERT INTO hit (fragment_id, source_id, loc) SELECT fragment_id, source_id, loc FROM legacy_hit ORDER BY 1, 2, 3')
+        cur.execute('DROP TABLE legacy_hit')
+    cur.execute('COMMIT')
+
+    create_tables()
+    create_indexes()
+
+def get_fragment_id_range():
+    cur = cxn.cursor()
+    cur.execute('SELECT MIN(id), MAX(id) FROM fragment')
+    return cur.fetchone()
+
+# Returns up to limit fragments with id in (after_id, max_id] that don't have a score with the given
+# name and version (so either no score, or one from another version of the scorer), in id order
+def get_unscored_fragments(score_name, version, after_id, max_id, limit):
+    cur = cxn.cursor()
+    fragments = []
+    for row in cur.execute('SELECT f.id, f.text, f.count_chars, f.count_mchars, f.logprob, f.count_toks FROM fragment f WHERE f.id > ? AND f.id <= ? AND NOT EXISTS (SELECT 1 FROM fragment_score fs WHERE fs.fragment_id = f.id AND fs.name = ? AND fs.version = ?) ORDER BY f.id LIMIT ?', (after_id, max_id, score_name, version, limit)):
+        fragments.append({
+            'id': row[0],
+            'text': row[1],
+            'count_chars': row[2],
+            'count_mchars': row[3],
+            'logprob': row[4],
+            'count_toks': row[5],
+        })
+    return fragments
+
+# scores is a list of (fragment_id, score) pairs, which are all written in one transaction. The
+# fragments are marked modified, since their score is part of what gets indexed.
+def insert_fragment_scores(score_name, version, scores):
+    cur = cxn.cursor()
+
+    cur.execute('BEGIN')
+    seq = _next_seq(cur)
+
+    cur.executemany('INSERT INTO fragment_score (fragment_id, name, version, score) VALUES (?, ?, ?, ?) ON CONFLICT (fragment_id, name) DO UPDATE SET version=excluded.version, score=excluded.score', [(fragment_id, score_name, version, score) for (fragment_id, score) in scores])
+    cur.executemany('UPDATE fragment SET modified = ? WHERE id = ?', [(seq, fragment_id) for (fragment_id, _) in scores])
+
+    cur.execute('COMMIT')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['rekey'], help='rekey: give fragments and sources in a db from before fragment_id/source_id their hash ids')
+    parser.add_argument('sqlite_db')
+    args = parser.parse_args()
+
+    open(args.sqlite_db)
+    if args.command == 'rekey':
+        if has_legacy_ids() or has_inline_constraints():
+            rekey()
+            cxn.execute('VACUUM')
+        else:
+            print('already has hash ids')
+    close()
@@ -11,9 +11,9 @@ import sys
 import boto3
 import srt
 import jaconv
-from bs4 import BeautifulSoup
 
 from ..util.count_chars import count_meaty_chars, remove_spaces_punctuation
+from ..util.html_parse import parse_p_children
 
 SUBTITLE_CONTINUATION_CHARS = '→➡'
 
@@ -157,23 +157,24 @@ def fragment_srt(text, log_reject):
 
     return frags
 
-def fragment_syosetu(text, log_reject):
-    soup = BeautifulSoup(text.strip(), 'html.parser')
+# takes a list of <p> elements, returns a list of fragments
+def fragment_html_paras(p_elems, log_reject):
     frags = []
-    for child in soup.contents[0].children:
-        # only consider <p> elements
-        # NOTE: we could recurse to find deeper <p> elements, but it doesn't seem necessary so far. could just do elem.descendants
-        if child.name == 'p':
-            para_text = child.get_text()
-            meaty_count = count_meaty_chars(para_text)
-            if meaty_count > 0: # skip useless paras
-                frag_texts = clean_and_divide(para_text, log_reject)
-
-                for frag_text in frag_texts:
-                    frag = {'text': frag_text}
-                    if child.has_attr('id'):
-                        frag['loc'] = f'a:{child["id"]}'
-
-                    frags.append(frag)
+    for child in p_elems:
+        para_text = child.get_text()
+        meaty_count = count_meaty_chars(para_text)
+        if meaty_count > 0: # skip useless paras
+            frag_texts = clean_and_divide(para_text, log_reject)
+
+            for frag_text in frag_texts:
+                frag = {'text': frag_text}
+                if child.has_attr('id'):
+                    frag['loc'] = f'a:{child["id"]}'
+
+                frags.append(frag)
 
     return frags
+
+# parser may be any BeautifulSoup tree builder, defaulting to the fastest one installed
+def fragment_syosetu(text, log_reject, parser=None):
+    return fragment_html_paras(parse_p_children(text.strip(), parser), log_reject)
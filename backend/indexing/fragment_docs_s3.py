@@ -2,6 +2,7 @@ import os
 import argparse
 import json
 import hashlib
+from multiprocessing import Pool
 
 import boto3
 
@@ -9,65 +10,127 @@ from . import fragdb
 from .fragment_doc import fragment_srt, fragment_syosetu
 from ..util.count_chars import count_meaty_chars
 
-def log_reject(text, sent, reason):
-    print('\t'.join([reason, sent, text, s3key]), file=reject_file)
+# returns (source, located_fragments) ready for fragdb.insert_source_fragments
+def fragment_doc(s3key, doc, minlen, maxlen, log_reject):
+    source_id = hashlib.md5(s3key.encode('utf-8')).hexdigest()
+
+    if s3key.startswith('ja/jpsubbers/'):
+        assert doc['type'] == 'application/x-subrip'
+        frags = fragment_srt(doc['text'], log_reject)
+        tags = 'drama,subs'
+    elif s3key.startswith('ja/syosetu/'):
+        assert doc['type'] == 'text/html'
+        frags = fragment_syosetu(doc['text'], log_reject)
+        tags = 'novel,url'
+    else:
+        assert False
+
+    source = {
+        's3key': s3key,
+        'title': doc['title'],
+        'pubdate': doc.get('published'),
+        'url': doc.get('url'),
+        'tags' : tags or None,
+    }
+
+    located_fragments = []
+    for frag in frags:
+        clen = count_meaty_chars(frag['text'])
+        if (clen >= minlen) and (clen <= maxlen):
+            located_fragments.append({
+                'text': frag['text'],
+                'count_chars': len(frag['text']),
+                'count_mchars': count_meaty_chars(frag['text']),
+                'loc': frag['loc'],
+            })
+
+    return (source, located_fragments)
+
+# takes an iterable of (s3key, doc), fragments them into the given db (creating it if needed)
+def fragment_docs_to_db(dbfn, reject_fn, docs, minlen, maxlen, verbose=True):
+    reject_file = open(reject_fn, 'x') # x means create only, fail if exists. safety measure
+    fragdb.open(dbfn, profile='bulk_load')
+    fragdb.create_tables()
+    fragdb.begin_bulk_load()
+
+    for (s3key, doc) in docs:
+        if verbose:
+            print(s3key)
+
+        def log_reject(text, sent, reason):
+            print('\t'.join([reason, sent, text, s3key]), file=reject_file)
+
+        (source, located_fragments) = fragment_doc(s3key, doc, minlen, maxlen, log_reject)
+        fragdb.insert_source_fragments(source, located_fragments)
+
+    fragdb.end_bulk_load()
+    fragdb.close()
+    reject_file.close()
+
+def iter_s3_docs(s3keys):
+    s3 = boto3.client('s3')
+    bucket = os.getenv('MASSIF_DOCS_BUCKET')
+    for s3key in s3keys:
+        obj = s3.get_object(Bucket=bucket, Key=s3key)
+        yield (s3key, json.loads(obj['Body'].read().decode('utf-8')))
+
+def fragment_s3_shard(dbfn, reject_fn, s3keys, minlen, maxlen):
+    fragment_docs_to_db(dbfn, reject_fn, iter_s3_docs(s3keys), minlen, maxlen)
+
+def fragment_s3_shard_star(args):
+    return fragment_s3_shard(*args)
+
+def shard_filename(fn, idx):
+    return f'{fn}.shard{idx}'
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--minlen', type=int, default=0)
     parser.add_argument('--maxlen', type=int, default=1000)
+    parser.add_argument('--shards', type=int, default=1, help='if more than one, fragment in this many worker processes, each into its own shard db, and then merge them into sqlite_db')
+    parser.add_argument('--keep-shards', action='store_true')
+    parser.add_argument('--delete-missing', action='store_true', help='delete sources under s3_prefix that are in the db but no longer in S3')
     parser.add_argument('sqlite_db')
     parser.add_argument('reject_file')
     parser.add_argument('s3_prefix')
     args = parser.parse_args()
-
-    reject_file = open(args.reject_file, 'x') # x means create only, fail if exists. safety measure
-
-    fragdb.open(args.sqlite_db)
+    if args.delete_missing and (args.shards > 1):
+        parser.error('sharding makes a new db, so there is nothing to delete')
 
     s3 = boto3.client('s3')
     bucket = os.getenv('MASSIF_DOCS_BUCKET')
 
+    s3keys = []
     s3_paginator = s3.get_paginator('list_objects_v2')
     for page in s3_paginator.paginate(Bucket=bucket, Prefix=args.s3_prefix):
         for entry in page['Contents']:
-            s3key = entry['Key']
-            print(s3key)
+            s3keys.append(entry['Key'])
+
+    if args.shards <= 1:
+        fragment_s3_shard(args.sqlite_db, args.reject_file, s3keys, args.minlen, args.maxlen)
+
+        if args.delete_missing:
+            fragdb.open(args.sqlite_db)
+            s3key_set = set(s3keys)
+            missing = [source['s3key'] for source in fragdb.iter_sources() if source['s3key'].startswith(args.s3_prefix) and (source['s3key'] not in s3key_set)]
+            fragdb.delete_sources(missing)
+            fragdb.close()
+            print(f'deleted {len(missing)} sources no longer in S3')
+    else:
+        assert not os.path.exists(args.sqlite_db), 'shards are merged into a new db'
+        shard_s3keys = [[] for _ in range(args.shards)]
+        for s3key in s3keys:
+            shard_s3keys[fragdb.shard_index(s3key, args.shards)].append(s3key)
+
+        shard_dbfns = [shard_filename(args.sqlite_db, i) for i in range(args.shards)]
+        with Pool(args.shards) as pool:
+            pool.map(fragment_s3_shard_star, [(shard_dbfns[i], shard_filename(args.reject_file, i), shard_s3keys[i], args.minlen, args.maxlen) for i in range(args.shards)])
 
-            obj = s3.get_object(Bucket=bucket, Key=s3key)
-
-            doc = json.loads(obj['Body'].read().decode('utf-8'))
-
-            source_id = hashlib.md5(s3key.encode('utf-8')).hexdigest()
-
-            if s3key.startswith('ja/jpsubbers/'):
-                assert doc['type'] == 'application/x-subrip'
-                frags = fragment_srt(doc['text'], log_reject)
-                tags = 'drama,subs'
-            elif s3key.startswith('ja/syosetu/'):
-                assert doc['type'] == 'text/html'
-                frags = fragment_syosetu(doc['text'], log_reject)
-                tags = 'novel,url'
-            else:
-                assert False
-
-            source = {
-                's3key': s3key,
-                'title': doc['title'],
-                'pubdate': doc.get('published'),
-                'url': doc.get('url'),
-                'tags' : tags or None,
-            }
-
-            located_fragments = []
-            for frag in frags:
-                clen = count_meaty_chars(frag['text'])
-                if (clen >= args.minlen) and (clen <= args.maxlen):
-                    located_fragments.append({
-                        'text': frag['text'],
-                        'count_chars': len(frag['text']),
-                        'count_mchars': count_meaty_chars(frag['text']),
-                        'loc': frag['loc'],
-                    })
-            fragdb.insert_source_fragments(source, located_fragments)
+        fragdb.open(args.sqlite_db, profile='bulk_load')
+        fragdb.create_tables(indexes=False)
+        fragdb.merge_shards(shard_dbfns)
+        fragdb.close()
 
+        if not args.keep_shards:
+            for fn in shard_dbfns:
+                os.remove(fn)
@@ -8,8 +8,8 @@ import boto3
 import srt
 import requests
 
-from ja_sent_split import SentenceTokenizer
-from chunk_doc import chunk_doc
+from ..util.ja_sent_split import SentenceTokenizer
+from .chunk_doc import chunk_doc
 
 sentence_tokenizer = SentenceTokenizer()
 
@@ -4,14 +4,17 @@ import sys
 import json
 import argparse
 import random
+import multiprocessing
 from collections import Counter
 
-import requests
-
 from . import fragdb
+from .es_bulk import BulkSender, ndjson, refresh_index
+from .es_indexes import ensure_index
 
 from ..util.count_chars import count_meaty_chars
-from ..common.ja import ja_get_text_morphemes, ja_get_morphemes_normal_stats, ja_get_morphemes_reading, ja_is_repetitive
+from ..common.fragment_hits import encode_hits
+from ..common.normal_fragments import NormalFragmentsWriter
+from ..common.ja import ja_open_analysis_cache, ja_close_analysis_cache, ja_preload, ja_get_texts_morphemes, ja_get_morphemes_normal_stats, ja_get_morphemes_reading, ja_is_repetitive
 
 INDEX_BATCH_SIZE = 1024
 MAX_HITS_PER_TAG_SET = 4
@@ -20,7 +23,7 @@ def jdump(obj):
     return json.dumps(obj, ensure_ascii=False)
 
 def index_sources_batch(source_rows):
-    lines = []
+    actions = []
 
     for source in source_rows:
         assert source['title']
@@ -36,35 +39,90 @@ def index_sources_batch(source_rows):
         else:
             obj['tags'] = []
 
-        lines.append(jdump({'index': {'_id': source['id']}}) + '\n')
-        lines.append(jdump(obj) + '\n')
+        actions.append(({'index': {'_id': str(source['id'])}}, obj))
 
-    data = ''.join(lines)
+    send_actions(source_sender, actions, 'SOURCE')
 
-    if args.print_docs:
-        print('SOURCE', data)
-    if source_index:
-        resp = requests.post(f'http://localhost:9200/{source_index}/_bulk', headers={'Content-Type': 'application/x-ndjson'}, data=data.encode('utf-8'))
-        resp.raise_for_status()
+# Unless the fragment index was just created by this run, fragment docs are updated in place instead
+# of replaced, so that fields added by others (mscore_NAME from rescore_fragments.py) aren't lost,
+# whether or not the run is incremental. The fields we set are replaced whole by a script, since a
+# partial doc update would merge hits with the old doc's, keeping tag-sets it no longer has. With
+# scripted_upsert, new docs go through the script too, starting from upsert.
+UPDATE_FRAGMENT_SCRIPT = 'ctx._source.putAll(params.doc)'
 
+# fragments is a list of (id, doc). ids are fragdb fragment ids, which are stable across rebuilds
 def index_fragments_batch(fragments):
-    lines = []
-
-    for fragment in fragments:
-        lines.append(jdump({'index': {}}) + '\n')
-        lines.append(jdump(fragment) + '\n')
+    if not update_fragments:
+        actions = [({'index': {'_id': str(fragment_id)}}, fragment) for (fragment_id, fragment) in fragments]
+    else:
+        actions = [({'update': {'_id': str(fragment_id)}}, {'script': {'source': UPDATE_FRAGMENT_SCRIPT, 'params': {'doc': fragment}}, 'scripted_upsert': True, 'upsert': {}}) for (fragment_id, fragment) in fragments]
+    send_actions(fragment_sender, actions, 'FRAGMENT')
 
-    data = ''.join(lines)
+# for fragments and sources removed from fragdb since the last run, by id
+def delete_docs(sender, ids, label):
+    for i in range(0, len(ids), INDEX_BATCH_SIZE):
+        send_actions(sender, [({'delete': {'_id': str(id)}}, None) for id in ids[i:i+INDEX_BATCH_SIZE]], label)
 
+def send_actions(sender, actions, label):
     if args.print_docs:
-        print('FRAGMENT', data)
-    if fragment_index:
-        resp = requests.post(f'http://localhost:9200/{fragment_index}/_bulk', headers={'Content-Type': 'application/x-ndjson'}, data=data.encode('utf-8'))
-        resp.raise_for_status()
+        print(label, ndjson(actions))
+    if sender:
+        sender.send(actions)
+
+# for a fragment that isn't indexed (no score, or repetitive). In an incremental run it was modified
+# since the last one, so it may have been indexed then, and its doc is deleted
+def skip_fragment(fragment_id):
+    if modified_after is not None:
+        accum_frag_deletes.append(fragment_id)
+
+# rows are (row from fragdb, score). tokenizes all their texts at once, then adds their docs to accum_frags
+def add_fragment_rows(scored_rows):
+    morpheme_lists = ja_get_texts_morphemes([row['text'] for (row, _) in scored_rows], tokenize_pool)
+    for ((row, score), morphemes) in zip(scored_rows, morpheme_lists):
+        # Map from unique tag-set (sorted, comma-joined into string) to a list of (source_id, loc) of hits
+        # with that tag-set. The tag-set string may be the empty string if there are no tags for that hit.
+        tag_set_hits = {}
+        for hit in row['hits']:
+            tag_set_str = ','.join(sorted(hit['tags'].split(','))) if hit['tags'] else ''
+            tag_set_hits.setdefault(tag_set_str, []).append((hit['source_id'], hit['loc']))
+
+        # Limit how many hits we store for each unique tag-set
+        tag_sets = {}
+        for (k, v) in tag_set_hits.items():
+            random.shuffle(v)
+            tag_sets[k] = (len(v), v[:MAX_HITS_PER_TAG_SET])
+
+        text = row['text']
+
+        if ja_is_repetitive(text, morphemes):
+            skip_fragment(row['id'])
+            continue
+
+        normal_stats = ja_get_morphemes_normal_stats(morphemes)
+        for normal, stats in normal_stats.items():
+            combined_normal_stats.setdefault(normal, {
+                'c': 0,
+                'sc': Counter(), # sub-counts by surface forms
+                'dc': Counter(), # sub-counts by dictionary forms
+            })
+            combined_normal_stats[normal]['c'] += stats['c']
+            combined_normal_stats[normal]['sc'].update(stats['sc'])
+            combined_normal_stats[normal]['dc'].update(stats['dc'])
 
-def refresh_index(index):
-    resp = requests.post(f'http://localhost:9200/{index}/_refresh')
-    resp.raise_for_status()
+        reading = ja_get_morphemes_reading(morphemes)
+
+        doc = {
+            'text': row['text'],
+            'normals': list(normal_stats.keys()),
+            'reading': reading,
+            'mscore': score,
+            'tag_sets': list(tag_sets.keys()), # ES can accept an array for any field
+            'tags': sorted(set(tag for k in tag_sets.keys() if k for tag in k.split(','))), # for filtering and counts by tag
+            'hits': encode_hits(tag_sets), # only stored, see common/fragment_hits.py
+        }
+        accum_frags.append((row['id'], doc))
+        if normal_fragments:
+            normal_fragments.add(score, doc)
 
 def flush_accum_sources():
     global accum_sources
@@ -73,102 +131,120 @@ def flush_accum_sources():
     accum_sources = []
 
 def flush_accum_frags():
-    global accum_frags
+    global accum_frags, accum_frag_deletes
     if accum_frags:
         index_fragments_batch(accum_frags)
     accum_frags = []
+    delete_docs(fragment_sender, accum_frag_deletes, 'DELETE FRAGMENT')
+    accum_frag_deletes = []
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--print-docs', action='store_true')
     parser.add_argument('--index-suffix')
     parser.add_argument('--normal-stats-file')
+    parser.add_argument('--normal-fragments-file', help='write the top fragments for each normal here, for the web app to serve /api/get_normal_fragments from (see common/normal_fragments.py)')
+    parser.add_argument('--score-name', help='use this score from fragment_score (see score_fragments.py) instead of score_ev_20230516')
+    parser.add_argument('--analysis-cache', help='SQLite file to cache morphological analyses in, so reindexing can skip tokenization')
+    parser.add_argument('--bulk-concurrency', type=int, default=4, help='max _bulk requests in flight')
+    parser.add_argument('--tokenize-processes', type=int, default=1, help='if more than one, tokenize in a pool of this many worker processes')
+    parser.add_argument('--incremental', action='store_true', help='only send what changed in the db since the last run for this --index-suffix, and delete what was removed')
     parser.add_argument('sqlite_db')
     args = parser.parse_args()
-
-    fragdb.open(args.sqlite_db)
+    if args.incremental and not args.index_suffix:
+        parser.error('--incremental needs --index-suffix')
+    if args.incremental and (args.normal_stats_file or args.normal_fragments_file):
+        parser.error('normal stats and fragments are over all fragments, so need a full run')
+
+    fragdb.open(args.sqlite_db, profile='read')
+    fragdb.create_tables() # adds change tracking to older dbs
+
+    # everything up to here is indexed by the end of this run. changes made while it runs may or may not
+    # be, so they get sent again next time
+    seq = fragdb.get_seq()
+    modified_after = None
+    if args.incremental:
+        modified_after = fragdb.get_watermark(args.index_suffix)
+        if modified_after is None:
+            print('NO WATERMARK FOR', args.index_suffix, 'SO INDEXING EVERYTHING')
+    if args.analysis_cache:
+        ja_open_analysis_cache(args.analysis_cache)
+    tokenize_pool = None
+    if args.tokenize_processes > 1:
+        ja_preload() # before forking, so the workers share the dictionary
+        tokenize_pool = multiprocessing.Pool(args.tokenize_processes)
 
     if args.index_suffix:
         fragment_index = 'fragment_' + args.index_suffix
         source_index = 'source_' + args.index_suffix
+        update_fragments = not ensure_index('fragment', fragment_index)
+        ensure_index('source', source_index)
+        fragment_sender = BulkSender(fragment_index, args.bulk_concurrency)
+        source_sender = BulkSender(source_index, args.bulk_concurrency)
     else:
         fragment_index = None
         source_index = None
+        update_fragments = False
+        fragment_sender = None
+        source_sender = None
+
+    if modified_after is not None:
+        print('DELETING REMOVED SOURCES AND FRAGMENTS')
+        delete_docs(source_sender, list(fragdb.iter_deleted_ids('source', modified_after)), 'DELETE SOURCE')
+        delete_docs(fragment_sender, list(fragdb.iter_deleted_ids('fragment', modified_after)), 'DELETE FRAGMENT')
 
     print('INDEXING SOURCES')
     accum_sources = []
     count = 0
-    for row in fragdb.iter_sources():
+    for row in fragdb.iter_sources(modified_after):
         accum_sources.append(row)
         count += 1
         if (count % INDEX_BATCH_SIZE) == 0:
             flush_accum_sources()
     flush_accum_sources()
     if source_index:
+        source_sender.close()
         refresh_index(source_index)
 
     print('INDEXING FRAGMENTS')
+    normal_fragments = NormalFragmentsWriter(args.normal_fragments_file) if args.normal_fragments_file else None
     accum_frags = []
-    count = 0
+    accum_frag_deletes = []
+    pending_rows = []
     combined_normal_stats = {}
-    for row in fragdb.iter_fragments_plus():
+    for row in fragdb.iter_fragments_plus(args.score_name, modified_after):
         # if row['logprob'] is None:
         #     continue
         # score = row['logprob']/math.pow(row['count_chars'], 0.5)
 
-        if row['score_ev_20230516'] is None:
+        if args.score_name:
+            score = row['score']
+        else:
+            score = row['score_ev_20230516'] # adjust for length?
+        if score is None:
+            skip_fragment(row['id'])
             continue
-        score = row['score_ev_20230516'] # adjust for length?
-
-        # Map from unique tag-set (sorted, comma-joined into string) to a list of hits with that tag-set.
-        # The tag-set string may be the empty string if there are no tags for that hit.
-        tag_sets = {}
-        for hit in row['hits']:
-            tag_set_str = ','.join(sorted(hit['tags'].split(','))) if hit['tags'] else ''
-            tag_sets.setdefault(tag_set_str, {'sample': []})
-            del hit['tags'] # remove this, since now redundant and don't want to store
-            tag_sets[tag_set_str]['sample'].append(hit)
-
-        # Limit how many hits we store for each unique tag-set
-        for k, v in tag_sets.items():
-            v['count'] = len(v['sample'])
-            random.shuffle(v['sample'])
-            del v['sample'][MAX_HITS_PER_TAG_SET:] # truncate list in-place
 
-        text = row['text']
-
-        morphemes = ja_get_text_morphemes(text)
-
-        if ja_is_repetitive(text, morphemes):
-            continue # skip this fragment
-
-        normal_stats = ja_get_morphemes_normal_stats(morphemes)
-        for normal, stats in normal_stats.items():
-            combined_normal_stats.setdefault(normal, {
-                'c': 0,
-                'sc': Counter(), # sub-counts by surface forms
-                'dc': Counter(), # sub-counts by dictionary forms
-            })
-            combined_normal_stats[normal]['c'] += stats['c']
-            combined_normal_stats[normal]['sc'].update(stats['sc'])
-            combined_normal_stats[normal]['dc'].update(stats['dc'])
-
-        reading = ja_get_morphemes_reading(morphemes)
-
-        accum_frags.append({
-            'text': row['text'],
-            'normals': list(normal_stats.keys()),
-            'reading': reading,
-            'mscore': score,
-            'tag_sets': list(tag_sets.keys()), # ES can accept an array for any field
-            'hits': tag_sets, # store the entire object
-        })
-        count += 1
-        if (count % INDEX_BATCH_SIZE) == 0:
+        pending_rows.append((row, score))
+        if len(pending_rows) >= INDEX_BATCH_SIZE:
+            add_fragment_rows(pending_rows)
             flush_accum_frags()
+            pending_rows = []
+    add_fragment_rows(pending_rows)
     flush_accum_frags()
+    if normal_fragments:
+        normal_fragments.close()
+    if tokenize_pool:
+        tokenize_pool.close()
     if fragment_index:
+        fragment_sender.close()
         refresh_index(fragment_index)
+    if args.analysis_cache:
+        ja_close_analysis_cache()
+    if fragment_index:
+        fragdb.set_watermark(args.index_suffix, seq)
+    fragdb.close()
 
-    with open(args.normal_stats_file, 'w') as f:
-        f.write(jdump(combined_normal_stats))
+    if args.normal_stats_file:
+        with open(args.normal_stats_file, 'w') as f:
+            f.write(jdump(combined_normal_stats))
@@ -1,23 +1,28 @@
 import sys
 import json
+import heapq
 import random
+import struct
+import argparse
+from itertools import groupby
 
-accum = None # this will be (text, [ref, ref, ...])
+from . import fragdb
+from ..util.count_chars import count_meaty_chars
+
+# Merges fragment files, each with lines of text, src, loc, tags (tab-separated) sorted by text
+# (codepoint order, e.g. with LC_ALL=C sort), into one record per distinct text with at most
+# MAX_REFS refs. So fragmentation can be done in parallel shards, each writing its own sorted file.
 
 MAX_REFS = 20
+SEED = 'massif'
 
-def emit_accum():
-    global accum
-    if accum:
-        shuf_refs = accum[1][:]
-        random.shuffle(shuf_refs)
-        print('%s\t%s' % (accum[0], json.dumps(shuf_refs[:MAX_REFS], sort_keys=True, ensure_ascii=False)))
-    accum = None
+FRAGDB_BATCH_SIZE = 10000
 
-if __name__ == "__main__":
-    random.seed('massif') # to make stable during testing at least
-    sys.stdin.reconfigure(encoding='utf-8')
-    for line in sys.stdin:
+BIN_MAGIC = b'MSFRAG1\n'
+
+def iter_file_refs(f, name):
+    prev_text = None
+    for line in f:
         sline = line.strip('\n')
         if not sline:
             continue
@@ -36,6 +41,10 @@ if __name__ == "__main__":
         # TODO: temporary sanity check due to issue with extra tabs
         assert(tags.count(',') == 1)
 
+        if (prev_text is not None) and (text < prev_text):
+            raise ValueError(f'{name} is not sorted (use LC_ALL=C sort): {prev_text!r} before {text!r}')
+        prev_text = text
+
         ref = {
             'src': src,
             'tags': tags,
@@ -43,9 +52,141 @@ if __name__ == "__main__":
         if loc:
             ref['loc'] = loc
 
-        if accum and (text == accum[0]):
-            accum[1].append(ref)
+        yield (text, ref)
+
+# Keeps a uniform random sample of at most max_refs of the refs, in random order. The RNG is seeded
+# from the seed and text, so results don't depend on what else is in the files or how they're split.
+def sample_refs(text, refs, max_refs, seed):
+    rng = random.Random(seed + '\t' + text)
+    reservoir = []
+    for (i, ref) in enumerate(refs):
+        if i < max_refs:
+            reservoir.append(ref)
+        else:
+            j = rng.randrange(i + 1)
+            if j < max_refs:
+                reservoir[j] = ref
+    rng.shuffle(reservoir)
+    return reservoir
+
+# yields (text, refs) in text order. ties between files are broken by file order, so it's deterministic
+def merge_refs(ref_iters, max_refs=MAX_REFS, seed=SEED):
+    merged = heapq.merge(*ref_iters, key=lambda text_ref: text_ref[0])
+    for (text, group) in groupby(merged, key=lambda text_ref: text_ref[0]):
+        yield (text, sample_refs(text, (ref for (_, ref) in group), max_refs, seed))
+
+def write_tsv(merged, f):
+    for (text, refs) in merged:
+        f.write('%s\t%s\n' % (text, json.dumps(refs, sort_keys=True, ensure_ascii=False)))
+
+# Compact binary format: BIN_MAGIC, then per text a record of varint-length-prefixed UTF-8 strings:
+# text, ref count (varint), then src, loc, tags for each ref.
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _write_str(out, s):
+    b = s.encode('utf-8')
+    _write_varint(out, len(b))
+    out += b
+
+def write_bin(merged, f):
+    f.write(BIN_MAGIC)
+    for (text, refs) in merged:
+        out = bytearray()
+        _write_str(out, text)
+        _write_varint(out, len(refs))
+        for ref in refs:
+            _write_str(out, ref['src'])
+            _write_str(out, ref.get('loc', ''))
+            _write_str(out, ref['tags'])
+        f.write(out)
+
+def iter_bin(f):
+    data = f.read()
+    assert data.startswith(BIN_MAGIC), 'not a merged fragment file'
+    pos = len(BIN_MAGIC)
+
+    def read_varint():
+        nonlocal pos
+        n = 0
+        shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def read_str():
+        nonlocal pos
+        length = read_varint()
+        s = data[pos:pos+length].decode('utf-8')
+        pos += length
+        return s
+
+    while pos < len(data):
+        text = read_str()
+        refs = []
+        for _ in range(read_varint()):
+            ref = {'src': read_str()}
+            loc = read_str()
+            ref['tags'] = read_str()
+            if loc:
+                ref['loc'] = loc
+            refs.append(ref)
+        yield (text, refs)
+
+def write_fragdb(merged):
+    batch = []
+    for (text, refs) in merged:
+        batch.append({
+            'text': text,
+            'count_chars': len(text),
+            'count_mchars': count_meaty_chars(text),
+            'refs': refs,
+        })
+        if len(batch) >= FRAGDB_BATCH_SIZE:
+            fragdb.insert_merged_fragments(batch)
+            batch = []
+    if batch:
+        fragdb.insert_merged_fragments(batch)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-refs', type=int, default=MAX_REFS)
+    parser.add_argument('--seed', default=SEED)
+    parser.add_argument('--format', choices=['tsv', 'bin', 'fragdb'], default='tsv')
+    parser.add_argument('--output', help='output file (sqlite db for fragdb format), default stdout for tsv')
+    parser.add_argument('input_files', nargs='*', help='sorted fragment files (default stdin)')
+    args = parser.parse_args()
+
+    if args.input_files:
+        files = [open(fn, encoding='utf-8') for fn in args.input_files]
+        ref_iters = [iter_file_refs(f, fn) for (f, fn) in zip(files, args.input_files)]
+    else:
+        sys.stdin.reconfigure(encoding='utf-8')
+        ref_iters = [iter_file_refs(sys.stdin, 'stdin')]
+
+    merged = merge_refs(ref_iters, args.max_refs, args.seed)
+
+    if args.format == 'tsv':
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                write_tsv(merged, f)
         else:
-            emit_accum()
-            accum = (text, [ref])
-    emit_accum()
+            sys.stdout.reconfigure(encoding='utf-8')
+            write_tsv(merged, sys.stdout)
+    elif args.format == 'bin':
+        assert args.output
+        with open(args.output, 'wb') as f:
+            write_bin(merged, f)
+    else:
+        assert args.output
+        fragdb.open(args.output)
+        fragdb.create_tables()
+        write_fragdb(merged)
+        fragdb.close()
@@ -0,0 +1,65 @@
+import re
+import sys
+import time
+import argparse
+
+import requests
+
+from . import fragdb
+from .es_bulk import ES_BASE_URL, BulkSender, refresh_index
+
+# Updates just the score field of fragments that are already in an index, from scores in fragdb, so
+# changing the ranking doesn't need a full run of index_fragments.py (which tokenizes everything).
+# Scores can go in mscore (what search sorts by), or in a named field mscore_NAME alongside it, which
+# search can be told to sort by instead (see the score param in web/application.py) to try out a new
+# ranking on the live index.
+
+UPDATE_BATCH_SIZE = 5000
+SCORE_FIELD_RE = re.compile(r'mscore(_[a-z0-9_]+)?')
+
+def score_field_name(field):
+    if not SCORE_FIELD_RE.fullmatch(field):
+        raise ValueError(f'score field must be mscore or mscore_NAME, not {field!r}')
+    return field
+
+# the index mapping is strict, so a new named score field has to be added before docs can have it
+def add_score_field(index, field, base_url=ES_BASE_URL):
+    resp = requests.put(f'{base_url}/{index}/_mapping', json={'properties': {field: {'type': 'float'}}})
+    resp.raise_for_status()
+
+# scores is an iterable of (fragment_id, score). Fragments that aren't in the index (e.g. because
+# they were skipped by index_fragments.py) are counted rather than being an error.
+def rescore(sender, field, scores, batch_size=UPDATE_BATCH_SIZE):
+    batch = []
+    for (fragment_id, score) in scores:
+        batch.append(({'update': {'_id': str(fragment_id)}}, {'doc': {field: score}}))
+        if len(batch) >= batch_size:
+            sender.send(batch)
+            batch = []
+    if batch:
+        sender.send(batch)
+    return sender.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index-suffix', required=True)
+    parser.add_argument('--score-name', help='score from fragment_score (see score_fragments.py), default is score_ev_20230516')
+    parser.add_argument('--field', default='mscore', type=score_field_name, help='mscore, or mscore_NAME to keep this score alongside it')
+    parser.add_argument('--concurrency', type=int, default=4, help='max _bulk requests in flight')
+    parser.add_argument('--batch-size', type=int, default=UPDATE_BATCH_SIZE)
+    parser.add_argument('sqlite_db')
+    args = parser.parse_args()
+
+    fragment_index = 'fragment_' + args.index_suffix
+    if args.field != 'mscore':
+        add_score_field(fragment_index, args.field)
+
+    fragdb.open(args.sqlite_db, profile='read')
+    t0 = time.time()
+    counts = rescore(BulkSender(fragment_index, args.concurrency, ignore_statuses=[404]), args.field, fragdb.iter_fragment_scores(args.score_name), args.batch_size)
+    dt = time.time() - t0
+    fragdb.close()
+    refresh_index(fragment_index)
+
+    total = sum(counts.values())
+    print(f'{total} fragments in {dt:.1f}s ({total/dt:.0f}/s): {counts["updated"]} updated, {counts["noop"]} unchanged, {counts[404]} not in index', file=sys.stderr)
@@ -0,0 +1,111 @@
+import sys
+import time
+import argparse
+import importlib
+from multiprocessing import Pool
+
+from . import fragdb
+
+# A scorer takes a list of fragment rows (with fields id, text, count_chars, count_mchars, logprob,
+# count_toks) and returns a list of scores in the same order. A score may be None if the fragment
+# can't be scored yet (e.g. it's waiting on GPT-2 logprobs), in which case it's left for a later run.
+# The version should be bumped whenever a scorer's output changes: it's recorded with each score, and
+# fragments with a score from another version are scored again.
+class Scorer:
+    name = None
+    version = None
+
+    def score(self, fragments):
+        raise NotImplementedError
+
+# Sum of GPT-2 token logprobs, as filled in by scoring/gpt2-ja/score.py --sqlite-db
+class LogprobScorer(Scorer):
+    name = 'gpt2_logprob'
+    version = 'gpt2ja-medium-1'
+
+    def score(self, fragments):
+        return [f['logprob'] for f in fragments]
+
+# Length-normalized variant, as in scoring/gpt2-ja/convert_score.py
+class LogprobPerMcharScorer(Scorer):
+    name = 'gpt2_logprob_per_mchar'
+    version = 'gpt2ja-medium-1'
+
+    def score(self, fragments):
+        return [(f['logprob']/f['count_mchars']) if ((f['logprob'] is not None) and f['count_mchars']) else None for f in fragments]
+
+SCORERS = {cls.name: cls for cls in [LogprobScorer, LogprobPerMcharScorer]}
+
+# spec is either a registered scorer name, or 'module.path:ClassName' for anything else
+def make_scorer(spec):
+    if spec in SCORERS:
+        return SCORERS[spec]()
+    (module_name, _, attr) = spec.partition(':')
+    assert attr, 'unknown scorer ' + repr(spec)
+    return getattr(importlib.import_module(module_name), attr)()
+
+# Score all fragments with id in (after_id, max_id] that don't have a score from this version of the
+# scorer. Returns (scored, skipped) counts.
+def score_id_range(dbfn, scorer_spec, after_id, max_id, chunk_size):
+    fragdb.open(dbfn, timeout=600) # other workers may be holding the write lock
+    scorer = make_scorer(scorer_spec)
+
+    scored = 0
+    skipped = 0
+    while True:
+        fragments = fragdb.get_unscored_fragments(scorer.name, scorer.version, after_id, max_id, chunk_size)
+        if not fragments:
+            break
+        after_id = fragments[-1]['id']
+
+        scores = scorer.score(fragments)
+        assert len(scores) == len(fragments)
+        results = [(f['id'], s) for (f, s) in zip(fragments, scores) if s is not None]
+        fragdb.insert_fragment_scores(scorer.name, scorer.version, results)
+
+        scored += len(results)
+        skipped += len(fragments) - len(results)
+
+    fragdb.close()
+    return (scored, skipped)
+
+def score_id_range_star(args):
+    return score_id_range(*args)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scorer', default=LogprobPerMcharScorer.name, help='one of ' + ', '.join(SCORERS) + ', or module.path:ClassName')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('sqlite_db')
+    args = parser.parse_args()
+
+    fragdb.open(args.sqlite_db)
+    fragdb.create_tables() # adds fragment_score etc. to older dbs
+    (min_id, max_id) = fragdb.get_fragment_id_range()
+    fragdb.close()
+
+    if min_id is None:
+        print('no fragments', file=sys.stderr)
+        sys.exit(0)
+
+    # split ids into contiguous ranges, one per worker
+    ranges = []
+    range_size = (max_id - min_id + args.workers)//args.workers
+    after_id = min_id - 1
+    while after_id < max_id:
+        range_max = min(after_id + range_size, max_id)
+        ranges.append((args.sqlite_db, args.scorer, after_id, range_max, args.chunk_size))
+        after_id = range_max
+
+    t0 = time.time()
+    if args.workers > 1:
+        with Pool(args.workers) as pool:
+            results = pool.map(score_id_range_star, ranges)
+    else:
+        results = [score_id_range_star(r) for r in ranges]
+    dt = time.time() - t0
+
+    scored = sum(r[0] for r in results)
+    skipped = sum(r[1] for r in results)
+    print(f'scored {scored} fragments ({skipped} not scorable yet) in {dt:.1f}s', file=sys.stderr)
@@ -0,0 +1,171 @@
+import html
+import random
+from datetime import timedelta
+
+import srt
+from bs4 import BeautifulSoup
+
+from .chunk_doc import group_subs_list, group_sents, group_split_paras, break_into_sentences, SENT_RE, HTML_MAX_CHUNK_CHARS, HTML_REJECT_CHUNK_CHARS, SUBTITLE_FORCED_CHUNK_TIME_GAP, SUBTITLE_MAX_CHUNK_CHARS, SUBTITLE_CONTINUATION_CHARS
+from ..util.count_chars import count_meaty_chars
+
+# Straightforward recursive versions of the chunkers, which the real ones must match exactly
+def ref_group_subs_list(subs):
+    if len(subs) == 1:
+        return [subs]
+
+    potential_breaks = [] # (time_gap, cumul_chars, before_idx) tuples
+    prev_sub = None
+    total_chars = 0
+    for (idx, sub) in enumerate(subs):
+        if prev_sub:
+            prev_sub_stripped = prev_sub.content.strip()
+            prev_sub_continuation = prev_sub_stripped and (prev_sub_stripped[-1] in SUBTITLE_CONTINUATION_CHARS)
+            time_gap = -1 if prev_sub_continuation else (sub.start - prev_sub.end).total_seconds()
+            potential_breaks.append((time_gap, total_chars, idx))
+        total_chars += count_meaty_chars(sub.content)
+        prev_sub = sub
+
+    potential_breaks.sort(reverse=True)
+    biggest_gap = potential_breaks[0][0]
+    if biggest_gap < SUBTITLE_FORCED_CHUNK_TIME_GAP and total_chars <= SUBTITLE_MAX_CHUNK_CHARS:
+        return [subs]
+
+    ties = [b for b in potential_breaks if b[0] == biggest_gap]
+    center_char_count = 0.5*total_chars
+    ties.sort(key=lambda b: abs(b[1] - center_char_count))
+    split_before_idx = ties[0][2]
+
+    return ref_group_subs_list(subs[:split_before_idx]) + ref_group_subs_list(subs[split_before_idx:])
+
+def ref_balanced_split(items):
+    potential_breaks = [] # (cumul_chars, before_idx) tuples
+    total_chars = 0
+    for (idx, item) in enumerate(items):
+        if idx > 0:
+            potential_breaks.append((total_chars, idx))
+        total_chars += item['chars']
+    center_char_count = 0.5*total_chars
+    potential_breaks.sort(key=lambda b: abs(b[0] - center_char_count))
+    return (total_chars, potential_breaks[0][1])
+
+def ref_group_sents(sents):
+    if len(sents) == 1:
+        if sents[0]['chars'] > HTML_REJECT_CHUNK_CHARS:
+            return []
+        return [sents]
+    (total_chars, split_before_idx) = ref_balanced_split(sents)
+    if total_chars <= HTML_MAX_CHUNK_CHARS:
+        return [sents]
+    return ref_group_sents(sents[:split_before_idx]) + ref_group_sents(sents[split_before_idx:])
+
+def ref_group_split_paras(paras):
+    if len(paras) == 1:
+        if paras[0]['chars'] <= HTML_MAX_CHUNK_CHARS:
+            return [[paras[0]]]
+        para_groups = []
+        for sent_group in ref_group_sents(paras[0]['sents']):
+            para = {
+                'sents': sent_group,
+                'chars': sum(sent['chars'] for sent in sent_group),
+            }
+            if paras[0].get('anchor'):
+                para['anchor'] = paras[0]['anchor']
+            para_groups.append([para])
+        return para_groups
+    (total_chars, split_before_idx) = ref_balanced_split(paras)
+    if total_chars <= HTML_MAX_CHUNK_CHARS:
+        return [paras]
+    return ref_group_split_paras(paras[:split_before_idx]) + ref_group_split_paras(paras[split_before_idx:])
+
+def ref_simplified_inner_html(elem):
+    if elem.name is None:
+        return html.escape(str(elem))
+    pieces = []
+    for e in elem.children:
+        if e.name == 'ruby':
+            pieces.append(str(e))
+        else:
+            pieces.append(ref_simplified_inner_html(e))
+    return ''.join(pieces)
+
+def ref_break_into_sentences(elem):
+    sentences = []
+    for sent_html in SENT_RE.findall(ref_simplified_inner_html(elem)):
+        shtml = sent_html.strip()
+        if not shtml:
+            continue
+        text = BeautifulSoup(shtml, 'html.parser').get_text()
+        sentences.append({
+            'html': shtml,
+            'text': text,
+            'chars': count_meaty_chars(text),
+        })
+    return sentences
+
+def random_subs(rng, count):
+    subs = []
+    t = timedelta(seconds=rng.randint(0, 100))
+    for i in range(count):
+        # lots of repeated gap values, so that we exercise tie-breaking
+        t += timedelta(seconds=rng.choice([0, 0, 0, 0.5, 1, 1, 2, 6, 10]))
+        duration = timedelta(seconds=rng.choice([1, 2, 3]))
+        content = 'あ'*rng.choice([1, 2, 5, 10, 20, 30])
+        if rng.random() < 0.1:
+            content += rng.choice(SUBTITLE_CONTINUATION_CHARS)
+        subs.append(srt.Subtitle(index=i+1, start=t, end=t+duration, content=content))
+        t += duration
+    return subs
+
+def random_sents(rng, count):
+    return [{'text': str(i), 'chars': rng.choice([0, 1, 5, 10, 20, 40, 100, 200])} for i in range(count)]
+
+def random_paras(rng, count):
+    paras = []
+    for i in range(count):
+        sents = random_sents(rng, rng.randint(1, 8))
+        para = {'sents': sents, 'chars': sum(s['chars'] for s in sents)}
+        if rng.random() < 0.5:
+            para['anchor'] = f'L{i}'
+        paras.append(para)
+    return paras
+
+def group_shape(groups):
+    return [[id(item) for item in group] for group in groups]
+
+rng = random.Random('massif')
+for trial in range(300):
+    count = rng.randint(1, 60)
+
+    subs = random_subs(rng, count)
+    if group_shape(group_subs_list(subs)) != group_shape(ref_group_subs_list(subs)):
+        print('FAIL GROUP SUBS', trial)
+
+    sents = random_sents(rng, count)
+    if group_shape(group_sents(sents)) != group_shape(ref_group_sents(sents)):
+        print('FAIL GROUP SENTS', trial)
+
+    paras = random_paras(rng, count)
+    if group_split_paras(paras) != ref_group_split_paras(paras):
+        print('FAIL GROUP PARAS', trial)
+
+SENTENCE_CASES = [
+    '<p>食べる</p>',
+    '<p id="L1">そのせいだろうか。あの日に見た空の青を、よく覚えている。</p>',
+    '<p>「……血……血が……………」</p>',
+    '<p>　　え？　本当！？　うそ……。</p>',
+    '<p><ruby><rb>漢字</rb><rp>(</rp><rt>かんじ</rt><rp>)</rp></ruby>を書く。<ruby>読<rt>よ</rt></ruby>む</p>',
+    '<p>  <ruby> 空<rt>そら</rt></ruby>だ。 <ruby>海<rt>うみ</rt></ruby> </p>',
+    '<p>A &amp; B &lt;tag&gt; &quot;quoted&quot;。次</p>',
+    '<p><span>外側<b>太字。</b></span>後ろ<br/>改行。<br/></p>',
+    '<p>前<!-- コメント。 -->後</p>',
+    '<p>\u3000</p>',
+    '<p>最後に<ruby>終<rt>お。わ</rt></ruby>り。</p>', # sentence end inside ruby, takes the slow path
+]
+
+for case in SENTENCE_CASES:
+    elem = BeautifulSoup(case, 'html.parser').contents[0]
+    if break_into_sentences(elem) != ref_break_into_sentences(elem):
+        print('FAIL SENTENCES')
+        print(case)
+        print(repr(break_into_sentences(elem)))
+        print(repr(ref_break_into_sentences(elem)))
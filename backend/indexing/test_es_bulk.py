@@ -0,0 +1,128 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import rescore_fragments
+from .es_bulk import BulkSender, BulkError
+
+# A fake Elasticsearch with one index, DOCS (id to source). The first REJECT_COUNT actions for
+# ids in REJECT are rejected with a 429, like an overloaded node does.
+DOCS = {}
+REJECT = set()
+REJECT_COUNT = 2
+rejected = {}
+mapping = {}
+in_flight = 0
+max_in_flight = 0
+lock = threading.Lock()
+
+class FakeESHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        global in_flight, max_in_flight
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        lines = [json.loads(line) for line in body.splitlines()]
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+
+        items = []
+        i = 0
+        while i < len(lines):
+            (action, meta) = next(iter(lines[i].items()))
+            doc = None if action == 'delete' else lines[i + 1]
+            i += 1 if action == 'delete' else 2
+            _id = meta['_id']
+            with lock:
+                if (_id in REJECT) and (rejected.get(_id, 0) < REJECT_COUNT):
+                    rejected[_id] = rejected.get(_id, 0) + 1
+                    items.append({action: {'_id': _id, 'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}})
+                elif action == 'index':
+                    items.append({action: {'_id': _id, 'status': 201, 'result': 'updated' if _id in DOCS else 'created'}})
+                    DOCS[_id] = doc
+                elif action == 'update':
+                    if _id not in DOCS:
+                        items.append({action: {'_id': _id, 'status': 404, 'error': {'type': 'document_missing_exception'}}})
+                    elif any(k not in mapping for k in doc['doc']):
+                        items.append({action: {'_id': _id, 'status': 400, 'error': {'type': 'strict_dynamic_mapping_exception'}}})
+                    elif all(DOCS[_id].get(k) == v for (k, v) in doc['doc'].items()):
+                        items.append({action: {'_id': _id, 'status': 200, 'result': 'noop'}})
+                    else:
+                        DOCS[_id].update(doc['doc'])
+                        items.append({action: {'_id': _id, 'status': 200, 'result': 'updated'}})
+                elif action == 'delete':
+                    items.append({action: {'_id': _id, 'status': 200 if _id in DOCS else 404, 'result': 'deleted' if _id in DOCS else 'not_found'}})
+                    DOCS.pop(_id, None)
+
+        with lock:
+            in_flight -= 1
+        self.send_json({'errors': any('error' in next(iter(item.values())) for item in items), 'items': items})
+
+    def do_PUT(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        mapping.update(body['properties'])
+        self.send_json({'acknowledged': True})
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeESHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+mapping.update({'text': {}, 'mscore': {}})
+
+# indexing, with some actions rejected (and retried) along the way
+REJECT.update(['3', '77'])
+sender = BulkSender('fragment_test', concurrency=3, base_url=base_url, retry_pause=0.01)
+for start in range(0, 200, 10):
+    sender.send([({'index': {'_id': str(i)}}, {'text': f'text {i}', 'mscore': 0.0}) for i in range(start, start + 10)])
+counts = sender.close()
+if (counts != {'created': 200}) or (len(DOCS) != 200) or (rejected != {'3': REJECT_COUNT, '77': REJECT_COUNT}):
+    print('FAIL index with retries', counts, len(DOCS), rejected)
+if max_in_flight > 3:
+    print('FAIL too many requests in flight', max_in_flight)
+REJECT.clear()
+
+# rescoring updates just the score field, and counts fragments that aren't in the index
+scores = [(i, i/10) for i in range(190, 210)]
+counts = rescore_fragments.rescore(BulkSender('fragment_test', 2, ignore_statuses=[404], base_url=base_url), 'mscore', iter(scores), batch_size=7)
+if counts != {'updated': 10, 404: 10}:
+    print('FAIL rescore counts', counts)
+if DOCS['195'] != {'text': 'text 195', 'mscore': 19.5}:
+    print('FAIL rescored doc', DOCS['195'])
+
+# a named score needs to be added to the mapping first, and then sits alongside mscore
+try:
+    rescore_fragments.rescore(BulkSender('fragment_test', 2, ignore_statuses=[404], base_url=base_url), 'mscore_new', iter(scores))
+    print('FAIL update of unmapped field not an error')
+except BulkError:
+    pass
+rescore_fragments.add_score_field('fragment_test', 'mscore_new', base_url)
+counts = rescore_fragments.rescore(BulkSender('fragment_test', 2, ignore_statuses=[404], base_url=base_url), 'mscore_new', iter(scores))
+if (counts != {'updated': 10, 404: 10}) or (DOCS['195'] != {'text': 'text 195', 'mscore': 19.5, 'mscore_new': 19.5}):
+    print('FAIL named score', counts, DOCS['195'])
+
+# deletes
+sender = BulkSender('fragment_test', base_url=base_url)
+sender.send([({'delete': {'_id': '0'}}, None), ({'delete': {'_id': 'nope'}}, None)])
+if (sender.close() != {'deleted': 1, 'not_found': 1}) or ('0' in DOCS):
+    print('FAIL delete')
+
+for bad_field in ['score', 'mscore_', 'mscore_X', 'mscore_a b']:
+    try:
+        rescore_fragments.score_field_name(bad_field)
+        print('FAIL bad score field accepted', bad_field)
+    except ValueError:
+        pass
+
+server.shutdown()
@@ -0,0 +1,67 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import es_indexes
+
+# A fake Elasticsearch that only knows how to create indexes and return their mappings
+INDEXES = {}
+
+class FakeESHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        index = self.path.strip('/')
+        INDEXES[index] = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.send_json(200, {'acknowledged': True})
+
+    def do_GET(self):
+        index = self.path.strip('/').split('/')[0]
+        if index not in INDEXES:
+            self.send_json(404, {'error': 'index_not_found_exception'})
+        else:
+            self.send_json(200, {index: {'mappings': INDEXES[index]['mappings']}})
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# the fragment index is sorted the way search sorts
+fragment_def = es_indexes.load_index_def('fragment')
+if (fragment_def['settings']['index']['sort.field'] != 'mscore') or (fragment_def['settings']['index']['sort.order'] != 'desc'):
+    print('FAIL fragment index not sorted on mscore')
+if fragment_def['mappings']['properties']['mscore'].get('doc_values') is False:
+    print('FAIL mscore needs doc values to sort')
+for kind in es_indexes.KINDS:
+    if not isinstance(es_indexes.index_def_version(kind), int):
+        print('FAIL no version', kind)
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeESHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+if not es_indexes.ensure_index('fragment', 'fragment_test', base_url):
+    print('FAIL new index not reported as created')
+if INDEXES.get('fragment_test') != fragment_def:
+    print('FAIL index not created from definition')
+if es_indexes.get_index_version('fragment_test', base_url) != es_indexes.index_def_version('fragment'):
+    print('FAIL created index version')
+if es_indexes.ensure_index('fragment', 'fragment_test', base_url): # already there, fine
+    print('FAIL existing index reported as created')
+
+# an index made by hand from the old README has no version
+INDEXES['fragment_old'] = {'mappings': {'properties': {}}}
+try:
+    es_indexes.ensure_index('fragment', 'fragment_old', base_url)
+    print('FAIL old index accepted')
+except ValueError:
+    pass
+
+server.shutdown()
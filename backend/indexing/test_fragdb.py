@@ -0,0 +1,188 @@
+import os
+import sqlite3
+import tempfile
+
+from . import fragdb
+from .bench_fragdb_shards import build
+
+def hit_set(dbfn):
+    cxn = sqlite3.connect(dbfn)
+    hits = set(cxn.execute('SELECT f.text, f.count_chars, f.count_mchars, s.s3key, s.title, s.tags, h.loc FROM hit h INNER JOIN fragment f ON f.id = h.fragment_id INNER JOIN source s ON s.id = h.source_id'))
+    cxn.close()
+    return hits
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    single_dbfn = os.path.join(tmpdir, 'single.db')
+    build(single_dbfn, 1, 60, 40, 1)
+    ref_hits = hit_set(single_dbfn)
+
+    for shard_count in [2, 5]:
+        dbfn = os.path.join(tmpdir, f'sharded{shard_count}.db')
+        build(dbfn, shard_count, 60, 40, 2)
+
+        if hit_set(dbfn) != ref_hits:
+            print('FAIL merged hits differ', shard_count)
+
+        cxn = sqlite3.connect(dbfn)
+        id_texts = list(cxn.execute('SELECT id, text FROM fragment ORDER BY id'))
+        texts = [text for (_, text) in id_texts]
+        if (len(texts) != len(set(texts))) or any(fid != fragdb.fragment_id(text) for (fid, text) in id_texts):
+            print('FAIL merged fragments not deduplicated with hash ids', shard_count)
+        indexes = set(row[0] for row in cxn.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+        if not set(fragdb.INDEXES).issubset(indexes):
+            print('FAIL merged db missing indexes', indexes)
+        cxn.close()
+
+        # the merged db works like any other
+        fragdb.open(dbfn)
+        fragdb.insert_source_fragments({'s3key': 'new', 'title': None, 'pubdate': None, 'url': None, 'tags': 'drama,subs'}, [{'text': texts[0], 'count_chars': 1, 'count_mchars': 1, 'loc': 'x'}])
+        if fragdb.cxn.execute('SELECT COUNT(*) FROM fragment').fetchone()[0] != len(texts):
+            print('FAIL insert into merged db duplicated fragment')
+        fragdb.close()
+
+    # bulk loads defer the hit index, and clean up duplicate hits before rebuilding it
+    dbfn = os.path.join(tmpdir, 'bulk.db')
+    fragdb.open(dbfn, profile='bulk_load')
+    fragdb.create_tables()
+    fragdb.begin_bulk_load()
+    if 'hit_unique' in set(row[0] for row in fragdb.cxn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")):
+        print('FAIL hit index not dropped for bulk load')
+    source = {'s3key': 'a', 'title': None, 'pubdate': None, 'url': None, 'tags': 'drama,subs'}
+    located_fragments = [{'text': t, 'count_chars': 1, 'count_mchars': 1, 'loc': 'x'} for t in ['あ', 'い', 'あ']]
+    for _ in range(2):
+        fragdb.insert_source_fragments(source, located_fragments)
+    fragdb.end_bulk_load()
+    if fragdb.cxn.execute('SELECT COUNT(*) FROM hit').fetchone()[0] != 2:
+        print('FAIL duplicate hits after bulk load')
+    if 'hit_unique' not in set(row[0] for row in fragdb.cxn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")):
+        print('FAIL hit index not rebuilt')
+    fragdb.close()
+
+    fragdb.open(dbfn, profile='read')
+    rows = list(fragdb.iter_fragments_plus())
+    if sorted((r['id'], r['text'], len(r['hits'])) for r in rows) != sorted([(fragdb.fragment_id('あ'), 'あ', 1), (fragdb.fragment_id('い'), 'い', 1)]):
+        print('FAIL read after bulk load', rows)
+    fragdb.close()
+
+    # loading into a db that already has sources keeps the indexes, which replacing them needs
+    fragdb.open(dbfn, profile='bulk_load')
+    fragdb.begin_bulk_load()
+    if not set(fragdb.INDEXES).issubset(set(row[0] for row in fragdb.cxn.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))):
+        print('FAIL indexes dropped for bulk load into db with sources')
+    fragdb.end_bulk_load()
+    fragdb.close()
+
+    # a different text with an id that's already taken is an error, not a silent merge
+    fragdb.open(dbfn)
+    fragdb.cxn.execute('INSERT INTO fragment (id, text, count_chars, count_mchars) VALUES (?, ?, 1, 1)', (fragdb.fragment_id('う'), 'え'))
+    fragdb.cxn.commit()
+    try:
+        fragdb.insert_source_fragments(source, [{'text': 'う', 'count_chars': 1, 'count_mchars': 1, 'loc': 'y'}])
+        print('FAIL collision not detected')
+    except fragdb.FragmentIdCollision:
+        fragdb.cxn.rollback()
+    fragdb.close()
+
+    # dbs with the old autoincrement ids can be converted
+    dbfn = os.path.join(tmpdir, 'legacy.db')
+    cxn = sqlite3.connect(dbfn)
+    cxn.executescript('''
+        CREATE TABLE fragment (id INTEGER PRIMARY KEY, text TEXT NOT NULL UNIQUE, count_chars INTEGER NOT NULL, count_mchars INTEGER NOT NULL, logprob REAL, count_toks INTEGER, score_ev_20230516 REAL);
+        CREATE TABLE source (id INTEGER PRIMARY KEY, s3key TEXT NOT NULL UNIQUE, title TEXT, pubdate TEXT, url TEXT, tags TEXT);
+        CREATE TABLE hit (fragment_id INTEGER NOT NULL, source_id INTEGER NOT NULL, loc TEXT NOT NULL, UNIQUE(fragment_id, source_id, loc));
+        CREATE TABLE fragment_score (fragment_id INTEGER NOT NULL, name TEXT NOT NULL, version TEXT NOT NULL, score REAL NOT NULL, PRIMARY KEY (fragment_id, name));
+        INSERT INTO fragment VALUES (1, 'あ', 1, 1, -1.5, 1, 0.5), (2, 'い', 1, 1, NULL, NULL, NULL);
+        INSERT INTO source VALUES (1, 'a', NULL, NULL, NULL, 'drama,subs');
+        INSERT INTO hit VALUES (1, 1, 'x'), (2, 1, 'y');
+        INSERT INTO fragment_score VALUES (2, 'test', '1', 0.25);
+    ''')
+    cxn.close()
+    fragdb.open(dbfn)
+    if not (fragdb.has_legacy_ids('fragment') and fragdb.has_legacy_ids('source')):
+        print('FAIL legacy ids not detected')
+    fragdb.rekey()
+    if fragdb.has_legacy_ids():
+        print('FAIL legacy ids after rekey')
+    indexes = set(row[0] for row in fragdb.cxn.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+    if fragdb.has_inline_constraints() or not set(fragdb.INDEXES).issubset(indexes):
+        print('FAIL hit table not rebuilt by rekey', indexes)
+    if [row[0] for row in fragdb.cxn.execute('SELECT DISTINCT source_id FROM hit')] != [fragdb.source_id('a')]:
+        print('FAIL rekey source ids')
+    rows = sorted((r['id'], r['text'], r['logprob'], r['hits'][0]['loc'], r['score']) for r in fragdb.iter_fragments_plus('test'))
+    if rows != sorted([(fragdb.fragment_id('あ'), 'あ', -1.5, 'x', None), (fragdb.fragment_id('い'), 'い', None, 'y', 0.25)]):
+        print('FAIL rekey', rows)
+    fragdb.create_tables()
+    fragdb.insert_source_fragments(dict(source, s3key='new'), [{'text': 'あ', 'count_chars': 1, 'count_mchars': 1, 'loc': 'z'}])
+    if fragdb.cxn.execute('SELECT COUNT(*) FROM fragment').fetchone()[0] != 2:
+        print('FAIL insert after rekey')
+    fragdb.close()
+
+    # changes are tracked for incremental indexing
+    dbfn = os.path.join(tmpdir, 'changes.db')
+    fragdb.open(dbfn)
+    fragdb.create_tables()
+    def lfs(texts):
+        return [{'text': t, 'count_chars': 1, 'count_mchars': 1, 'loc': str(i)} for (i, t) in enumerate(texts)]
+    def source(s3key):
+        return {'s3key': s3key, 'title': s3key, 'pubdate': None, 'url': None, 'tags': 'drama,subs'}
+    def changed(seq):
+        return (sorted(r['text'] for r in fragdb.iter_fragments_plus(modified_after=seq)), sorted(s['s3key'] for s in fragdb.iter_sources(seq)), sorted(fragdb.iter_deleted_ids('fragment', seq)), sorted(fragdb.iter_deleted_ids('source', seq)))
+
+    fragdb.insert_source_fragments(source('a'), lfs(['あ', 'い']))
+    fragdb.insert_source_fragments(source('b'), lfs(['い', 'う']))
+    if fragdb.get_watermark('test') is not None:
+        print('FAIL watermark before set')
+    fragdb.set_watermark('test', fragdb.get_seq())
+    w = fragdb.get_watermark('test')
+    if changed(w) != ([], [], [], []):
+        print('FAIL changes after watermark', changed(w))
+
+    # reinserting a source as it was changes nothing
+    fragdb.insert_source_fragments(source('a'), lfs(['あ', 'い']))
+    if (changed(w) != ([], [], [], [])) or (fragdb.get_seq() != w):
+        print('FAIL changes after reinserting unchanged source', changed(w))
+
+    # replacing a source's fragments deletes the one only it had, and touches the others it had or has
+    fragdb.cxn.execute("UPDATE fragment SET logprob = -1 WHERE text = 'い'")
+    fragdb.cxn.commit()
+    fragdb.insert_source_fragments(source('a'), lfs(['い', 'え']))
+    if changed(w) != (['い', 'え'], [], [fragdb.fragment_id('あ')], []):
+        print('FAIL changes after replacing source', changed(w))
+    if fragdb.cxn.execute("SELECT logprob FROM fragment WHERE text = 'い'").fetchone()[0] != -1:
+        print('FAIL fragment kept by replaced source lost its data')
+    if sorted(r['hits'][0]['loc'] for r in fragdb.iter_fragments_plus() if r['text'] == 'い') != ['0'] or sum(len(r['hits']) for r in fragdb.iter_fragments_plus()) != 4:
+        print('FAIL hits after replacing source')
+
+    # only the source is touched when only its fields change
+    w = fragdb.get_seq()
+    fragdb.insert_source_fragments(dict(source('a'), title='A'), lfs(['い', 'え']))
+    if changed(w) != ([], ['a'], [], []):
+        print('FAIL changes after retitling source', changed(w))
+
+    w = fragdb.get_seq()
+    fragdb.delete_sources(['b', 'not there'])
+    if changed(w) != (['い'], [], [fragdb.fragment_id('う')], [fragdb.source_id('b')]):
+        print('FAIL changes after deleting source', changed(w))
+
+    # a deleted fragment that comes back isn't reported as deleted
+    w = fragdb.get_seq()
+    fragdb.insert_source_fragments(source('c'), lfs(['う']))
+    if (changed(w)[0] != ['う']) or list(fragdb.iter_deleted_ids('fragment', w - 1)):
+        print('FAIL changes after readding fragment', changed(w), changed(w - 1))
+
+    w = fragdb.get_seq()
+    fragdb.insert_fragment_scores('test', '1', [(fragdb.fragment_id('え'), 0.5)])
+    if changed(w)[0] != ['え']:
+        print('FAIL scoring not tracked', changed(w))
+    def unscored(version):
+        return sorted(f['text'] for f in fragdb.get_unscored_fragments('test', version, -1, 2**63 - 1, 100))
+    if (unscored('1') != ['い', 'う']) or (unscored('2') != ['い', 'う', 'え']):
+        print('FAIL unscored fragments', unscored('1'), unscored('2'))
+    fragdb.close()
+
+# shards are stable and roughly balanced
+counts = [0]*4
+for i in range(4000):
+    counts[fragdb.shard_index(f'ja/syosetu/n{i}/1', 4)] += 1
+if (fragdb.shard_index('ja/syosetu/n1/1', 4) != fragdb.shard_index('ja/syosetu/n1/1', 4)) or (min(counts) < 900):
+    print('FAIL shard_index', counts)
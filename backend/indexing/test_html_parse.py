@@ -0,0 +1,60 @@
+import json
+
+from bs4 import BeautifulSoup
+
+from .fragment_doc import fragment_html_paras, fragment_syosetu
+from .chunk_doc import chunk_html_paras, chunk_syosetu
+
+PARSERS = ['html.parser']
+try:
+    import lxml
+    PARSERS.append('lxml')
+except ImportError:
+    pass
+
+def syosetu_chapter(paras):
+    return '<div id="novel_honbun" class="novel_view">\n' + '\n'.join(f'<p id="L{i+1}">{p}</p>' for (i, p) in enumerate(paras)) + '\n</div>'
+
+DOCS = [
+    '<div><p>食べる</p></div>',
+    '<div><p id="L123">食べる</p></div>',
+    '<div><p>そのせいだろうか。あの日に見た空の青を、よく覚えている。</p></div>',
+    '<div><p>「……血……血が……………」</p></div>',
+    '<div><p>【ポルペオ】「なんだ、その目は？</p></div>',
+    '\n<div><p>（平次）おい　大変だ。</p>\n</div>\n',
+    syosetu_chapter([
+        '　その日、<ruby><rb>王都</rb><rp>(</rp><rt>おうと</rt><rp>)</rp></ruby>は雨だった。',
+        '<br/>',
+        '「待って！　……待ってってば！」',
+        '',
+        '～～～～',
+        '　A &amp; B &lt;tag&gt; と書かれた<span>看板</span>を見上げる。',
+        '<ruby>騎士団<rt>きしだん</rt></ruby>による警備を撤去せよ。' * 12, # long enough to be split
+        '　　――ああ、そうだったのですか。',
+    ]),
+    syosetu_chapter(['「' + 'あ'*20 + '」と彼は言った。' for _ in range(200)]),
+]
+
+# The original approach: build the whole tree with html.parser, and use the root's direct <p> children
+def ref_p_children(text):
+    soup = BeautifulSoup(text.strip(), 'html.parser')
+    return [child for child in soup.contents[0].children if child.name == 'p']
+
+for doc in DOCS:
+    ref_frags = json.dumps(fragment_html_paras(ref_p_children(doc), None), sort_keys=True, ensure_ascii=False)
+    ref_chunks = json.dumps(chunk_html_paras(ref_p_children(doc)), sort_keys=True, ensure_ascii=False)
+
+    for parser in PARSERS:
+        frags = json.dumps(fragment_syosetu(doc, None, parser), sort_keys=True, ensure_ascii=False)
+        if frags != ref_frags:
+            print('FAIL FRAGMENTS', parser)
+            print(doc)
+            print(ref_frags)
+            print(frags)
+
+        chunks = json.dumps(chunk_syosetu(doc.strip(), parser), sort_keys=True, ensure_ascii=False)
+        if chunks != ref_chunks:
+            print('FAIL CHUNKS', parser)
+            print(doc)
+            print(ref_chunks)
+            print(chunks)
@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import fragdb
+
+# A fake Elasticsearch for index_fragments.py, run against it as a script: it creates indexes, and
+# takes bulk index, delete, and the scripted updates index_fragments.py sends for existing docs.
+# INDEXES is index name to {'mappings', 'docs' (id to source)}, ACTIONS the bulk actions sent.
+INDEXES = {}
+ACTIONS = []
+lock = threading.Lock()
+
+class FakeESHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        index = self.path.strip('/')
+        with lock:
+            INDEXES[index] = {'mappings': json.loads(self.read_body())['mappings'], 'docs': {}}
+        self.send_json(200, {'acknowledged': True})
+
+    def do_GET(self):
+        index = self.path.strip('/').split('/')[0]
+        if index not in INDEXES:
+            self.send_json(404, {'error': 'index_not_found_exception'})
+        else:
+            self.send_json(200, {index: {'mappings': INDEXES[index]['mappings']}})
+
+    def do_POST(self):
+        (index, endpoint) = self.path.strip('/').split('/')
+        lines = [json.loads(line) for line in self.read_body().splitlines()]
+        if endpoint == '_refresh':
+            self.send_json(200, {})
+            return
+        items = []
+        with lock:
+            docs = INDEXES[index]['docs']
+            i = 0
+            while i < len(lines):
+                (action, meta) = next(iter(lines[i].items()))
+                _id = meta['_id']
+                ACTIONS.append((index, action, _id))
+                if action == 'delete':
+                    items.append({action: {'_id': _id, 'status': 200 if _id in docs else 404, 'result': 'deleted' if _id in docs else 'not_found'}})
+                    docs.pop(_id, None)
+                    i += 1
+                    continue
+                body = lines[i + 1]
+                i += 2
+                if action == 'index':
+                    items.append({action: {'_id': _id, 'status': 201, 'result': 'updated' if _id in docs else 'created'}})
+                    docs[_id] = body
+                else:
+                    assert (action == 'update') and (body['script']['source'] == 'ctx._source.putAll(params.doc)') and body['scripted_upsert']
+                    items.append({action: {'_id': _id, 'status': 200, 'result': 'updated' if _id in docs else 'created'}})
+                    docs.setdefault(_id, dict(body['upsert'])).update(body['script']['params']['doc'])
+        self.send_json(200, {'errors': False, 'items': items})
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+
+    def send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeESHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+env = dict(os.environ, MASSIF_ES_URL=f'http://127.0.0.1:{server.server_address[1]}')
+
+def index_fragments(dbfn, *args):
+    subprocess.run([sys.executable, '-m', 'backend.indexing.index_fragments', '--index-suffix', 'test', '--score-name', 'test', *args, dbfn], env=env, check=True, stdout=subprocess.DEVNULL)
+    actions = [(action, _id) for (index, action, _id) in ACTIONS if index == 'fragment_test']
+    ACTIONS.clear()
+    return actions
+
+def fragment_docs():
+    return INDEXES['fragment_test']['docs']
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    dbfn = os.path.join(tmpdir, 'frags.db')
+    texts = ['猫が好きだ。', '犬が好きだ。']
+    ids = [str(fragdb.fragment_id(text)) for text in texts]
+    fragdb.open(dbfn)
+    fragdb.create_tables()
+    fragdb.insert_source_fragments({'s3key': 'a', 'title': 'A', 'pubdate': None, 'url': None, 'tags': 'drama'}, [{'text': text, 'count_chars': len(text), 'count_mchars': len(text), 'loc': str(i)} for (i, text) in enumerate(texts)])
+    fragdb.insert_fragment_scores('test', '1', [(int(_id), 1.0) for _id in ids])
+    fragdb.close()
+
+    # into a new index, docs are indexed whole
+    actions = index_fragments(dbfn)
+    if sorted(actions) != sorted(('index', _id) for _id in ids):
+        print('FAIL first run actions', actions)
+    if sorted(doc['text'] for doc in fragment_docs().values()) != sorted(texts):
+        print('FAIL first run docs', fragment_docs())
+
+    # a full reindex into an existing index keeps an alternate score added by rescore_fragments.py
+    fragment_docs()[ids[0]]['mscore_alt'] = 5.0
+    fragdb.open(dbfn)
+    fragdb.insert_fragment_scores('test', '2', [(int(ids[0]), 2.0)])
+    fragdb.close()
+    actions = index_fragments(dbfn)
+    if sorted(actions) != sorted(('update', _id) for _id in ids):
+        print('FAIL full reindex actions', actions)
+    doc = fragment_docs()[ids[0]]
+    if (doc['mscore'] != 2.0) or (doc.get('mscore_alt') != 5.0) or (doc['text'] != texts[0]):
+        print('FAIL full reindex doc', doc)
+
+    # so does an incremental one, which deletes the doc of a fragment that lost its score
+    fragdb.open(dbfn)
+    fragdb.cxn.execute('DELETE FROM fragment_score WHERE fragment_id = ?', (int(ids[1]), ))
+    fragdb.cxn.commit()
+    fragdb.insert_fragment_scores('test', '3', [(int(ids[0]), 3.0)])
+    fragdb.cxn.execute('UPDATE fragment SET modified = ? WHERE id = ?', (fragdb.get_seq(), int(ids[1])))
+    fragdb.cxn.commit()
+    fragdb.close()
+    actions = index_fragments(dbfn, '--incremental')
+    if sorted(actions) != sorted([('update', ids[0]), ('delete', ids[1])]):
+        print('FAIL incremental actions', actions)
+    doc = fragment_docs()[ids[0]]
+    if (list(fragment_docs()) != [ids[0]]) or (doc['mscore'] != 3.0) or (doc.get('mscore_alt') != 5.0):
+        print('FAIL incremental docs', fragment_docs())
+
+server.shutdown()
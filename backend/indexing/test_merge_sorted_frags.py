@@ -0,0 +1,96 @@
+import io
+import os
+import random
+import sqlite3
+import tempfile
+
+from . import fragdb
+from .merge_sorted_frags import MAX_REFS, iter_file_refs, merge_refs, write_tsv, write_bin, iter_bin, write_fragdb
+
+def ref_line(text, i):
+    # tags go with the source, and loc is unique (or empty)
+    return '\t'.join([text, f'src{i % 37}', str(i) if (i % 3) else '', 'drama,subs' if ((i % 37) % 2) else 'novel,url'])
+
+# some rare texts and some very common ones, spread across shards
+rng = random.Random(1)
+lines = []
+for i in range(3000):
+    text = rng.choice(['はい。', 'うん。', 'えっ？']) if (i % 4) else f'文{rng.randrange(500)}です。'
+    lines.append(ref_line(text, i))
+
+def shard(lines, n):
+    shards = [[] for _ in range(n)]
+    for (i, line) in enumerate(lines):
+        shards[i % n].append(line)
+    return [sorted(s) for s in shards]
+
+def merge_lines(shards, **kwargs):
+    return list(merge_refs([iter_file_refs(io.StringIO('\n'.join(s) + '\n'), str(i)) for (i, s) in enumerate(shards)], **kwargs))
+
+all_refs = {}
+for line in lines:
+    (text, src, loc, tags) = line.split('\t')
+    all_refs.setdefault(text, []).append((src, loc, tags))
+
+merged = merge_lines(shard(lines, 4))
+texts = [text for (text, _) in merged]
+if texts != sorted(all_refs):
+    print('FAIL merged texts')
+for (text, refs) in merged:
+    ref_tuples = [(r['src'], r.get('loc', ''), r['tags']) for r in refs]
+    if len(refs) != min(MAX_REFS, len(all_refs[text])):
+        print('FAIL ref count', text, len(refs))
+    if any(ref_tuples.count(r) > all_refs[text].count(r) for r in ref_tuples):
+        print('FAIL refs not from input', text)
+    if (len(all_refs[text]) <= MAX_REFS) and (sorted(ref_tuples) != sorted(all_refs[text])):
+        print('FAIL lost refs', text)
+
+# reproducible
+if merge_lines(shard(lines, 4)) != merged:
+    print('FAIL not reproducible')
+if merge_lines(shard(lines, 4), seed='other') == merged:
+    print('FAIL seed ignored')
+
+# sampling is roughly uniform: each of 100 refs kept about max_refs/100 of the time
+counts = {}
+for trial in range(400):
+    many = sorted(ref_line('はい。', i) for i in range(100))
+    for (_, refs) in merge_lines([many], seed=str(trial), max_refs=10):
+        for r in refs:
+            key = (r['src'], r.get('loc'))
+            counts[key] = counts.get(key, 0) + 1
+if (len(counts) != 100) or (min(counts.values()) < 15) or (max(counts.values()) > 70):
+    print('FAIL sampling not uniform', min(counts.values()), max(counts.values()))
+
+try:
+    merge_lines([['b\tsrc\t1\ta,b', 'a\tsrc\t1\ta,b']])
+    print('FAIL unsorted input accepted')
+except ValueError:
+    pass
+
+# binary and tsv round trip
+f = io.BytesIO()
+write_bin(iter(merged), f)
+if list(iter_bin(io.BytesIO(f.getvalue()))) != merged:
+    print('FAIL binary round trip')
+f = io.StringIO()
+write_tsv(iter(merged), f)
+if len(f.getvalue().splitlines()) != len(merged):
+    print('FAIL tsv lines')
+
+# fragdb output
+with tempfile.TemporaryDirectory() as tmpdir:
+    dbfn = os.path.join(tmpdir, 'frags.db')
+    fragdb.open(dbfn)
+    fragdb.create_tables()
+    write_fragdb(iter(merged))
+    fragdb.close()
+
+    cxn = sqlite3.connect(dbfn)
+    if cxn.execute('SELECT COUNT(*) FROM fragment').fetchone()[0] != len(merged):
+        print('FAIL fragdb fragment count')
+    if cxn.execute('SELECT COUNT(*) FROM hit').fetchone()[0] != sum(len(set((r['src'], r.get('loc', '')) for r in refs)) for (_, refs) in merged):
+        print('FAIL fragdb hit count')
+    if cxn.execute("SELECT tags FROM source WHERE s3key = 'src1'").fetchone()[0] != 'drama,subs':
+        print('FAIL fragdb source')
+    cxn.close()
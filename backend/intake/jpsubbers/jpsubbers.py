@@ -3,12 +3,16 @@ import os
 import glob
 import json
 import re
+import hashlib
 import argparse
+import threading
+import tempfile
 from datetime import datetime
 from zipfile import ZipFile
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-import boto3
+from ..upload_target import make_upload_target
 
 SP_DATE_RE = re.compile(r'\(([0-9]{4})\.([0-9]{2})\.([0-9]{2})\)')
 
@@ -23,14 +27,15 @@ BAD_KEYS = set([
     'ja/jpsubbers/Japanese-Subtitles/@Reairs/@2010-2012/恋を何年休んでますか.zip/恋を何年休んでますか＃01.srt',
 ])
 
-def process_sub(key, subfn, data, published, verbose, bucket):
+# returns the doc for this subtitle file, or None if it should be skipped
+def make_doc(key, subfn, data, published, verbose):
     if verbose:
         print(key)
 
     if key in BAD_KEYS:
         if verbose:
             print('SKIPPING BAD FILE')
-        return 0
+        return None
 
     (subfn_base, subfn_ext) = os.path.splitext(subfn)
     assert subfn_ext.lower() == '.srt'
@@ -57,28 +62,32 @@ def process_sub(key, subfn, data, published, verbose, bucket):
     if not doc_text:
         if verbose:
             print('SKIPPING EMPTY FILE')
-        return 0
+        return None
 
     # sanity check that this looks like the start of an SRT file
     assert doc_text.startswith('1\r\n'), repr(doc_text[:16])
 
     doc['text'] = doc_text
 
-    doc_json = json.dumps(doc, indent=2, ensure_ascii=False)
     if verbose:
-        print(doc_json)
+        print(json.dumps(doc, indent=2, ensure_ascii=False))
 
-    if bucket:
-        bucket.put_object(
-            Key=key,
-            ContentType='application/json',
-            Body=doc_json.encode('utf-8')
-        )
+    return doc
 
-    return 1
+# hash of everything but the created time, so it only changes if the document really does
+def doc_content_hash(doc):
+    content = {k: v for (k, v) in doc.items() if k != 'created'}
+    return hashlib.sha256(json.dumps(content, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
 
-def process_zip(fn, rel_fn, published, verbose, bucket):
-    count = 0
+# returns (key, encoded doc, content hash) or None
+def process_sub(key, subfn, data, published, verbose):
+    doc = make_doc(key, subfn, data, published, verbose)
+    if doc is None:
+        return None
+    return (key, json.dumps(doc, indent=2, ensure_ascii=False).encode('utf-8'), doc_content_hash(doc))
+
+def process_zip(fn, rel_fn, published, verbose):
+    results = []
     with ZipFile(fn, 'r') as zipf:
         for subfn in sorted(zipf.namelist()):
             key = 'ja/jpsubbers/' + rel_fn + '/' + subfn
@@ -86,28 +95,14 @@ def process_zip(fn, rel_fn, published, verbose, bucket):
             with zipf.open(subfn) as subf:
                 data = subf.read()
 
-            count += process_sub(key, subfn, data, published, verbose, bucket)
-    return count
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('crawldir')
-    parser.add_argument('-v', '--verbose', action='store_true')
-    parser.add_argument('-n', '--dry-run', action='store_true', help="don't upload to S3")
-    args = parser.parse_args()
-
-    root_dir = args.crawldir
-    assert os.path.exists(root_dir), "crawl directory doesn't exist"
-
-    assert os.path.exists(os.path.join(root_dir, 'Japanese-Subtitles')), 'wrong directory?'
-
-    docs_bucket = None
-    if not args.dry_run:
-        s3 = boto3.resource('s3')
-        docs_bucket = s3.Bucket(os.getenv('MASSIF_DOCS_BUCKET'))
+            result = process_sub(key, subfn, data, published, verbose)
+            if result is not None:
+                results.append(result)
+    return results
 
+# yields (category, fn, rel_fn, published) for every zip or srt file to process
+def iter_tasks(root_dir):
     # Mains
-    processed_mains = 0
     for fn in glob.iglob(os.path.join(root_dir, 'Japanese-Subtitles/@Mains/@20*/*/*.zip')):
         (season_dir, zip_fn) = os.path.split(fn)
         (year_dir, season_fn) = os.path.split(season_dir)
@@ -116,35 +111,160 @@ if __name__ == '__main__':
         year_int = int(year_str)
         assert (year_int >= 2000) and (year_int < 2100)
 
-        rel_fn = os.path.relpath(fn, root_dir)
-
-        processed_mains += process_zip(fn, rel_fn, published=year_str, verbose=args.verbose, bucket=docs_bucket)
+        yield ('mains', fn, os.path.relpath(fn, root_dir), year_str)
 
     # Reairs
     # recursive because there is some non-uniform directory structure
-    processed_reairs = 0
     for fn in glob.iglob(os.path.join(root_dir, 'Japanese-Subtitles/@Reairs/**/*.zip'), recursive=True):
-        rel_fn = os.path.relpath(fn, root_dir)
-
-        processed_reairs += process_zip(fn, rel_fn, published=None, verbose=args.verbose, bucket=docs_bucket) # can't determine year it originally aired
+        yield ('reairs', fn, os.path.relpath(fn, root_dir), None) # can't determine year it originally aired
 
     # Specials
-    processed_specials = 0
     for fn in glob.iglob(os.path.join(root_dir, 'Japanese-Subtitles/@OtherSPs/@20*/*.srt')):
-        rel_fn = os.path.relpath(fn, root_dir)
-        key = 'ja/jpsubbers/' + rel_fn
-
         (_, subfn) = os.path.split(fn)
 
         date_match = SP_DATE_RE.match(subfn)
         published = '-'.join(date_match.groups())
 
+        yield ('specials', fn, os.path.relpath(fn, root_dir), published)
+
+# reads and decodes the docs for one task, returning (category, list of process_sub results)
+def run_task(task, verbose):
+    (category, fn, rel_fn, published) = task
+    if fn.endswith('.zip'):
+        return (category, process_zip(fn, rel_fn, published, verbose))
+    else:
         with open(fn, 'rb') as f:
             data = f.read()
+        result = process_sub('ja/jpsubbers/' + rel_fn, os.path.basename(fn), data, published, verbose)
+        return (category, [result] if result is not None else [])
+
+def run_task_star(args):
+    return run_task(*args)
+
+# Yields the results of tasks in order, run in process_pool (or in this process if None). At most
+# max_outstanding tasks are submitted ahead of the result being yielded, so decoded docs don't pile
+# up in memory when uploads are slower than decoding.
+def iter_task_results(process_pool, tasks, max_outstanding):
+    if process_pool is None:
+        yield from map(run_task_star, tasks)
+        return
+    futures = deque()
+    for task in tasks:
+        futures.append(process_pool.submit(run_task_star, task))
+        if len(futures) >= max_outstanding:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+# Keys we've already uploaded, with the content hash of what we uploaded, so that re-runs only
+# upload documents that are new or changed. Saved as JSON, periodically and when closed.
+class Manifest:
+    SAVE_COUNT = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.unsaved = 0
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.hashes = json.load(f)
+        else:
+            self.hashes = {}
+
+    def unchanged(self, key, content_hash):
+        with self.lock:
+            return self.hashes.get(key) == content_hash
+
+    def record(self, key, content_hash):
+        with self.lock:
+            self.hashes[key] = content_hash
+            self.unsaved += 1
+            if self.unsaved >= self.SAVE_COUNT:
+                self._save_locked()
+
+    def _save_locked(self):
+        (fd, tmp_fn) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self.hashes, f, ensure_ascii=False, indent=0, sort_keys=True)
+        os.replace(tmp_fn, self.path)
+        self.unsaved = 0
+
+    def close(self):
+        with self.lock:
+            self._save_locked()
+
+# Zips are read and decoded by a pool of worker processes, and documents are uploaded by a pool of threads.
+# Returns a dict of the number of docs in each category, plus how many were uploaded and unchanged.
+def ingest(root_dir, target, manifest=None, workers=1, upload_threads=8, verbose=False):
+    counts = {'mains': 0, 'reairs': 0, 'specials': 0, 'uploaded': 0, 'unchanged': 0}
+    tasks = ((task, verbose) for task in iter_tasks(root_dir))
+
+    def upload(key, body, content_hash):
+        target.put(key, body)
+        if manifest:
+            manifest.record(key, content_hash)
+
+    pending = set()
+    def wait_pending(max_pending):
+        nonlocal pending
+        while len(pending) > max_pending:
+            (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result() # raises if upload failed
+
+    process_pool = ProcessPoolExecutor(workers) if (workers > 1) else None
+    try:
+        with ThreadPoolExecutor(upload_threads) as upload_pool:
+            for (category, results) in iter_task_results(process_pool, tasks, 2*workers):
+                counts[category] += len(results)
+                for (key, body, content_hash) in results:
+                    if target is None:
+                        continue
+                    if manifest and manifest.unchanged(key, content_hash):
+                        counts['unchanged'] += 1
+                        continue
+                    pending.add(upload_pool.submit(upload, key, body, content_hash))
+                    counts['uploaded'] += 1
+                    wait_pending(4*upload_threads) # don't let docs pile up in memory if uploads are slow
+            wait_pending(0)
+    finally:
+        if process_pool:
+            process_pool.shutdown(cancel_futures=True)
+
+    return counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('crawldir')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-n', '--dry-run', action='store_true', help="don't upload to S3")
+    parser.add_argument('--target', help='s3://bucket or local directory to upload to (default is MASSIF_DOCS_BUCKET)')
+    parser.add_argument('--manifest', help='JSON file of uploaded keys and content hashes, so re-runs only upload what changed')
+    parser.add_argument('--workers', type=int, default=1, help='processes for reading zips')
+    parser.add_argument('--upload-threads', type=int, default=8)
+    args = parser.parse_args()
+
+    root_dir = args.crawldir
+    assert os.path.exists(root_dir), "crawl directory doesn't exist"
 
-        processed_specials += process_sub(key, subfn, data, published, verbose=args.verbose, bucket=docs_bucket)
+    assert os.path.exists(os.path.join(root_dir, 'Japanese-Subtitles')), 'wrong directory?'
 
-    eprint(f'{processed_mains} mains')
-    eprint(f'{processed_reairs} reairs')
-    eprint(f'{processed_specials} specials')
-    eprint(f'{processed_mains + processed_reairs + processed_specials} total')
+    target = None
+    manifest = None
+    if not args.dry_run:
+        target = make_upload_target(args.target)
+        if args.manifest:
+            manifest = Manifest(args.manifest)
+
+    try:
+        counts = ingest(root_dir, target, manifest, args.workers, args.upload_threads, args.verbose)
+    finally:
+        if manifest:
+            manifest.close()
+
+    eprint(f'{counts["mains"]} mains')
+    eprint(f'{counts["reairs"]} reairs')
+    eprint(f'{counts["specials"]} specials')
+    eprint(f'{counts["mains"] + counts["reairs"] + counts["specials"]} total')
+    if target:
+        eprint(f'{counts["uploaded"]} uploaded, {counts["unchanged"]} unchanged since last upload')
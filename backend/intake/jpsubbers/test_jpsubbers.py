@@ -0,0 +1,98 @@
+import os
+import json
+import tempfile
+import multiprocessing
+from zipfile import ZipFile
+
+from .jpsubbers import ingest, Manifest
+from ..upload_target import LocalDirTarget
+
+def srt(line):
+    return f'1\r\n00:00:01,000 --> 00:00:02,000\r\n{line}\r\n'.encode('utf-8')
+
+def write_zip(fn, members):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with ZipFile(fn, 'w') as zipf:
+        for (name, data) in members.items():
+            zipf.writestr(name, data)
+
+def write_file(fn, data):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, 'wb') as f:
+        f.write(data)
+
+def make_crawl(root):
+    subs = os.path.join(root, 'Japanese-Subtitles')
+    write_zip(os.path.join(subs, '@Mains/@2014/@2014_04-06_Spring_Season/ドラマ.zip'), {
+        'ドラマ＃01.srt': srt('こんにちは'),
+        'ドラマ＃02.srt': b'\xff\xfe' + '1\r\n00:00:01,000 --> 00:00:02,000\r\nさようなら\r\n'.encode('utf-16-le'),
+        'ドラマ＃03.srt': b'', # skipped as empty
+    })
+    write_zip(os.path.join(subs, '@Mains/@2015/@2015_01-03_Winter_Season/別のドラマ.zip'), {
+        '別のドラマ_01.srt': srt('はい'),
+    })
+    write_zip(os.path.join(subs, '@Reairs/@2010-2012/恋を何年休んでますか.zip'), {
+        '恋を何年休んでますか＃01.srt': srt('bad'), # in BAD_KEYS
+        '恋を何年休んでますか＃02.srt': srt('いいえ'),
+    })
+    write_zip(os.path.join(subs, '@Reairs/deeper/dir/再放送.zip'), {
+        '再放送.srt': srt('もう一度'),
+    })
+    write_file(os.path.join(subs, '@OtherSPs/@2016/(2016.01.02)スペシャル.srt'), srt('特別'))
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    crawl_dir = os.path.join(tmpdir, 'crawl')
+    make_crawl(crawl_dir)
+
+    # a sequential dry run gives the reference counts
+    ref_counts = ingest(crawl_dir, None)
+    if ref_counts != {'mains': 3, 'reairs': 2, 'specials': 1, 'uploaded': 0, 'unchanged': 0}:
+        print('FAIL dry run counts', ref_counts)
+
+    for workers in [1, 3]:
+        out_dir = os.path.join(tmpdir, f'out{workers}')
+        manifest_fn = os.path.join(tmpdir, f'manifest{workers}.json')
+
+        manifest = Manifest(manifest_fn)
+        counts = ingest(crawl_dir, LocalDirTarget(out_dir), manifest, workers=workers, upload_threads=4)
+        manifest.close()
+        if counts != {**ref_counts, 'uploaded': 6}:
+            print('FAIL counts', workers, counts)
+
+        key = 'ja/jpsubbers/Japanese-Subtitles/@Mains/@2014/@2014_04-06_Spring_Season/ドラマ.zip/ドラマ＃02.srt'
+        with open(os.path.join(out_dir, key), encoding='utf-8') as f:
+            doc = json.load(f)
+        if (doc['title'] != 'ドラマ＃02') or (doc['published'] != '2014') or ('さようなら' not in doc['text']):
+            print('FAIL doc', doc)
+        with open(os.path.join(out_dir, 'ja/jpsubbers/Japanese-Subtitles/@OtherSPs/@2016/(2016.01.02)スペシャル.srt'), encoding='utf-8') as f:
+            doc = json.load(f)
+        if doc['published'] != '2016-01-02':
+            print('FAIL special doc', doc)
+
+        # nothing changed, so nothing is uploaded again (even though created times differ)
+        manifest = Manifest(manifest_fn)
+        counts = ingest(crawl_dir, LocalDirTarget(out_dir), manifest, workers=workers)
+        manifest.close()
+        if counts != {**ref_counts, 'unchanged': 6}:
+            print('FAIL rerun counts', workers, counts)
+
+        # change one file, and only it is uploaded
+        write_file(os.path.join(crawl_dir, 'Japanese-Subtitles/@OtherSPs/@2016/(2016.01.02)スペシャル.srt'), srt('変更'))
+        manifest = Manifest(manifest_fn)
+        counts = ingest(crawl_dir, LocalDirTarget(out_dir), manifest, workers=workers)
+        manifest.close()
+        if counts != {**ref_counts, 'uploaded': 1, 'unchanged': 5}:
+            print('FAIL changed counts', workers, counts)
+        write_file(os.path.join(crawl_dir, 'Japanese-Subtitles/@OtherSPs/@2016/(2016.01.02)スペシャル.srt'), srt('特別'))
+
+    # a failed upload is raised, rather than left behind with the workers still running
+    class FailingTarget:
+        def put(self, key, body):
+            raise IOError('upload failed')
+    try:
+        ingest(crawl_dir, FailingTarget(), workers=3)
+        print('FAIL upload error not raised')
+    except IOError:
+        pass
+    if multiprocessing.active_children():
+        print('FAIL workers left running after upload error')
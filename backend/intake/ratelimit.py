@@ -0,0 +1,29 @@
+import time
+import asyncio
+
+# Token bucket shared by any number of concurrent fetches: on average at most rate acquisitions
+# per second, with bursts of up to burst. This is how crawlers keep to their politeness budget
+# no matter how many requests they have in flight.
+class AsyncTokenBucket:
+    def __init__(self, rate, burst=1):
+        assert rate > 0
+        assert burst >= 1
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last)*self.rate)
+        self.last = now
+
+    async def acquire(self):
+        # holding the lock while we sleep makes waiters take turns in order
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens)/self.rate)
+                self._refill()
+            self.tokens -= 1
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import argparse
+import asyncio
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlite3
+import requests
+
+from .syosetu_novels import HEADERS, WAIT_TIME, RETRY_TIME, TRY_COUNT, SYOSETU_BASE_URL, parse_novel_index, chapter_s3key, make_chapter_doc
+from ..ratelimit import AsyncTokenBucket
+from ..upload_target import make_upload_target
+
+# A resumable version of syosetu_novels.py. The frontier of novels and chapters to fetch is kept in
+# SQLite, so an interrupted crawl picks up where it left off, and a refresh only re-uploads chapters
+# that the server says have changed (using ETag/Last-Modified conditional requests).
+#
+# Novel status is one of: pending, indexed, noindex, stale (to be re-indexed), failed. has_index is
+# whether the last index page we got had a chapter index (so what a stale novel goes back to if the
+# page hasn't changed), or NULL if we haven't got one yet.
+# Chapter status is one of: pending, done, stale (done, but to be revalidated), failed. Chapters that
+# drop out of their novel's index are deleted.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS novel (
+  code TEXT PRIMARY KEY NOT NULL,
+  status TEXT NOT NULL,
+  etag TEXT,
+  last_modified TEXT,
+  has_index INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS chapter (
+  code TEXT NOT NULL,
+  chapter TEXT NOT NULL,
+  href TEXT NOT NULL,
+  published TEXT NOT NULL,
+  status TEXT NOT NULL,
+  etag TEXT,
+  last_modified TEXT,
+  PRIMARY KEY (code, chapter)
+);
+'''
+
+CRAWL_CONCURRENCY = 4
+CRAWL_RATE = 1/WAIT_TIME # same politeness budget as syosetu_novels.py
+FETCH_TIMEOUT = 60
+
+TODO_STATUSES = ('pending', 'stale', 'failed')
+
+cxn = None
+
+def db_open(dbfn):
+    global cxn
+    cxn = sqlite3.connect(dbfn)
+    cxn.executescript(SCHEMA)
+    if 'has_index' not in [row[1] for row in cxn.execute('PRAGMA table_info(novel)')]:
+        # frontier dbs from before has_index. Only novels whose index was found have chapters
+        cxn.execute('ALTER TABLE novel ADD COLUMN has_index INTEGER')
+        cxn.execute("UPDATE novel SET has_index = EXISTS (SELECT 1 FROM chapter c WHERE c.code = novel.code) WHERE status != 'pending'")
+        cxn.commit()
+
+def db_close():
+    global cxn
+    if cxn:
+        cxn.close()
+    cxn = None
+
+def add_codes(codes):
+    cur = cxn.cursor()
+    cur.execute('BEGIN')
+    cur.executemany("INSERT INTO novel (code, status) VALUES (?, 'pending') ON CONFLICT (code) DO NOTHING", ((code, ) for code in codes))
+    cur.execute('COMMIT')
+
+# mark everything done as needing revalidation
+def mark_stale():
+    cur = cxn.cursor()
+    cur.execute('BEGIN')
+    cur.execute("UPDATE novel SET status = 'stale' WHERE status IN ('indexed', 'noindex')")
+    cur.execute("UPDATE chapter SET status = 'stale' WHERE status = 'done'")
+    cur.execute('COMMIT')
+
+def get_todo_novels():
+    return [{'code': row[0], 'etag': row[1], 'last_modified': row[2], 'has_index': row[3]} for row in cxn.execute(f"SELECT code, etag, last_modified, has_index FROM novel WHERE status IN {TODO_STATUSES!r}")]
+
+# chapters to fetch. if code is None, only chapters of novels that don't need (re)indexing first
+def get_todo_chapters(code=None):
+    if code is None:
+        rows = cxn.execute(f"SELECT c.code, c.chapter, c.href, c.published, c.etag, c.last_modified FROM chapter c INNER JOIN novel n ON n.code = c.code WHERE n.status = 'indexed' AND c.status IN {TODO_STATUSES!r}")
+    else:
+        rows = cxn.execute(f"SELECT code, chapter, href, published, etag, last_modified FROM chapter WHERE code = ? AND status IN {TODO_STATUSES!r}", (code, ))
+    return [{'code': row[0], 'chapter': row[1], 'href': row[2], 'published': row[3], 'etag': row[4], 'last_modified': row[5]} for row in rows]
+
+# chapters is the novel's new index, if it was fetched (None if it hasn't changed or there isn't one)
+def update_novel(code, status, etag=None, last_modified=None, chapters=None):
+    cur = cxn.cursor()
+    cur.execute('BEGIN')
+    if status == 'failed':
+        # keep validators, since we still have the chapters from the last good index
+        cur.execute('UPDATE novel SET status = ? WHERE code = ?', (status, code))
+    else:
+        cur.execute('UPDATE novel SET status = ?, etag = ?, last_modified = ?, has_index = ? WHERE code = ?', (status, etag, last_modified, status == 'indexed', code))
+    if chapters is not None:
+        cur.executemany("INSERT INTO chapter (code, chapter, href, published, status) VALUES (?, ?, ?, ?, 'pending') ON CONFLICT (code, chapter) DO UPDATE SET href = excluded.href, published = excluded.published", ((code, chapter_id, href, published) for (chapter_id, href, published) in chapters))
+        cur.execute('DELETE FROM chapter WHERE code = ? AND chapter NOT IN (SELECT value FROM json_each(?))', (code, json.dumps([chapter_id for (chapter_id, _, _) in chapters])))
+    elif status == 'noindex':
+        cur.execute('DELETE FROM chapter WHERE code = ?', (code, ))
+    cur.execute('COMMIT')
+
+def update_chapter(code, chapter, status, etag=None, last_modified=None):
+    cur = cxn.cursor()
+    cur.execute('BEGIN')
+    if status == 'failed':
+        cur.execute('UPDATE chapter SET status = ? WHERE code = ? AND chapter = ?', (status, code, chapter))
+    else:
+        cur.execute('UPDATE chapter SET status = ?, etag = ?, last_modified = ? WHERE code = ? AND chapter = ?', (status, etag, last_modified, code, chapter))
+    cur.execute('COMMIT')
+
+class SyosetuCrawler:
+    def __init__(self, target, base_url=SYOSETU_BASE_URL):
+        self.target = target
+        self.base_url = base_url
+        self.thread_local = threading.local()
+
+    # returns the response, or None if the server says it hasn't changed. runs in a worker thread
+    def conditional_get(self, url, etag, last_modified):
+        session = getattr(self.thread_local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(HEADERS)
+            self.thread_local.session = session
+
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        resp = session.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+        if resp.status_code == 304:
+            return None
+        resp.raise_for_status()
+        return resp
+
+    # returns (status, etag, last_modified, chapters or None)
+    def fetch_novel(self, novel):
+        resp = self.conditional_get(f'{self.base_url}/{novel["code"]}/', novel['etag'], novel['last_modified'])
+        if resp is None:
+            return ('indexed' if novel['has_index'] else 'noindex', novel['etag'], novel['last_modified'], None)
+        chapters = parse_novel_index(novel['code'], resp.content)
+        if chapters is None:
+            return ('noindex', resp.headers.get('ETag'), resp.headers.get('Last-Modified'), None)
+        return ('indexed', resp.headers.get('ETag'), resp.headers.get('Last-Modified'), chapters)
+
+    # returns (etag, last_modified, uploaded)
+    def fetch_chapter(self, chapter):
+        chapter_url = self.base_url + chapter['href']
+        resp = self.conditional_get(chapter_url, chapter['etag'], chapter['last_modified'])
+        if resp is None:
+            return (chapter['etag'], chapter['last_modified'], False)
+        doc_body = make_chapter_doc(chapter_url, resp.content, chapter['published'])
+        self.target.put(chapter_s3key(chapter['href']), doc_body)
+        return (resp.headers.get('ETag'), resp.headers.get('Last-Modified'), True)
+
+    # Fetch every novel index and chapter in the frontier that isn't done, with up to concurrency
+    # requests in flight, started no faster than rate per second. Failures are retried with backoff
+    # without holding up other fetches, and are marked failed (to be tried next run) after TRY_COUNT.
+    async def crawl(self, concurrency=CRAWL_CONCURRENCY, rate=CRAWL_RATE, retry_pause=RETRY_TIME):
+        loop = asyncio.get_running_loop()
+        bucket = AsyncTokenBucket(rate)
+        queue = asyncio.Queue()
+        stats = {'novels': 0, 'uploaded': 0, 'unchanged': 0, 'failed': 0}
+        remaining = 0
+        done = asyncio.Event()
+        retry_tasks = set()
+
+        def enqueue(job):
+            nonlocal remaining
+            remaining += 1
+            queue.put_nowait((job, 0))
+
+        def finish_job():
+            nonlocal remaining
+            remaining -= 1
+            if remaining == 0:
+                done.set()
+
+        async def retry_later(job, attempt):
+            await asyncio.sleep(retry_pause*(2**(attempt - 1)))
+            queue.put_nowait((job, attempt))
+
+        for novel in get_todo_novels():
+            enqueue(('novel', novel))
+        for chapter in get_todo_chapters():
+            enqueue(('chapter', chapter))
+        if remaining == 0:
+            return stats
+
+        async def worker(executor):
+            while True:
+                ((kind, item), attempt) = await queue.get()
+                await bucket.acquire()
+                try:
+                    if kind == 'novel':
+                        result = await loop.run_in_executor(executor, self.fetch_novel, item)
+                    else:
+                        result = await loop.run_in_executor(executor, self.fetch_chapter, item)
+                except requests.RequestException as exc:
+                    print('GET ERROR', kind, item['code'], item.get('chapter', ''), repr(exc), file=sys.stderr)
+                    if (attempt + 1) < TRY_COUNT:
+                        task = asyncio.create_task(retry_later((kind, item), attempt + 1))
+                        retry_tasks.add(task)
+                        task.add_done_callback(retry_tasks.discard)
+                    else:
+                        if kind == 'novel':
+                            update_novel(item['code'], 'failed')
+                        else:
+                            update_chapter(item['code'], item['chapter'], 'failed')
+                        stats['failed'] += 1
+                        finish_job()
+                    continue
+
+                if kind == 'novel':
+                    (status, etag, last_modified, chapters) = result
+                    update_novel(item['code'], status, etag, last_modified, chapters)
+                    stats['novels'] += 1
+                    print(datetime.now(), 'NOVEL', item['code'], status)
+                    if status == 'indexed':
+                        for chapter in get_todo_chapters(item['code']):
+                            enqueue(('chapter', chapter))
+                else:
+                    (etag, last_modified, uploaded) = result
+                    update_chapter(item['code'], item['chapter'], 'done', etag, last_modified)
+                    stats['uploaded' if uploaded else 'unchanged'] += 1
+                    print(datetime.now(), 'CHAPTER', item['code'], item['chapter'], 'uploaded' if uploaded else 'unchanged')
+                finish_job()
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            workers = [asyncio.create_task(worker(executor)) for _ in range(concurrency)]
+            try:
+                # a worker only dies on an unexpected (e.g. parsing or upload) error, which is fatal
+                await asyncio.wait([asyncio.create_task(done.wait())] + workers, return_when=asyncio.FIRST_COMPLETED)
+                for w in workers:
+                    if w.done() and w.exception():
+                        raise w.exception()
+            finally:
+                for task in workers + list(retry_tasks):
+                    task.cancel()
+
+        return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frontier-db', required=True)
+    parser.add_argument('--target', help='s3://bucket or local directory to upload to (default is MASSIF_DOCS_BUCKET)')
+    parser.add_argument('--base-url', default=SYOSETU_BASE_URL)
+    parser.add_argument('--concurrency', type=int, default=CRAWL_CONCURRENCY)
+    parser.add_argument('--rate', type=float, default=CRAWL_RATE, help='max requests per second')
+    parser.add_argument('command', choices=['add', 'crawl', 'refresh'], help='add: add novel codes from stdin, crawl: fetch everything not done yet, refresh: revalidate everything and upload what changed')
+    args = parser.parse_args()
+
+    db_open(args.frontier_db)
+
+    if args.command == 'add':
+        add_codes([line.strip() for line in sys.stdin if line.strip()])
+    else:
+        if args.command == 'refresh':
+            mark_stale()
+        crawler = SyosetuCrawler(make_upload_target(args.target), args.base_url)
+        stats = asyncio.run(crawler.crawl(args.concurrency, args.rate))
+        print(f'{stats["novels"]} novels indexed, {stats["uploaded"]} chapters uploaded, {stats["unchanged"]} unchanged, {stats["failed"]} failed', file=sys.stderr)
+
+    db_close()
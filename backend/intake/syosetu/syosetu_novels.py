@@ -8,9 +8,10 @@ from collections import OrderedDict
 from datetime import datetime
 
 import requests
-from bs4 import BeautifulSoup
 import boto3
 
+from ...util.html_parse import parse_html
+
 PUBLISHED_DATE_RE = re.compile(r'^([0-9]{4})/([0-9]{2})/([0-9]{2})')
 HEADERS = {'User-Agent': 'MassifBot/1.0'}
 WAIT_TIME = 3
@@ -18,8 +19,7 @@ WAIT_TIME = 3
 RETRY_TIME = 15
 TRY_COUNT = 3
 
-s3 = boto3.client('s3')
-bucket = os.getenv('MASSIF_DOCS_BUCKET')
+SYOSETU_BASE_URL = 'https://ncode.syosetu.com'
 
 def requests_get_retry(url, headers):
     tries = 0
@@ -35,64 +35,84 @@ def requests_get_retry(url, headers):
             print('RETRYING')
             time.sleep(RETRY_TIME)
 
-def process_novel(code, bucket, resume_chapter):
-    novel_url = f'https://ncode.syosetu.com/{code}/'
-    novel_resp = requests_get_retry(novel_url, headers=HEADERS)
-    novel_resp.raise_for_status()
-    print(datetime.now(), novel_url)
-    time.sleep(WAIT_TIME)
-
+# returns list of (chapter_id, chapter_href, published) tuples, or None if the novel has no index
+def parse_novel_index(code, content):
     LINK_RE = re.compile(r'^/' + re.escape(code) + r'/([1-9][0-9]*)/$')
 
-    novel_soup = BeautifulSoup(novel_resp.content, 'html.parser')
+    novel_soup = parse_html(content)
     index = novel_soup.find(class_='index_box')
 
     if not index:
-        print('NO INDEX, SKIPPING')
-        return
+        return None
 
+    chapters = []
     for chapter in index.find_all('dl', class_='novel_sublist2'):
         chapter_href = chapter.find('dd').find('a').get('href')
         link_match = LINK_RE.match(chapter_href)
         assert link_match
         chapter_id = link_match.group(1)
 
+        published_str = chapter.find('dt').contents[0].strip()
+        published_match = PUBLISHED_DATE_RE.match(published_str)
+        assert published_match
+        published = '-'.join(published_match.groups())
+
+        chapters.append((chapter_id, chapter_href, published))
+
+    return chapters
+
+def chapter_s3key(chapter_href):
+    return 'ja/syosetu' + chapter_href.rstrip('/')
+
+# returns encoded JSON doc
+def make_chapter_doc(chapter_url, content, published):
+    chapter_soup = parse_html(content)
+    title = chapter_soup.title.get_text()
+    meat_html = str(chapter_soup.find(id='novel_honbun'))
+
+    doc = OrderedDict()
+    doc['type'] = 'text/html'
+    doc['lang'] = 'ja'
+    doc['url'] = chapter_url
+    doc['title'] = title
+    doc['created'] = datetime.utcnow().isoformat() + 'Z'
+    doc['published'] = published
+    doc['text'] = meat_html
+
+    return json.dumps(doc, indent=2, ensure_ascii=False).encode('utf-8')
+
+def process_novel(code, bucket, resume_chapter):
+    novel_url = f'{SYOSETU_BASE_URL}/{code}/'
+    novel_resp = requests_get_retry(novel_url, headers=HEADERS)
+    novel_resp.raise_for_status()
+    print(datetime.now(), novel_url)
+    time.sleep(WAIT_TIME)
+
+    chapters = parse_novel_index(code, novel_resp.content)
+
+    if chapters is None:
+        print('NO INDEX, SKIPPING')
+        return
+
+    for (chapter_id, chapter_href, published) in chapters:
         if resume_chapter:
             if chapter_id == resume_chapter:
                 resume_chapter = None
             else:
                 continue
 
-        s3key = 'ja/syosetu' + chapter_href.rstrip('/')
+        s3key = chapter_s3key(chapter_href)
 
-        published_str = chapter.find('dt').contents[0].strip()
-        published_match = PUBLISHED_DATE_RE.match(published_str)
-        assert published_match
-        published = '-'.join(published_match.groups())
-
-        chapter_url = 'https://ncode.syosetu.com' + chapter_href
+        chapter_url = SYOSETU_BASE_URL + chapter_href
         chapter_resp = requests_get_retry(chapter_url, headers=HEADERS)
         chapter_resp.raise_for_status()
 
-        chapter_soup = BeautifulSoup(chapter_resp.content, 'html.parser')
-        title = chapter_soup.title.get_text()
-        meat_html = str(chapter_soup.find(id='novel_honbun'))
-
-        doc = OrderedDict()
-        doc['type'] = 'text/html'
-        doc['lang'] = 'ja'
-        doc['url'] = chapter_url
-        doc['title'] = title
-        doc['created'] = datetime.utcnow().isoformat() + 'Z'
-        doc['published'] = published
-        doc['text'] = meat_html
-
-        doc_json = json.dumps(doc, indent=2, ensure_ascii=False)
+        doc_body = make_chapter_doc(chapter_url, chapter_resp.content, published)
 
         bucket.put_object(
             Key=s3key,
             ContentType='application/json',
-            Body=doc_json.encode('utf-8')
+            Body=doc_body
         )
 
         print(datetime.now(), chapter_url, '->', s3key)
@@ -0,0 +1,158 @@
+import os
+import json
+import asyncio
+import hashlib
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import syosetu_crawl
+from .syosetu_crawl import SyosetuCrawler
+from ..upload_target import LocalDirTarget
+
+# A fake ncode.syosetu.com. NOVELS maps code to a list of chapter texts (or None for a novel without
+# an index). Chapters send an ETag and honor If-None-Match. Paths in BROKEN always fail with a 503.
+NOVELS = {
+    'n0001aa': ['第一話の本文。', '第二話の本文。', '第三話の本文。'],
+    'n0002bb': ['短編です。'],
+    'n0003cc': None,
+}
+BROKEN = set()
+requests_seen = []
+requests_seen_lock = threading.Lock()
+
+def novel_page(code):
+    chapters = NOVELS[code]
+    if chapters is None:
+        return '<html><head><title>短編</title></head><body><div id="novel_honbun">本文</div></body></html>'
+    items = ''.join(f'<dl class="novel_sublist2"><dd class="subtitle"><a href="/{code}/{i+1}/">第{i+1}話</a></dd><dt class="long_update">2020/01/{i+1:02} 12:00</dt></dl>' for i in range(len(chapters)))
+    return f'<html><head><title>{code}</title></head><body><div class="index_box">{items}</div></body></html>'
+
+def chapter_page(code, i):
+    return f'<html><head><title>{code} 第{i}話</title></head><body><div id="novel_honbun" class="novel_view"><p id="L1">{NOVELS[code][i-1]}</p></div></body></html>'
+
+class FakeSyosetuHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        with requests_seen_lock:
+            requests_seen.append(self.path)
+
+        if self.path in BROKEN:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if len(parts) == 1:
+            body = novel_page(parts[0])
+        else:
+            body = chapter_page(parts[0], int(parts[1]))
+        body = body.encode('utf-8')
+
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def crawl(crawler):
+    requests_seen.clear()
+    return asyncio.run(crawler.crawl(concurrency=4, rate=500, retry_pause=0.01))
+
+def read_doc(out_dir, code, i):
+    with open(os.path.join(out_dir, 'ja/syosetu', code, str(i)), encoding='utf-8') as f:
+        return json.load(f)
+
+def novel_statuses():
+    return dict(syosetu_crawl.cxn.execute('SELECT code, status FROM novel'))
+
+def statuses():
+    return dict(((code, chapter), status) for (code, chapter, status) in syosetu_crawl.cxn.execute('SELECT code, chapter, status FROM chapter'))
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSyosetuHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    out_dir = os.path.join(tmpdir, 'out')
+    syosetu_crawl.db_open(os.path.join(tmpdir, 'frontier.db'))
+    syosetu_crawl.add_codes(['n0001aa', 'n0002bb', 'n0003cc'])
+    crawler = SyosetuCrawler(LocalDirTarget(out_dir), base_url)
+
+    # first run, with one chapter failing every time
+    BROKEN.add('/n0001aa/2/')
+    stats = crawl(crawler)
+    if stats != {'novels': 3, 'uploaded': 3, 'unchanged': 0, 'failed': 1}:
+        print('FAIL first crawl stats', stats)
+    if statuses() != {('n0001aa', '1'): 'done', ('n0001aa', '2'): 'failed', ('n0001aa', '3'): 'done', ('n0002bb', '1'): 'done'}:
+        print('FAIL first crawl statuses', statuses())
+    if requests_seen.count('/n0001aa/2/') != syosetu_crawl.TRY_COUNT:
+        print('FAIL retries', requests_seen.count('/n0001aa/2/'))
+    doc = read_doc(out_dir, 'n0001aa', 3)
+    if (doc['published'] != '2020-01-03') or (doc['title'] != 'n0001aa 第3話') or ('第三話の本文。' not in doc['text']) or (doc['url'] != base_url + '/n0001aa/3/'):
+        print('FAIL doc', doc)
+
+    # the next run resumes with just the failed chapter
+    BROKEN.clear()
+    stats = crawl(crawler)
+    if (stats != {'novels': 0, 'uploaded': 1, 'unchanged': 0, 'failed': 0}) or (requests_seen != ['/n0001aa/2/']):
+        print('FAIL resumed crawl', stats, requests_seen)
+
+    # a crawl with nothing to do makes no requests
+    stats = crawl(crawler)
+    if requests_seen:
+        print('FAIL idle crawl', requests_seen)
+
+    # a refresh revalidates everything, and only uploads what changed (including new chapters)
+    NOVELS['n0001aa'][0] = '第一話の本文（改稿）。'
+    NOVELS['n0002bb'].append('続編です。')
+    syosetu_crawl.mark_stale()
+    mtime = os.path.getmtime(os.path.join(out_dir, 'ja/syosetu/n0001aa/3'))
+    stats = crawl(crawler)
+    if stats != {'novels': 3, 'uploaded': 2, 'unchanged': 3, 'failed': 0}:
+        print('FAIL refresh stats', stats)
+    if '第一話の本文（改稿）。' not in read_doc(out_dir, 'n0001aa', 1)['text']:
+        print('FAIL refreshed doc')
+    if not os.path.exists(os.path.join(out_dir, 'ja/syosetu/n0002bb/2')):
+        print('FAIL new chapter not uploaded')
+    if os.path.getmtime(os.path.join(out_dir, 'ja/syosetu/n0001aa/3')) != mtime:
+        print('FAIL unchanged chapter was uploaded again')
+    if set(statuses().values()) != {'done'}:
+        print('FAIL refresh statuses', statuses())
+    if novel_statuses() != {'n0001aa': 'indexed', 'n0002bb': 'indexed', 'n0003cc': 'noindex'}:
+        print('FAIL refresh novel statuses', novel_statuses())
+
+    # simulate a crash partway through: the frontier says chapters are pending, so they get fetched
+    syosetu_crawl.cxn.execute("UPDATE chapter SET status = 'pending', etag = NULL WHERE code = 'n0002bb'")
+    syosetu_crawl.cxn.commit()
+    stats = crawl(crawler)
+    if (stats['uploaded'] != 2) or (sorted(requests_seen) != ['/n0002bb/1/', '/n0002bb/2/']):
+        print('FAIL crash recovery', stats, requests_seen)
+
+    # a chapter dropped from its novel's index is forgotten, rather than retried (and failing) every run
+    NOVELS['n0001aa'].pop()
+    syosetu_crawl.mark_stale()
+    stats = crawl(crawler)
+    if (stats['failed'] != 0) or ('/n0001aa/3/' in requests_seen) or (('n0001aa', '3') in statuses()) or (set(statuses().values()) != {'done'}):
+        print('FAIL dropped chapter', stats, statuses())
+    stats = crawl(crawler)
+    if requests_seen:
+        print('FAIL crawl after dropped chapter', requests_seen)
+
+    syosetu_crawl.db_close()
+
+server.shutdown()
@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+# Where intake tools put the documents they produce. Each target has put(key, body) taking an
+# S3-style key and the encoded JSON document, and is safe to call from multiple threads.
+
+class S3Target:
+    def __init__(self, bucket):
+        import boto3
+        self.bucket = bucket
+        self.s3 = boto3.client('s3') # clients (unlike resources) can be shared between threads
+
+    def put(self, key, body):
+        self.s3.put_object(Bucket=self.bucket, Key=key, ContentType='application/json', Body=body)
+
+    def __repr__(self):
+        return f's3://{self.bucket}'
+
+# Stands in for S3 when testing, or for staging documents locally. Keys become relative paths.
+class LocalDirTarget:
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, key, body):
+        fn = os.path.join(self.root, key)
+        dirname = os.path.dirname(fn)
+        os.makedirs(dirname, exist_ok=True)
+        # write then rename, so a reader never sees a partial file
+        (fd, tmp_fn) = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_fn, fn)
+
+    def __repr__(self):
+        return self.root
+
+# spec is s3://bucket or a local directory. if not given, it's the MASSIF_DOCS_BUCKET bucket
+def make_upload_target(spec=None):
+    if spec is None:
+        return S3Target(os.getenv('MASSIF_DOCS_BUCKET'))
+    if spec.startswith('s3://'):
+        return S3Target(spec[len('s3://'):])
+    return LocalDirTarget(spec)
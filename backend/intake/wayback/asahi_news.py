@@ -1,9 +1,8 @@
 import re
 from datetime import datetime
 
-from bs4 import BeautifulSoup
-
 from .wayback import Wayback
+from ...util.html_parse import parse_html
 
 NEWS_DATE_RE = re.compile(r'^([0-9]+)月([0-9]+)日$')
 NEWS_TIME_RE = re.compile(r'^([0-9]+)時([0-9]+)分$')
@@ -46,7 +45,7 @@ class NHKNews(Wayback):
         return True
 
     def parse_string(self, text, url):
-        soup = BeautifulSoup(text, 'html.parser')
+        soup = parse_html(text)
 
         page_title = soup.title.text
         assert page_title.strip()
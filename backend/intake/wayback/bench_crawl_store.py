@@ -0,0 +1,83 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+
+from . import wayback
+
+SAMPLE_SENTENCES = [
+    '政府は今日、新しい経済対策を発表しました。',
+    '気象庁によりますと、関東地方では明日にかけて大雨となる見込みです。',
+    '警察は事故の詳しい原因を調べています。',
+    '専門家は、引き続き注意が必要だと話しています。',
+    'この影響で、およそ二万人の利用客に影響が出ました。',
+    '会見で大臣は「責任を持って対応したい」と述べました。',
+    '市によりますと、けが人はいないということです。',
+    '今年の夏は平年より気温が高くなると予想されています。',
+]
+
+def make_article(rng, i):
+    return {
+        'url': f'https://www3.nhk.or.jp/news/html/2020{i % 12 + 1:02}01/k{10000000 + i}.html',
+        'title': f'NHK NEWS WEB {i}',
+        'keywords': rng.sample(['経済', '天気', '事故', '政治', '社会'], 2),
+        'headline': rng.choice(SAMPLE_SENTENCES),
+        'datetime': f'2020-{i % 12 + 1:02}-01T{i % 24:02}:00',
+        'sections': [''.join(rng.choice(SAMPLE_SENTENCES) for _ in range(rng.randint(3, 12))) for _ in range(rng.randint(1, 4))],
+    }
+
+def write_db(dbfn, mode, articles, train_samples):
+    wayback.db_open(dbfn)
+    wayback.cxn.executescript(wayback.SCHEMA)
+    if mode != 'plain':
+        wayback.compact_db()
+        if mode == 'zlib':
+            wayback.write_codec = 'zlib'
+        elif mode == 'zstd-dict':
+            # train on an initial batch, as you'd do when compacting an existing crawl
+            wayback.insert_crawl_results([(a['url'], '20200101000000', a) for a in articles[:train_samples]])
+            wayback.train_zdict()
+            wayback.cxn.execute('DELETE FROM crawl_result_compact')
+            wayback.cxn.execute('DELETE FROM crawl_blob')
+            wayback.cxn.commit()
+
+    t0 = time.perf_counter()
+    for i in range(0, len(articles), wayback.CRAWL_COMMIT_COUNT):
+        wayback.insert_crawl_results([(a['url'], '20200101000000', a) for a in articles[i:i+wayback.CRAWL_COMMIT_COUNT]])
+    write_dt = time.perf_counter() - t0
+    wayback.cxn.execute('VACUUM')
+    wayback.db_close()
+    return write_dt
+
+def scan_db(dbfn):
+    wayback.db_open(dbfn)
+    t0 = time.perf_counter()
+    for result in wayback.iter_crawl_results():
+        pass
+    dt = time.perf_counter() - t0
+    wayback.db_close()
+    return dt
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--dup-fraction', type=float, default=0.1, help='fraction of articles that repeat an earlier body at a new URL')
+    parser.add_argument('--modes', default='plain,zlib,zstd,zstd-dict')
+    args = parser.parse_args()
+
+    rng = random.Random('massif')
+    articles = []
+    for i in range(args.count):
+        if articles and (rng.random() < args.dup_fraction):
+            articles.append({**rng.choice(articles), 'url': f'https://www.nhk.or.jp/dup/{i}.html'})
+        else:
+            articles.append(make_article(rng, i))
+
+    print('\t'.join(['mode', 'articles', 'MB', 'write secs', 'scan secs']))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for mode in args.modes.split(','):
+            dbfn = os.path.join(tmpdir, mode + '.db')
+            write_dt = write_db(dbfn, mode, articles, min(2000, len(articles)))
+            scan_dt = scan_db(dbfn)
+            print('\t'.join([mode, str(len(articles)), f'{os.path.getsize(dbfn)/1e6:.1f}', f'{write_dt:.2f}', f'{scan_dt:.2f}']))
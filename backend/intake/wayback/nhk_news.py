@@ -1,9 +1,8 @@
 import re
 from datetime import datetime
 
-from bs4 import BeautifulSoup
-
 from .wayback import Wayback
+from ...util.html_parse import parse_html
 
 INCLUDE_URL_RE = re.compile(r'/news/html/[0-9]+/[kt][0-9]+\.html$') # other ones seem worthless. recent years only use k, old ones sometimes use t it seems
 
@@ -56,7 +55,7 @@ class NHKNews(Wayback):
         return bool(INCLUDE_URL_RE.search(url))
 
     def parse_string(self, text, url):
-        soup = BeautifulSoup(text, 'html.parser')
+        soup = parse_html(text)
 
         page_title = soup.title.text
         assert page_title.strip()
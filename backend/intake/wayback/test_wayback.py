@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import asyncio
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import wayback
+from .wayback import Wayback
+from ..ratelimit import AsyncTokenBucket
+
+# A fake Wayback Machine. Archived pages are at /web/<timestamp>/<url>, and the page title is the URL.
+# URLs containing 'flaky' fail with a 503 the first time, and URLs containing 'broken' always fail.
+request_counts = {}
+request_counts_lock = threading.Lock()
+
+class FakeArchiveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # so keep-alive works
+
+    def do_GET(self):
+        with request_counts_lock:
+            request_counts[self.path] = request_counts.get(self.path, 0) + 1
+            count = request_counts[self.path]
+
+        (_, _, timestamp, url) = self.path.split('/', 3)
+        if ('broken' in url) or (('flaky' in url) and (count == 1)):
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        time.sleep(0.02) # some latency for concurrency to overlap
+        body = f'<html><head><title>{url}</title></head><body><p>{timestamp}</p></body></html>'.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeSite(Wayback):
+    def parse_string(self, s, url):
+        return {'url': url, 'title': s.split('<title>')[1].split('</title>')[0]}
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), FakeArchiveHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    wayback.db_open(os.path.join(tmpdir, 'crawl.db'))
+    wayback.cxn.executescript(wayback.SCHEMA)
+
+    urls = [f'https://example.com/news/{i}.html' for i in range(40)] + ['https://example.com/flaky/1.html', 'https://example.com/flaky/2.html', 'https://example.com/broken/1.html']
+    wayback.insert_crawl_urls([('20200101000000', url) for url in urls])
+
+    # first pass, resuming from a checkpoint: pretend one URL was already crawled
+    wayback.insert_crawl_result(urls[0], '20200101000000', {'url': urls[0], 'title': 'old'})
+
+    site = FakeSite(base_url)
+    t0 = time.monotonic()
+    stats = asyncio.run(site.crawl_async(concurrency=8, rate=200, retry_base_pause=0.01, commit_count=7))
+    dt = time.monotonic() - t0
+
+    if stats != {'crawled': len(urls) - 2, 'failed': 1}:
+        print('FAIL stats', stats)
+
+    results = {url: json.loads(data) for (url, data) in wayback.cxn.execute('SELECT url, data FROM crawl_result')}
+    if set(results) != set(urls[:-1]):
+        print('FAIL crawled urls', sorted(set(urls) ^ set(results)))
+    if results[urls[0]]['title'] != 'old':
+        print('FAIL already-crawled url was refetched')
+    for url in urls[1:-1]:
+        if results.get(url) != {'url': url, 'title': url}:
+            print('FAIL result', url, results.get(url))
+
+    for url in urls:
+        path = '/web/20200101000000/' + url
+        expected = {'flaky': 2, 'broken': wayback.CRAWL_RETRIES}.get(url.split('/')[3], 1)
+        if url == urls[0]:
+            expected = 0
+        if request_counts.get(path, 0) != expected:
+            print('FAIL request count', url, request_counts.get(path, 0), expected)
+
+    # with 8 in flight, 40 fetches of 20ms each (plus ~0.3s of backoff for the broken URL) should take well under 40*20ms
+    if dt > 0.75:
+        print('FAIL crawl took too long', dt)
+
+    # a second run only retries the broken URL
+    request_counts.clear()
+    stats = asyncio.run(site.crawl_async(concurrency=8, rate=200, retry_base_pause=0.01))
+    if (stats != {'crawled': 0, 'failed': 1}) or (list(request_counts) != ['/web/20200101000000/' + urls[-1]]):
+        print('FAIL resumed crawl', stats, request_counts)
+
+    # switching to compact storage keeps every result readable, and new results go there too
+    before = sorted(wayback.iter_crawl_results(), key=lambda r: r['url'])
+    wayback.compact_db()
+    if wayback.cxn.execute('SELECT COUNT(*) FROM crawl_result').fetchone()[0] != 0:
+        print('FAIL compact left rows in crawl_result')
+    if sorted(wayback.iter_crawl_results(), key=lambda r: r['url']) != before:
+        print('FAIL compacted results differ')
+    if wayback.get_crawl_result(urls[1]) != before[[r['url'] for r in before].index(urls[1])]:
+        print('FAIL get_crawl_result', wayback.get_crawl_result(urls[1]))
+
+    # the same article at two URLs is only stored once
+    article = {'title': '同じ記事', 'sections': ['本文です。']}
+    wayback.insert_crawl_results([('https://example.com/a.html', '20200101000000', {'url': 'https://example.com/a.html', **article}), ('https://example.com/b.html', '20200102000000', {'url': 'https://example.com/b.html', **article}), ('https://example.com/c.html', '20200103000000', article)])
+    if wayback.cxn.execute('SELECT COUNT(DISTINCT blob_hash) FROM crawl_result_compact WHERE url IN (?, ?, ?)', ('https://example.com/a.html', 'https://example.com/b.html', 'https://example.com/c.html')).fetchone()[0] != 1:
+        print('FAIL duplicate article stored twice')
+    if wayback.get_crawl_result('https://example.com/b.html')['data'] != {'url': 'https://example.com/b.html', **article}:
+        print('FAIL deduped result', wayback.get_crawl_result('https://example.com/b.html'))
+    if wayback.get_crawl_result('https://example.com/c.html')['data'] != article:
+        print('FAIL deduped result without url', wayback.get_crawl_result('https://example.com/c.html'))
+    if wayback.get_crawl_result('https://example.com/d.html') is not None:
+        print('FAIL missing result')
+
+    # and a compact DB still resumes properly
+    request_counts.clear()
+    stats = asyncio.run(site.crawl_async(concurrency=8, rate=200, retry_base_pause=0.01))
+    if list(request_counts) != ['/web/20200101000000/' + urls[-1]]:
+        print('FAIL resumed compact crawl', stats, request_counts)
+
+    wayback.db_close()
+
+# the bucket should hold a crowd of acquirers to its rate, after the initial burst
+async def time_acquires(bucket, count):
+    t0 = time.monotonic()
+    await asyncio.gather(*[bucket.acquire() for _ in range(count)])
+    return time.monotonic() - t0
+
+dt = asyncio.run(time_acquires(AsyncTokenBucket(50, burst=5), 30))
+if not (0.45 <= dt <= 0.8):
+    print('FAIL token bucket took', dt, 'expected about', 25/50)
+
+server.shutdown()
@@ -1,11 +1,23 @@
+import os
 import sys
 import argparse
 import time
 import json
 import urllib
+import hashlib
+import zlib
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import sqlite3
 import requests
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from ..ratelimit import AsyncTokenBucket
 
 LONG_CRAWL_PAUSE = 10
 CRAWL_PAUSE = 2
@@ -13,9 +25,20 @@ CRAWL_PAUSE = 2
 CRAWL_RETRIES = 6
 RETRY_PAUSE = 300
 
+CRAWL_COMMIT_COUNT = 50 # results are committed in batches of this many
+
+# for crawl_async. the default rate is the same budget as crawl's CRAWL_PAUSE, but since several
+# fetches can be in flight, we aren't also waiting on each response before starting the next one
+ASYNC_CRAWL_CONCURRENCY = 4
+ASYNC_CRAWL_RATE = 1/CRAWL_PAUSE
+ASYNC_RETRY_BASE_PAUSE = 10 # doubled after each failure of the same URL
+ASYNC_CRAWL_TIMEOUT = 60
+
+WAYBACK_BASE_URL = os.getenv('MASSIF_WAYBACK_BASE_URL', 'https://web.archive.org')
+
 MASSIFBOT_UA = 'Massifbot (+http://www.massif.com/)'
 
-'''
+SCHEMA = '''
 CREATE TABLE crawl_url (
   url TEXT PRIMARY KEY NOT NULL,
   timestamp TEXT NOT NULL
@@ -28,11 +51,47 @@ CREATE TABLE crawl_result (
 );
 '''
 
+# Compact storage, which the compact command adds to a DB (migrating any existing crawl_result rows).
+# Once these tables exist, results are written to them instead of crawl_result. Parse results are
+# stored once per distinct content (minus the url, so the same article at two URLs is stored once),
+# compressed with zstd if available (optionally with a trained dictionary) or else zlib.
+COMPACT_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS crawl_blob (
+  hash BLOB PRIMARY KEY NOT NULL, -- blake2b of the uncompressed data
+  codec TEXT NOT NULL, -- zlib, zstd, or zstd:<crawl_zdict id>
+  data BLOB NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS crawl_zdict (
+  id INTEGER PRIMARY KEY NOT NULL,
+  data BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS crawl_result_compact (
+  url TEXT PRIMARY KEY NOT NULL,
+  timestamp TEXT NOT NULL,
+  blob_hash BLOB NOT NULL REFERENCES crawl_blob(hash),
+  url_in_data INTEGER NOT NULL -- if the parse result had a url field equal to url, which we removed
+);
+'''
+
+ZSTD_LEVEL = 10
+ZSTD_DICT_SIZE = 112*1024
+ZSTD_DICT_SAMPLES = 5000
+
 cxn = None
+compact = False
+zdicts = {} # crawl_zdict id -> zstandard.ZstdCompressionDict
+write_codec = None
+compressor = None # for write_codec, if it's a zstd one
+decompressors = {} # codec -> zstandard.ZstdDecompressor
 
 def db_open(dbfn):
-    global cxn
+    global cxn, compact
     cxn = sqlite3.connect(dbfn)
+    compact = bool(cxn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'crawl_result_compact'").fetchone())
+    if compact:
+        load_zdicts()
 
 def db_close():
     global cxn
@@ -52,21 +111,149 @@ def insert_crawl_urls(crawl_urls):
 
 def iter_uncrawled_urls():
     cur = cxn.cursor()
-    for row in cur.execute('SELECT url, timestamp FROM crawl_url WHERE NOT EXISTS (SELECT url FROM crawl_result WHERE crawl_result.url = crawl_url.url)'):
+    if compact:
+        rows = cur.execute('SELECT url, timestamp FROM crawl_url WHERE NOT EXISTS (SELECT url FROM crawl_result WHERE crawl_result.url = crawl_url.url) AND NOT EXISTS (SELECT url FROM crawl_result_compact WHERE crawl_result_compact.url = crawl_url.url)')
+    else:
+        rows = cur.execute('SELECT url, timestamp FROM crawl_url WHERE NOT EXISTS (SELECT url FROM crawl_result WHERE crawl_result.url = crawl_url.url)')
+    for row in rows:
         yield {
             'url': row[0],
             'timestamp': row[1],
         }
 
-def insert_crawl_result(url, timestamp, data):
+def load_zdicts():
+    global write_codec, compressor
+    zdicts.clear()
+    decompressors.clear()
+    if zstandard is None:
+        write_codec = 'zlib'
+        compressor = None
+        return
+
+    write_codec = 'zstd'
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    decompressors['zstd'] = zstandard.ZstdDecompressor()
+    for (zdict_id, data) in cxn.execute('SELECT id, data FROM crawl_zdict ORDER BY id'):
+        zdict = zstandard.ZstdCompressionDict(data)
+        zdicts[zdict_id] = zdict
+        decompressors[f'zstd:{zdict_id}'] = zstandard.ZstdDecompressor(dict_data=zdict)
+        # the newest one is used for writing
+        write_codec = f'zstd:{zdict_id}'
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict)
+
+def compress_blob(raw):
+    if write_codec == 'zlib':
+        return zlib.compress(raw, 9)
+    return compressor.compress(raw)
+
+def decompress_blob(codec, data):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    assert zstandard, 'zstandard package is needed to read this DB'
+    return decompressors[codec].decompress(data)
+
+def blob_raw(url, parse_result):
+    payload = dict(parse_result)
+    url_in_data = payload.get('url') == url
+    if url_in_data:
+        del payload['url']
+    return (json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), url_in_data)
+
+def insert_crawl_result(url, timestamp, parse_result):
+    insert_crawl_results([(url, timestamp, parse_result)])
+
+# takes list of (url, timestamp, parse_result) tuples, inserted in one transaction
+def insert_crawl_results(results):
+    cur = cxn.cursor()
+    cur.execute('BEGIN')
+    if compact:
+        for (url, timestamp, parse_result) in results:
+            (raw, url_in_data) = blob_raw(url, parse_result)
+            blob_hash = hashlib.blake2b(raw, digest_size=16).digest()
+            if not cur.execute('SELECT 1 FROM crawl_blob WHERE hash = ?', (blob_hash, )).fetchone():
+                cur.execute('INSERT INTO crawl_blob (hash, codec, data) VALUES (?, ?, ?)', (blob_hash, write_codec, compress_blob(raw)))
+            cur.execute('INSERT INTO crawl_result_compact (url, timestamp, blob_hash, url_in_data) VALUES (?, ?, ?, ?)', (url, timestamp, blob_hash, int(url_in_data)))
+    else:
+        cur.executemany('INSERT INTO crawl_result (url, timestamp, data) VALUES (?, ?, ?)', ((url, timestamp, json.dumps(parse_result, ensure_ascii=False, indent=2)) for (url, timestamp, parse_result) in results))
+    cur.execute('COMMIT')
+
+def decode_compact_row(url, timestamp, url_in_data, codec, data):
+    parse_result = json.loads(decompress_blob(codec, data))
+    if url_in_data:
+        parse_result = {'url': url, **parse_result}
+    return {
+        'url': url,
+        'timestamp': timestamp,
+        'data': parse_result,
+    }
+
+# yields dicts with fields url, timestamp, data (the parse result), whichever way they were stored
+def iter_crawl_results():
+    for row in cxn.execute('SELECT url, timestamp, data FROM crawl_result'):
+        yield {
+            'url': row[0],
+            'timestamp': row[1],
+            'data': json.loads(row[2]),
+        }
+    if compact:
+        for row in cxn.execute('SELECT r.url, r.timestamp, r.url_in_data, b.codec, b.data FROM crawl_result_compact r INNER JOIN crawl_blob b ON b.hash = r.blob_hash'):
+            yield decode_compact_row(*row)
+
+def get_crawl_result(url):
+    row = cxn.execute('SELECT url, timestamp, data FROM crawl_result WHERE url = ?', (url, )).fetchone()
+    if row:
+        return {
+            'url': row[0],
+            'timestamp': row[1],
+            'data': json.loads(row[2]),
+        }
+    if compact:
+        row = cxn.execute('SELECT r.url, r.timestamp, r.url_in_data, b.codec, b.data FROM crawl_result_compact r INNER JOIN crawl_blob b ON b.hash = r.blob_hash WHERE r.url = ?', (url, )).fetchone()
+        if row:
+            return decode_compact_row(*row)
+    return None
+
+# Trains a zstd dictionary on a sample of the stored results, which is then used for new blobs
+def train_zdict(sample_count=ZSTD_DICT_SAMPLES, dict_size=ZSTD_DICT_SIZE):
+    global write_codec
+    assert zstandard, 'zstandard package is needed to train a dictionary'
+    samples = []
+    for result in iter_crawl_results():
+        samples.append(blob_raw(result['url'], result['data'])[0])
+        if len(samples) >= sample_count:
+            break
+    zdict = zstandard.train_dictionary(dict_size, samples)
     cur = cxn.cursor()
     cur.execute('BEGIN')
-    cur.execute('INSERT INTO crawl_result (url, timestamp, data) VALUES (?, ?, ?)', (url, timestamp, data))
+    cur.execute('INSERT INTO crawl_zdict (data) VALUES (?)', (zdict.as_bytes(), ))
     cur.execute('COMMIT')
+    load_zdicts()
+
+# Switches the DB to compact storage, moving any existing crawl_result rows over
+def compact_db(train_dict=False):
+    global compact
+    cxn.executescript(COMPACT_SCHEMA)
+    compact = True
+    load_zdicts()
+    if train_dict:
+        train_zdict()
+
+    while True:
+        rows = cxn.execute('SELECT url, timestamp, data FROM crawl_result LIMIT ?', (CRAWL_COMMIT_COUNT*20, )).fetchall()
+        if not rows:
+            break
+        insert_crawl_results([(url, timestamp, json.loads(data)) for (url, timestamp, data) in rows])
+        cur = cxn.cursor()
+        cur.execute('BEGIN')
+        cur.executemany('DELETE FROM crawl_result WHERE url = ?', ((row[0], ) for row in rows))
+        cur.execute('COMMIT')
+
+    cxn.execute('VACUUM')
 
 class Wayback:
-    def __init__(self):
-        pass
+    def __init__(self, base_url=None):
+        self.base_url = base_url or WAYBACK_BASE_URL
+        self.thread_local = threading.local()
 
     def crawl_seeds(self):
         for seed_prefix in self.get_seed_prefixes():
@@ -79,7 +266,7 @@ class Wayback:
                 'filter': ['statuscode:200', 'mimetype:text/html'],
                 'limit': '100000',
             }
-            r = requests.get('https://web.archive.org/web/timemap/', params=params, headers={'User-Agent': MASSIFBOT_UA})
+            r = requests.get(f'{self.base_url}/web/timemap/', params=params, headers={'User-Agent': MASSIFBOT_UA})
             r.raise_for_status()
 
             result_rows = r.json()
@@ -117,7 +304,7 @@ class Wayback:
                 if resume_key is not None:
                     params['resumeKey'] = resume_key
 
-                r = requests.get('https://web.archive.org/cdx/search/cdx', params=params, headers={'User-Agent': MASSIFBOT_UA})
+                r = requests.get(f'{self.base_url}/cdx/search/cdx', params=params, headers={'User-Agent': MASSIFBOT_UA})
                 r.raise_for_status()
 
                 raw_result_rows = r.json()
@@ -154,11 +341,15 @@ class Wayback:
     def parse_file(self, fn, url):
         return self.parse_string(open(fn).read(), url)
 
+    def archive_url(self, info):
+        return f'{self.base_url}/web/{info["timestamp"]}/{info["url"]}'
+
     def crawl(self):
+        accum_results = []
         for info in iter_uncrawled_urls():
             for retry in range(CRAWL_RETRIES):
                 try:
-                    r = requests.get(f'https://web.archive.org/web/{info["timestamp"]}/{info["url"]}', headers={'User-Agent': MASSIFBOT_UA})
+                    r = requests.get(self.archive_url(info), headers={'User-Agent': MASSIFBOT_UA})
                     r.raise_for_status()
                     break
                 except:
@@ -174,23 +365,125 @@ class Wayback:
                 print('TEXT:')
                 print(r.text)
                 raise
-            json_text = json.dumps(parse_result, ensure_ascii=False, indent=2)
-            # print(json_text)
-
-            insert_crawl_result(info['url'], info['timestamp'], json_text)
+            accum_results.append((info['url'], info['timestamp'], parse_result))
+            if len(accum_results) >= CRAWL_COMMIT_COUNT:
+                insert_crawl_results(accum_results)
+                accum_results = []
 
             print('CRAWLED', info['timestamp'], info['url'])
 
             time.sleep(CRAWL_PAUSE)
 
+        if accum_results:
+            insert_crawl_results(accum_results)
+
+    # Fetch and parse one URL, returning the parse result to store. This runs in a worker thread,
+    # each of which keeps its own session so connections are reused.
+    def fetch_and_parse(self, info):
+        session = getattr(self.thread_local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers['User-Agent'] = MASSIFBOT_UA
+            self.thread_local.session = session
+
+        r = session.get(self.archive_url(info), timeout=ASYNC_CRAWL_TIMEOUT)
+        r.raise_for_status()
+
+        try:
+            parse_result = self.parse_string(r.text, info['url'])
+        except:
+            print('ERROR parsing url', info['url'], file=sys.stderr)
+            raise
+        return parse_result
+
+    # Like crawl, but with up to concurrency fetches in flight, started no faster than rate per second.
+    # A failed URL is retried after its own backoff without holding up the others, and is given up on
+    # (until the next run) after CRAWL_RETRIES attempts. Results are committed every commit_count URLs,
+    # and since the queue is just the crawl_url rows without a crawl_result, an interrupted crawl resumes.
+    async def crawl_async(self, concurrency=ASYNC_CRAWL_CONCURRENCY, rate=ASYNC_CRAWL_RATE, retry_base_pause=ASYNC_RETRY_BASE_PAUSE, commit_count=CRAWL_COMMIT_COUNT):
+        loop = asyncio.get_running_loop()
+        bucket = AsyncTokenBucket(rate)
+        queue = asyncio.Queue()
+        for info in list(iter_uncrawled_urls()):
+            queue.put_nowait((info, 0))
+        remaining = queue.qsize()
+        done = asyncio.Event()
+        if remaining == 0:
+            done.set()
+
+        accum_results = []
+        stats = {'crawled': 0, 'failed': 0}
+
+        def finish_url():
+            nonlocal remaining
+            remaining -= 1
+            if remaining == 0:
+                done.set()
+
+        async def retry_later(info, attempt):
+            await asyncio.sleep(retry_base_pause*(2**(attempt - 1)))
+            queue.put_nowait((info, attempt))
+
+        retry_tasks = set()
+
+        async def worker(executor):
+            nonlocal accum_results
+            while True:
+                (info, attempt) = await queue.get()
+                await bucket.acquire()
+                try:
+                    parse_result = await loop.run_in_executor(executor, self.fetch_and_parse, info)
+                except requests.RequestException as exc:
+                    print('REQUEST ERROR', info['url'], repr(exc), file=sys.stderr)
+                    if (attempt + 1) < CRAWL_RETRIES:
+                        task = asyncio.create_task(retry_later(info, attempt + 1))
+                        retry_tasks.add(task)
+                        task.add_done_callback(retry_tasks.discard)
+                    else:
+                        print('GIVING UP', info['url'], file=sys.stderr)
+                        stats['failed'] += 1
+                        finish_url()
+                    continue
+
+                accum_results.append((info['url'], info['timestamp'], parse_result))
+                if len(accum_results) >= commit_count:
+                    insert_crawl_results(accum_results)
+                    accum_results = []
+                stats['crawled'] += 1
+                print('CRAWLED', info['timestamp'], info['url'])
+                finish_url()
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            workers = [asyncio.create_task(worker(executor)) for _ in range(concurrency)]
+            try:
+                # a worker only dies if parsing fails, which (like crawl) we treat as fatal
+                await asyncio.wait([asyncio.create_task(done.wait())] + workers, return_when=asyncio.FIRST_COMPLETED)
+                for w in workers:
+                    if w.done() and w.exception():
+                        raise w.exception()
+            finally:
+                for task in workers + list(retry_tasks):
+                    task.cancel()
+                if accum_results:
+                    insert_crawl_results(accum_results)
+
+        return stats
+
     def run_main(self):
         parser = argparse.ArgumentParser()
         parser.add_argument('--sqlite-db')
         parser.add_argument('--parse-url')
         parser.add_argument('--parse-fn')
+        parser.add_argument('--base-url', help='Wayback Machine base URL (default ' + WAYBACK_BASE_URL + ')')
+        parser.add_argument('--concurrency', type=int, default=ASYNC_CRAWL_CONCURRENCY, help='for crawl_async')
+        parser.add_argument('--rate', type=float, default=ASYNC_CRAWL_RATE, help='max requests per second, for crawl_async')
+        parser.add_argument('--train-dict', action='store_true', help='for compact, train a zstd dictionary on existing results')
         parser.add_argument('command')
         args = parser.parse_args()
 
+        if args.base_url:
+            self.base_url = args.base_url
+
         if args.command == 'crawl_seeds':
             assert args.sqlite_db
             db_open(args.sqlite_db)
@@ -203,5 +496,19 @@ class Wayback:
             assert args.sqlite_db
             db_open(args.sqlite_db)
             self.crawl()
+        elif args.command == 'crawl_async':
+            assert args.sqlite_db
+            db_open(args.sqlite_db)
+            stats = asyncio.run(self.crawl_async(args.concurrency, args.rate))
+            print(f'crawled {stats["crawled"]} urls, gave up on {stats["failed"]}')
+        elif args.command == 'compact':
+            assert args.sqlite_db
+            db_open(args.sqlite_db)
+            compact_db(args.train_dict)
+        elif args.command == 'train_dict':
+            assert args.sqlite_db
+            db_open(args.sqlite_db)
+            assert compact, 'run compact first'
+            train_zdict()
         else:
             assert False, 'unrecognized command'
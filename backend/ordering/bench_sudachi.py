@@ -0,0 +1,73 @@
+import sys
+import time
+import random
+import argparse
+
+from sudachi import analyze_stream, analyze_batch
+
+SAMPLE_SENTENCES = [
+    'その口ぶりからすると、あなたは知っているようですね。',
+    '飛ばねぇ豚はただの豚だ',
+    '何か喋っているようだが内容までは聞き取れない。',
+    'どうやら相当の思い入れがあったらしい。',
+    '明日は学校に行かなければならない。',
+    'えっ、本当に？',
+]
+
+def stream_batch(frags):
+    gen = analyze_stream()
+    results = []
+    for frag in frags:
+        next(gen)
+        results.append(gen.send(frag))
+    try:
+        next(gen)
+        gen.send(None)
+    except StopIteration:
+        pass
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--subprocess-sample', type=int, default=10, help='a JVM per fragment is so slow that we only time this many and extrapolate')
+    parser.add_argument('--modes', default='subprocess,stream,server,python')
+    parser.add_argument('frags_file', nargs='?', help='fragments, one per line (default is synthetic)')
+    args = parser.parse_args()
+
+    if args.frags_file:
+        frags = [line.strip() for line in open(args.frags_file) if line.strip()][:args.count]
+    else:
+        rng = random.Random('massif')
+        frags = [rng.choice(SAMPLE_SENTENCES) + rng.choice(SAMPLE_SENTENCES) for _ in range(args.count)]
+
+    print('\t'.join(['mode', 'frags', 'secs', 'frags/sec']))
+    baseline = None
+    for mode in args.modes.split(','):
+        if mode == 'subprocess':
+            run_frags = frags[:args.subprocess_sample]
+            f = lambda batch: analyze_batch(batch, 'subprocess')
+        elif mode == 'stream':
+            run_frags = frags
+            f = stream_batch
+        else:
+            run_frags = frags
+            f = lambda batch, mode=mode: analyze_batch(batch, mode)
+
+        try:
+            t0 = time.perf_counter()
+            results = []
+            for i in range(0, len(run_frags), args.batch_size):
+                results.extend(f(run_frags[i:i+args.batch_size]))
+            dt = time.perf_counter() - t0
+        except Exception as exc:
+            print('\t'.join([mode, 'FAILED', repr(exc)]))
+            continue
+
+        if baseline is None:
+            baseline = results
+        elif results != baseline[:len(results)]:
+            print('NOTE: results for', mode, 'differ from', args.modes.split(',')[0], file=sys.stderr)
+
+        print('\t'.join([mode, str(len(run_frags)), f'{dt:.2f}', f'{len(run_frags)/dt:.1f}']))
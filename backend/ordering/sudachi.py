@@ -1,9 +1,18 @@
+import os
+import atexit
 import subprocess
+import threading
 
 CMD = 'java -jar ~/vendor/sudachi-0.5.2/sudachi-0.5.2.jar -m B -p ~/vendor/sudachi-0.5.2'
 
 SUDACHI_FRAG_SEPARATOR = '\a'
 
+# How analyze_single/analyze_batch do their work:
+#   server: one long-lived Java Sudachi process, with batches of fragments pipelined through it
+#   python: in-process SudachiPy (faster still, but its dictionary may not exactly match the jar's)
+#   subprocess: a new Java process per call (the old behavior)
+SUDACHI_MODE = os.getenv('MASSIF_SUDACHI_MODE', 'server')
+
 # takes sudachi output line (without trailing newline, if any) and returns tuple (orig, analysis, normalized) or None
 # this only filters the stuff we are totally sure we don't want to index on (particles and everything are still included)
 def _filter_line(sline):
@@ -44,7 +53,7 @@ def analyze_stream():
 
         yield accum_results
 
-def analyze_single(frag):
+def analyze_subprocess(frag):
     completed = subprocess.run(CMD, shell=True, check=True, capture_output=True, encoding='utf-8', input=frag)
 
     accum_results = []
@@ -56,5 +65,96 @@ def analyze_single(frag):
 
     return accum_results
 
+# A long-lived Java Sudachi process. Each fragment (which may have newlines) is followed by a line
+# with just the separator, so we know where its output ends. A batch of fragments is written from a
+# separate thread while we read results, so requests and responses are pipelined.
+class SudachiServer:
+    def __init__(self):
+        self.proc = subprocess.Popen(CMD, shell=True, encoding='utf-8', stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+
+    def _write_batch(self, frags):
+        for frag in frags:
+            self.proc.stdin.write(frag + '\n' + SUDACHI_FRAG_SEPARATOR + '\n')
+        self.proc.stdin.flush()
+
+    def analyze_batch(self, frags):
+        for frag in frags:
+            assert SUDACHI_FRAG_SEPARATOR not in frag
+
+        with self.lock:
+            writer = threading.Thread(target=self._write_batch, args=(frags, ))
+            writer.start()
+
+            results = []
+            accum_results = []
+            while len(results) < len(frags):
+                line = self.proc.stdout.readline()
+                assert line, 'sudachi exited unexpectedly'
+                sline = line.rstrip('\n')
+                if SUDACHI_FRAG_SEPARATOR in sline:
+                    # done with this fragment. the EOS for the separator line gets filtered out later
+                    results.append(accum_results)
+                    accum_results = []
+                else:
+                    maybe_result = _filter_line(sline)
+                    if maybe_result is not None:
+                        accum_results.append(maybe_result)
+
+            writer.join()
+
+        return results
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+_server = None
+
+def get_server():
+    global _server
+    if _server is None:
+        _server = SudachiServer()
+        atexit.register(_server.close)
+    return _server
+
+_py_tokenizer = None
+
+# Same output as the Java CLI, which analyzes each line separately
+def analyze_batch_python(frags):
+    global _py_tokenizer
+    from sudachipy import tokenizer, dictionary
+    if _py_tokenizer is None:
+        _py_tokenizer = dictionary.Dictionary().create()
+    mode = tokenizer.Tokenizer.SplitMode.B
+
+    results = []
+    for frag in frags:
+        accum_results = []
+        for line in frag.split('\n'):
+            if not line:
+                continue
+            for m in _py_tokenizer.tokenize(line, mode):
+                maybe_result = _filter_line('\t'.join([m.surface(), ','.join(m.part_of_speech()), m.normalized_form()]))
+                if maybe_result is not None:
+                    accum_results.append(maybe_result)
+        results.append(accum_results)
+    return results
+
+# takes a list of fragments, returns a list of lists of (orig, fields_str, normal) tuples
+def analyze_batch(frags, mode=None):
+    mode = mode or SUDACHI_MODE
+    if mode == 'server':
+        return get_server().analyze_batch(frags)
+    elif mode == 'python':
+        return analyze_batch_python(frags)
+    elif mode == 'subprocess':
+        return [analyze_subprocess(frag) for frag in frags]
+    else:
+        assert False, 'unknown sudachi mode ' + repr(mode)
+
+def analyze_single(frag, mode=None):
+    return analyze_batch([frag], mode)[0]
+
 if __name__ == '__main__':
     print(analyze_single('これ。それ。学校\nに行った。'))
@@ -1,31 +1,30 @@
 import sys
-import subprocess
+import argparse
 
-from sudachi import analyze_stream
+from sudachi import analyze_batch
+
+def flush_batch(batch):
+    for (frag, results) in zip(batch, analyze_batch(batch)):
+        normals = [normal for (orig, fields_str, normal) in results]
+
+        # print the result line for this fragment
+        print('\t'.join([frag, '|'.join(normals)]))
 
 if __name__ == '__main__':
     sys.stdin.reconfigure(encoding='utf-8')
 
-    # start sudachi
-    gen = analyze_stream()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
 
+    batch = []
     for line in sys.stdin:
         frag = line.strip()
         if not frag:
             continue
 
-        # step generator-iterator to get analysis for this fragment
-        next(gen)
-        results = gen.send(frag)
-
-        normals = [normal for (orig, fields_str, normal) in results]
-
-        # print the result line for this fragment
-        print('\t'.join([frag, '|'.join(normals)]))
-
-    # finish iteration (weird)
-    try:
-        next(gen)
-        gen.send(None)
-    except StopIteration:
-        pass
+        batch.append(frag)
+        if len(batch) >= args.batch_size:
+            flush_batch(batch)
+            batch = []
+    flush_batch(batch)
@@ -3,6 +3,8 @@ import os
 import sys
 import tensorflow as tf
 import argparse
+import sqlite3
+import numpy as np
 from tensorflow.contrib.training import HParams
 
 import model
@@ -40,12 +42,61 @@ def score_tokens(*, hparams, tokens):
 
     return ln_probs_next
 
+# Batched version of score_tokens. tokens is a [batch_size, max_length] batch of token-lists, padded
+# on the right to the same length, and lengths has the real length of each one.
+# Returns the sum of log probabilities of each token-list (over tokens after the first one).
+# Since the model attention is causal, padding at the end has no effect on the real positions.
+def score_token_batch(*, hparams, tokens, lengths):
+    lm_output = model.model(hparams=hparams, X=tokens, past=None, reuse=tf.AUTO_REUSE)
+
+    logits = lm_output['logits']
+    assert logits.shape[2] == hparams.n_vocab
+    # logits has shape [batch_size, max_length, vocab_size]
+
+    # as in score_tokens, look up the probability it gave for each actual next token
+    log_probs = tf.nn.log_softmax(logits[:, :-1, :])
+    next_tokens = tokens[:, 1:]
+    next_shape = tf.shape(next_tokens)
+    batch_idx = tf.tile(tf.expand_dims(tf.range(next_shape[0]), 1), [1, next_shape[1]])
+    pos_idx = tf.tile(tf.expand_dims(tf.range(next_shape[1]), 0), [next_shape[0], 1])
+    indices = tf.stack([batch_idx, pos_idx, next_tokens], axis=-1)
+    ln_probs_next = tf.gather_nd(log_probs, indices)
+    # ln_probs_next has shape [batch_size, max_length-1]
+
+    # ignore positions that are just padding
+    mask = tf.sequence_mask(lengths - 1, maxlen=next_shape[1], dtype=ln_probs_next.dtype)
+
+    return tf.reduce_sum(ln_probs_next * mask, axis=1)
+
+# Takes a list of (key, expanded_tokens) and yields lists of them with similar lengths, so that there
+# isn't much wasted work on padding. Batches are limited by count and by total padded tokens.
+def iter_length_buckets(items, batch_size, max_batch_tokens):
+    items = sorted(items, key=lambda item: len(item[1]))
+    batch = []
+    for item in items:
+        # items are sorted, so this item is the longest in the batch if we add it
+        if batch and ((len(batch) >= batch_size) or ((len(batch) + 1)*len(item[1]) > max_batch_tokens)):
+            yield batch
+            batch = []
+        batch.append(item)
+    if batch:
+        yield batch
+
 parser = argparse.ArgumentParser()
-parser.add_argument('input_file')
+parser.add_argument('input_file', nargs='?', help='file of texts to score, one per line (or - for stdin), printing TSV')
+parser.add_argument('--sqlite-db', help='fragment db, whose unscored fragments get scored in place')
 parser.add_argument('--model', default='gpt2ja-medium')
 parser.add_argument('--gpu', type=str, default='0')
+parser.add_argument('--batch-size', type=int, default=1, help='greater than 1 uses batched scoring')
+parser.add_argument('--max-batch-tokens', type=int, default=8192)
+parser.add_argument('--intra-threads', type=int, default=0, help='0 lets TensorFlow decide')
+parser.add_argument('--inter-threads', type=int, default=0, help='0 lets TensorFlow decide')
+parser.add_argument('--db-chunk-size', type=int, default=10000)
+parser.add_argument('--verify', type=int, default=0, help='check batched sums against batch-1 sums for this many texts first')
 args = parser.parse_args()
 
+assert bool(args.input_file) != bool(args.sqlite_db), 'need exactly one of input_file or --sqlite-db'
+
 with open('ja-bpe.txt') as f:
     bpe = f.read().split('\n')
 
@@ -82,21 +133,10 @@ elif 'large' in args.model:
 else:
     raise ValueError('invalid model name.')
 
-# read input texts
-if args.input_file == '-':
-    input_f = sys.stdin
-else:
-    input_f = open(args.input_file, 'r')
-
-texts = []
-for line in input_f:
-    sline = line.strip()
-    if not sline:
-        continue
-    texts.append(sline)
-
-
-config = tf.ConfigProto()
+config = tf.ConfigProto(
+    intra_op_parallelism_threads=args.intra_threads,
+    inter_op_parallelism_threads=args.inter_threads,
+)
 
 if int(args.gpu) >= 0:
     config.gpu_options.allow_growth = True
@@ -104,32 +144,118 @@ if int(args.gpu) >= 0:
 
 ADD_END_TOKEN = True
 
+end_token = enc.encode('<|endoftext|>')[0]
+start_token = end_token # it does double duty
+
+def expand_tokens(text):
+    # prepend the start token so that we get a probability for the first "real" token
+    tokens = enc.encode(text)
+    expanded_tokens = [start_token] + tokens
+    if ADD_END_TOKEN:
+        expanded_tokens += [end_token]
+    return (tokens, expanded_tokens)
+
+# batch of 1 at a time. returns list of sums of logprobs
+def score_single(sess, expanded_tokens_list):
+    sums = []
+    for expanded_tokens in expanded_tokens_list:
+        logprobs = sess.run(output, feed_dict={
+            tokens_tensor: expanded_tokens,
+        })
+
+        logprobs_list = logprobs.tolist()
+        assert len(logprobs_list) == len(expanded_tokens) - 1 # sanity check
+
+        sums.append(sum(logprobs_list))
+    return sums
+
+# bucketed batches. returns list of sums of logprobs, in same order as input
+def score_batched(sess, expanded_tokens_list):
+    sums = [None]*len(expanded_tokens_list)
+    for batch in iter_length_buckets(enumerate(expanded_tokens_list), args.batch_size, args.max_batch_tokens):
+        max_length = len(batch[-1][1])
+        padded = np.full((len(batch), max_length), end_token, dtype=np.int32)
+        lengths = np.zeros(len(batch), dtype=np.int32)
+        for (row, (_, expanded_tokens)) in enumerate(batch):
+            padded[row, :len(expanded_tokens)] = expanded_tokens
+            lengths[row] = len(expanded_tokens)
+
+        batch_sums = sess.run(batch_output, feed_dict={
+            batch_tokens_tensor: padded,
+            batch_lengths_tensor: lengths,
+        })
+
+        for ((idx, _), s) in zip(batch, batch_sums.tolist()):
+            sums[idx] = s
+    return sums
+
+def score_texts(sess, texts):
+    expanded = [expand_tokens(text) for text in texts]
+    expanded_tokens_list = [e for (_, e) in expanded]
+    if args.batch_size > 1:
+        sums = score_batched(sess, expanded_tokens_list)
+    else:
+        sums = score_single(sess, expanded_tokens_list)
+    return [(s, len(tokens)) for (s, (tokens, _)) in zip(sums, expanded)]
+
 with tf.Session(config=config, graph=tf.Graph()) as sess:
     tokens_tensor = tf.placeholder(tf.int32, [None])
-
     output = score_tokens(hparams=hparams, tokens=tokens_tensor)
 
+    batch_tokens_tensor = tf.placeholder(tf.int32, [None, None])
+    batch_lengths_tensor = tf.placeholder(tf.int32, [None])
+    batch_output = score_token_batch(hparams=hparams, tokens=batch_tokens_tensor, lengths=batch_lengths_tensor)
+
     saver = tf.train.Saver()
     ckpt = tf.train.latest_checkpoint(args.model)
     saver.restore(sess, ckpt)
 
-    end_token = enc.encode('<|endoftext|>')[0]
-    start_token = end_token # it does double duty
+    if args.sqlite_db:
+        # NOTE: this script gets copied to the scoring node on its own, so we talk to the fragment db
+        # directly rather than through fragdb
+        cxn = sqlite3.connect(args.sqlite_db)
+        cur = cxn.cursor()
+        last_id = -1
+        verify_remaining = args.verify
+        scored = 0
+        while True:
+            # only rows without a score, so we can resume after an interruption
+            rows = cur.execute('SELECT id, text FROM fragment WHERE logprob IS NULL AND id > ? ORDER BY id LIMIT ?', (last_id, args.db_chunk_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
 
-    for text in texts:
-        # prepend the start token so that we get a probability for the first "real" token
-        tokens = enc.encode(text)
-        expanded_tokens = [start_token] + tokens
-        if ADD_END_TOKEN:
-            expanded_tokens += [end_token]
+            texts = [text for (_, text) in rows]
+            results = score_texts(sess, texts)
 
-        logprobs = sess.run(output, feed_dict={
-            tokens_tensor: expanded_tokens,
-        })
+            if verify_remaining > 0:
+                check = [expand_tokens(text)[1] for text in texts[:verify_remaining]]
+                expected = score_single(sess, check)
+                actual = [s for (s, _) in results[:len(check)]]
+                assert np.allclose(actual, expected, rtol=1e-4, atol=1e-3), (actual, expected)
+                verify_remaining -= len(check)
+                print('verified', len(check), 'sums against batch-1 path', file=sys.stderr)
 
-        logprobs_list = logprobs.tolist()
-        assert len(logprobs_list) == len(expanded_tokens) - 1 # sanity check
+            cur.execute('BEGIN')
+            cur.executemany('UPDATE fragment SET logprob = ?, count_toks = ? WHERE id = ?', [(s, count_toks, frag_id) for ((s, count_toks), (frag_id, _)) in zip(results, rows)])
+            cur.execute('COMMIT')
+
+            scored += len(rows)
+            print('scored', scored, 'fragments, up to id', last_id, file=sys.stderr, flush=True)
+        cxn.close()
+    else:
+        # read input texts
+        if args.input_file == '-':
+            input_f = sys.stdin
+        else:
+            input_f = open(args.input_file, 'r')
 
-        sumlogprob = sum(logprobs_list)
+        texts = []
+        for line in input_f:
+            sline = line.strip()
+            if not sline:
+                continue
+            texts.append(sline)
 
-        print('%s\t%.5g' % (text, sumlogprob), flush=True)
+        for (text, (sumlogprob, _)) in zip(texts, score_texts(sess, texts)):
+            print('%s\t%.5g' % (text, sumlogprob), flush=True)
@@ -0,0 +1,31 @@
+import os
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+# Intake parsers for whole scraped pages (nhk_news.py, asahi_news.py, syosetu_novels.py) were written
+# against html.parser, and lxml can build a different tree from the same messy HTML, so they keep
+# using it. Parsing the <p>s of docs for indexing uses the C-accelerated lxml tree builder if it's
+# installed, since parsing there is most of the CPU cost, and test_html_parse checks it gives the same
+# fragments and chunks. MASSIF_HTML_PARSER forces a specific builder for both.
+def _pick_fast_parser():
+    try:
+        import lxml
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+DEFAULT_PARSER = os.getenv('MASSIF_HTML_PARSER') or 'html.parser'
+FAST_PARSER = os.getenv('MASSIF_HTML_PARSER') or _pick_fast_parser()
+
+def parse_html(text, parser=None, parse_only=None):
+    return BeautifulSoup(text, parser or DEFAULT_PARSER, parse_only=parse_only)
+
+P_ONLY = SoupStrainer('p')
+
+# Takes an HTML fragment like '<div><p>...</p><p>...</p></div>' and returns its <p> elements, only
+# building the parts of the tree under those <p>s.
+# NOTE: This also finds <p>s nested deeper than direct children of the root, but that doesn't happen
+# in the docs we handle (e.g. syosetu chapters).
+def parse_p_children(text, parser=None):
+    soup = parse_html(text, parser or FAST_PARSER, parse_only=P_ONLY)
+    return [child for child in soup.children if child.name == 'p']
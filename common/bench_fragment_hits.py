@@ -0,0 +1,58 @@
+import json
+import random
+import argparse
+
+from .fragment_hits import encode_hits, decode_hits
+
+# Size of the stored hits of fragment docs, in the old dict-of-samples format vs the compact one, and
+# how much of a search response _source filtering cuts for each endpoint. Fragments are made up, with
+# a skewed hit count (most have one hit) over a few tag-sets, and realistic source ids and locs.
+
+TAG_SETS = ['drama,subs', 'novel,url', 'anime,subs', '']
+MAX_HITS_PER_TAG_SET = 4
+
+def jlen(obj):
+    return len(json.dumps(obj, ensure_ascii=False).encode('utf-8'))
+
+def make_tag_sets(rng):
+    tag_sets = {}
+    for tag_set in rng.sample(TAG_SETS, rng.choice([1, 1, 1, 2, 3])):
+        count = int(rng.paretovariate(1.2))
+        sample = []
+        for _ in range(min(count, MAX_HITS_PER_TAG_SET)):
+            start = rng.uniform(0, 3000)
+            loc = f't:{start:.3f}-{start + rng.uniform(1, 5):.3f}' if tag_set.endswith('subs') else f'a:L{rng.randrange(1, 500)}'
+            sample.append((rng.getrandbits(63), loc))
+        tag_sets[tag_set] = (count, sample)
+    return tag_sets
+
+def old_hits(tag_sets):
+    return {k: {'count': count, 'sample': [{'source_id': sid, 'loc': loc} for (sid, loc) in sample]} for (k, (count, sample)) in tag_sets.items()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    sizes = dict((k, 0) for k in ['old_hits', 'new_hits', 'old_doc', 'new_doc', 'fsearch', 'normal_fragments'])
+    for _ in range(args.count):
+        tag_sets = make_tag_sets(rng)
+        assert decode_hits(encode_hits(tag_sets)) == tag_sets
+        doc = {
+            'text': '言い聞かせるように聞き込みをしているうちに、',
+            'normals': ['言い聞かせる', 'よう', 'だ', '聞き込み', 'を', 'する', 'て', 'いる', 'うち', 'に', '、'],
+            'reading': [['言', 'い'], 'い', ['聞', 'き'], 'かせるように', ['聞', 'き'], ['込', 'こ'], 'みをしているうちに、'],
+            'mscore': rng.random(),
+            'tag_sets': list(tag_sets.keys()),
+        }
+        sizes['old_hits'] += jlen(old_hits(tag_sets))
+        sizes['new_hits'] += jlen(encode_hits(tag_sets))
+        sizes['old_doc'] += jlen(dict(doc, hits=old_hits(tag_sets)))
+        sizes['new_doc'] += jlen(dict(doc, hits=encode_hits(tag_sets)))
+        sizes['fsearch'] += jlen({'text': doc['text'], 'hits': encode_hits(tag_sets)})
+        sizes['normal_fragments'] += jlen({'text': doc['text'], 'normals': doc['normals'], 'reading': doc['reading']})
+
+    print('\t'.join(['what', 'avg bytes', 'vs old doc']))
+    for (k, v) in sizes.items():
+        print('\t'.join([k, f'{v/args.count:.1f}', f'{v/sizes["old_doc"]:.2f}']))
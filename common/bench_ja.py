@@ -0,0 +1,136 @@
+import sys
+import time
+import argparse
+
+import jaconv
+
+from . import ja
+
+SAMPLE_FRAGMENTS = [
+    '様々な可愛い豚を繰り返す',
+    '飛ばねぇ豚はただの豚だ',
+    'ぶっ殺したのはここ一ヶ月のことだ',
+    '鏡は無ぇみてぇだなァ',
+    '或は小ぢんまりとした部屋',
+    '２人で五〇歳になった。',
+    '204号室のスミスの部屋。',
+    '言い聞かせるように聞き込みをしているうちに、',
+    'どうやら相当の思い入れがあったらしい。',
+    '何か喋っているようだが内容までは聞き取れない。',
+    '日本では、これは私のです',
+    'その口ぶりからすると、あなたは知っているようですね。',
+]
+
+# the original dict-per-step version, for comparison
+def ref_match_furigana(kanji_text, kana_text, not_start):
+    len_kanji_text = len(kanji_text)
+    len_kana_text = len(kana_text)
+    stack = [{
+        'kanji_idx': 0,
+        'kana_idx': 0,
+        'result': '',
+        'accum_kana': '',
+    }]
+
+    while stack:
+        top = stack.pop()
+        kanji_idx = top['kanji_idx']
+        kana_idx = top['kana_idx']
+        result = top['result']
+        accum_kana = top['accum_kana']
+        if kanji_idx == len_kanji_text:
+            if kana_idx == len_kana_text:
+                return result
+        elif kana_idx != len_kana_text:
+            kanji_char = kanji_text[kanji_idx]
+            kana_char = kana_text[kana_idx]
+            norm_kanji_char = jaconv.hira2kata(kanji_char)
+            norm_kana_char = jaconv.hira2kata(kana_char)
+            if (norm_kanji_char == norm_kana_char) or \
+              ((norm_kanji_char == 'ハ') and (norm_kana_char == 'ワ')) or \
+              ((norm_kanji_char == 'ヂ') and (norm_kana_char == 'ジ')) or \
+              ((norm_kanji_char == 'ヅ') and (norm_kana_char == 'ズ')):
+                stack.append({
+                    'kanji_idx': kanji_idx + 1,
+                    'kana_idx': kana_idx + 1,
+                    'result': result + kanji_char,
+                    'accum_kana': '',
+                })
+            elif ja.char_could_have_reading(kanji_char):
+                after_run_idx = kanji_idx + 1
+                while (after_run_idx < len_kanji_text) and ja.char_could_have_reading(kanji_text[after_run_idx]):
+                    after_run_idx += 1
+                stack.append({
+                    'kanji_idx': kanji_idx,
+                    'kana_idx': kana_idx + 1,
+                    'result': result,
+                    'accum_kana': accum_kana + kana_text[kana_idx],
+                })
+                stack.append({
+                    'kanji_idx': after_run_idx,
+                    'kana_idx': kana_idx + 1,
+                    'result': result + (' ' if (not_start or result) else '') + kanji_text[kanji_idx:after_run_idx] + '[' + jaconv.kata2hira(accum_kana + kana_text[kana_idx]) + ']',
+                    'accum_kana': '',
+                })
+
+    return kanji_text
+
+def memo_match_furigana(kanji_text, kana_text, not_start):
+    return ja._ja_match_furigana_memo(kanji_text, kana_text, not_start)
+
+def run_readings(match_furigana, morpheme_lists):
+    # ja_get_morphemes_reading looks up ja_match_furigana as a module global
+    saved = ja.ja_match_furigana
+    ja.ja_match_furigana = match_furigana
+    try:
+        t0 = time.perf_counter()
+        results = [ja.ja_get_morphemes_reading(morphemes) for morphemes in morpheme_lists]
+        dt = time.perf_counter() - t0
+    finally:
+        ja.ja_match_furigana = saved
+    return (results, dt)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--morphemes', type=int, default=1000000)
+    parser.add_argument('frags_file', nargs='?', help='fragments, one per line (default is a built-in sample)')
+    args = parser.parse_args()
+
+    if args.frags_file:
+        frags = [line.strip() for line in open(args.frags_file, encoding='utf-8') if line.strip()]
+    else:
+        frags = SAMPLE_FRAGMENTS
+
+    # analyze each fragment once, and repeat them until we have enough morphemes
+    analyzed = [ja.ja_compact_morphemes(ja.ja_get_tokenizer().tokenize(frag)) for frag in frags]
+    morpheme_lists = []
+    count = 0
+    while count < args.morphemes:
+        for morphemes in analyzed:
+            morpheme_lists.append(morphemes)
+            count += len(morphemes)
+
+    print('\t'.join(['variant', 'morphemes', 'secs', 'morphemes/sec']))
+
+    (baseline, dt) = run_readings(ref_match_furigana, morpheme_lists)
+    print('\t'.join(['original', str(count), f'{dt:.2f}', f'{count/dt:.0f}']))
+
+    variants = [
+        ('uncached', ja.ja_match_furigana_uncached),
+        ('memoized', memo_match_furigana),
+    ]
+    for (name, f) in variants:
+        ja._ja_match_furigana_memo.cache_clear()
+        (results, dt) = run_readings(f, morpheme_lists)
+        assert results == baseline, name + ' results differ from original'
+        print('\t'.join([name, str(count), f'{dt:.2f}', f'{count/dt:.0f}']))
+
+    # precomputed table covering every pair in the workload
+    for morphemes in analyzed:
+        for m in morphemes:
+            if ja.ja_wants_furigana(m.surface(), m.reading_form()):
+                ja.furigana_table[(m.surface(), m.reading_form())] = (ja.ja_match_furigana_uncached(m.surface(), m.reading_form(), False), ja.ja_match_furigana_uncached(m.surface(), m.reading_form(), True))
+    (results, dt) = run_readings(ja.ja_match_furigana, morpheme_lists)
+    assert results == baseline, 'table results differ from original'
+    print('\t'.join(['table', str(count), f'{dt:.2f}', f'{count/dt:.0f}']))
+    print(ja._ja_match_furigana_memo.cache_info(), file=sys.stderr)
@@ -0,0 +1,57 @@
+import time
+import argparse
+import multiprocessing
+
+from . import ja
+from .bench_ja import SAMPLE_FRAGMENTS
+
+# Tokenizing and analyzing fragments the way index_fragments.py does (repetition check, normal stats,
+# reading). "sudachi" hands each Sudachi MorphemeList straight to the analysis, as ja_get_text_morphemes
+# used to; the others go through ja_get_texts_morphemes, in one process or a pool. Times are the best
+# of --repeat runs, since they vary a lot from run to run.
+
+def analyze(texts, morpheme_lists):
+    for (text, morphemes) in zip(texts, morpheme_lists):
+        ja.ja_is_repetitive(text, morphemes)
+        ja.ja_get_morphemes_normal_stats(morphemes)
+        ja.ja_get_morphemes_reading(morphemes)
+
+def run_sudachi(texts, batch_size):
+    tokenizer_obj = ja.ja_get_tokenizer()
+    analyze(texts, (tokenizer_obj.tokenize(text, ja._split_mode) for text in texts))
+
+def run_batch(texts, batch_size, pool=None):
+    for i in range(0, len(texts), batch_size):
+        batch = texts[i:i+batch_size]
+        analyze(batch, ja.ja_get_texts_morphemes(batch, pool))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=50000)
+    parser.add_argument('--batch-size', type=int, default=1024)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('frags_file', nargs='?', help='fragments, one per line (default is a built-in sample)')
+    args = parser.parse_args()
+
+    if args.frags_file:
+        frags = [line.strip() for line in open(args.frags_file, encoding='utf-8') if line.strip()]
+    else:
+        frags = SAMPLE_FRAGMENTS
+    texts = [frags[i % len(frags)] for i in range(args.count)]
+
+    ja.ja_preload()
+    print('\t'.join(['variant', 'texts', 'secs', 'texts/sec']))
+    with multiprocessing.Pool(args.processes) as pool:
+        variants = [
+            ('sudachi', run_sudachi),
+            ('batch', run_batch),
+            (f'batch, pool of {args.processes}', lambda texts, batch_size: run_batch(texts, batch_size, pool)),
+        ]
+        for (name, run) in variants:
+            dt = float('inf')
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                run(texts, args.batch_size)
+                dt = min(dt, time.perf_counter() - t0)
+            print('\t'.join([name, str(len(texts)), f'{dt:.2f}', f'{len(texts)/dt:.0f}']))
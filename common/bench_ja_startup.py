@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import multiprocessing
+
+from . import ja
+from .bench_ja import SAMPLE_FRAGMENTS
+
+# Startup: time and peak RSS of a fresh process that imports ja, with and without loading the Sudachi
+# dictionary. Workers: memory of forked worker processes after they've all tokenized something, when
+# each loads the dictionary itself (lazy) vs when it's loaded before forking (preload, as the web app
+# does under gunicorn preload_app). Pss splits shared pages between the processes sharing them, so
+# the Pss total is what the workers really cost together.
+
+STARTUP_VARIANTS = [
+    ('import', f'from {__package__} import ja'),
+    ('import+load', f'from {__package__} import ja; ja.ja_preload()'),
+    ('import+tokenize', f'from {__package__} import ja; ja.ja_get_text_morphemes("日本では")'),
+]
+
+STARTUP_PROBE = '''
+import sys, time, resource
+t0 = time.perf_counter()
+exec(sys.argv[1])
+print(time.perf_counter() - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'sudachipy' in sys.modules)
+'''
+
+def bench_startup(runs):
+    print('\t'.join(['startup', 'median secs', 'max rss MB', 'sudachi imported']))
+    for (name, code) in STARTUP_VARIANTS:
+        results = []
+        for _ in range(runs):
+            out = subprocess.run([sys.executable, '-c', STARTUP_PROBE, code], capture_output=True, text=True, check=True).stdout.split()
+            results.append((float(out[0]), int(out[1]), out[2] == 'True'))
+        print('\t'.join([name, f'{statistics.median(r[0] for r in results):.3f}', f'{max(r[1] for r in results)/1024:.1f}', str(results[0][2])]))
+
+# kB by field, e.g. Rss, Pss, Anonymous
+def smaps_rollup():
+    fields = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if (len(parts) == 3) and (parts[2] == 'kB'):
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return fields
+
+def worker(barrier, queue):
+    for frag in SAMPLE_FRAGMENTS*10:
+        ja.ja_get_text_morphemes(frag)
+    barrier.wait() # measure while all the workers are alive, so shared pages are split between them
+    queue.put(smaps_rollup())
+    barrier.wait()
+
+def bench_workers(worker_count, mode):
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(worker_count)
+    queue = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(barrier, queue)) for _ in range(worker_count)]
+    for p in procs:
+        p.start()
+    results = [queue.get() for _ in procs]
+    for p in procs:
+        p.join()
+
+    rss = statistics.mean(r['Rss'] for r in results)/1024
+    pss = statistics.mean(r['Pss'] for r in results)/1024
+    private = statistics.mean(r['Private_Clean'] + r['Private_Dirty'] for r in results)/1024
+    print('\t'.join([mode, str(worker_count), f'{rss:.1f}', f'{pss:.1f}', f'{private:.1f}', f'{pss*worker_count:.1f}']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    bench_startup(args.runs)
+
+    print('\t'.join(['workers', 'count', 'rss MB', 'pss MB', 'private MB', 'total pss MB']))
+    bench_workers(args.workers, 'lazy')
+    ja.ja_preload()
+    bench_workers(args.workers, 'preload')
@@ -0,0 +1,85 @@
+import os
+import time
+import random
+import argparse
+import itertools
+import tempfile
+import statistics
+
+import requests
+
+from .normal_fragments import NormalFragmentsWriter, NormalFragmentsFile, TOP_K
+
+# Latency of looking up the top fragments for a normal, from a normal fragments file vs from ES with
+# the query /api/get_normal_fragments makes. Normals to look up are drawn from the file, weighted
+# towards common ones, as word lookups are. Without --table, the file is built from made-up fragments
+# with Zipf-distributed normals. ES is only timed if --es-url is given.
+
+def make_table(path, fragment_count, vocab_size, rng):
+    cum_weights = list(itertools.accumulate(1/(i + 1) for i in range(vocab_size)))
+    vocab = [f'語{i}' for i in range(vocab_size)]
+    writer = NormalFragmentsWriter(path)
+    for i in range(fragment_count):
+        normals = list(dict.fromkeys(rng.choices(vocab, cum_weights=cum_weights, k=rng.randint(3, 15))))
+        text = ''.join(normals)
+        writer.add(rng.random(), {'text': text, 'normals': normals, 'reading': text})
+    writer.close()
+
+def percentiles(times):
+    times = sorted(times)
+    return (statistics.median(times), times[int(len(times)*0.99)])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--table', help='existing normal fragments file (default is to build one)')
+    parser.add_argument('--fragments', type=int, default=200000)
+    parser.add_argument('--vocab', type=int, default=50000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--es-url', help='e.g. http://localhost:9200/fragment_ja')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.table
+        if not path:
+            path = os.path.join(tmpdir, 'normal_fragments.bin')
+            t0 = time.perf_counter()
+            make_table(path, args.fragments, args.vocab, rng)
+            print('built', args.fragments, 'fragments in', f'{time.perf_counter() - t0:.1f}s,', f'{os.path.getsize(path)/1e6:.1f}MB')
+
+        table = NormalFragmentsFile(path)
+        names = []
+        for i in range(table.normal_count):
+            (name_offset, name_length, _, ref_count) = table._entry(i)
+            names.append((table.mm[name_offset:name_offset+name_length].decode('utf-8'), ref_count))
+        normals = rng.choices([name for (name, _) in names], [ref_count for (_, ref_count) in names], k=args.lookups)
+
+        print('\t'.join(['path', 'lookups', 'p50 ms', 'p99 ms']))
+        times = []
+        for normal in normals:
+            t0 = time.perf_counter()
+            table.get_json(normal, TOP_K)
+            times.append(time.perf_counter() - t0)
+        (p50, p99) = percentiles(times)
+        print('\t'.join(['file', str(len(times)), f'{p50*1000:.3f}', f'{p99*1000:.3f}']))
+
+        if args.es_url:
+            session = requests.Session()
+            times = []
+            for normal in normals:
+                t0 = time.perf_counter()
+                resp = session.get(f'{args.es_url}/_search', json={
+                    'query': {'match_phrase': {'normals': normal}},
+                    'sort': [{'mscore': 'desc'}],
+                    'track_total_hits': False,
+                    '_source': ['text', 'normals', 'reading'],
+                    'size': TOP_K,
+                })
+                resp.raise_for_status()
+                resp.json()
+                times.append(time.perf_counter() - t0)
+            (p50, p99) = percentiles(times)
+            print('\t'.join(['es', str(len(times)), f'{p50*1000:.3f}', f'{p99*1000:.3f}']))
+        else:
+            print('es\t(skipped, no --es-url)')
+        table.close()
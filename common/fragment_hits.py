@@ -0,0 +1,41 @@
+import random
+
+# The hits of a fragment doc in the ES fragment index. For each tag-set (sorted tags comma-joined into a
+# string, or the empty string for hits without tags), the total count of hits and a sample of them.
+#
+# Stored compactly as {tag_set: [count, source_id, loc, source_id, loc, ...]}. Indexes built before this
+# have {tag_set: {'count': count, 'sample': [{'source_id': ..., 'loc': ...}, ...]}}, which decode_hits
+# also reads, so the web app works against either.
+
+# takes {tag_set: (count, [(source_id, loc), ...])}
+def encode_hits(tag_sets):
+    encoded = {}
+    for (tag_set, (count, sample)) in tag_sets.items():
+        flat = [count]
+        for (source_id, loc) in sample:
+            flat.append(source_id)
+            flat.append(loc)
+        encoded[tag_set] = flat
+    return encoded
+
+# returns {tag_set: (count, [(source_id, loc), ...])}
+def decode_hits(hits):
+    decoded = {}
+    for (tag_set, v) in hits.items():
+        if isinstance(v, dict):
+            decoded[tag_set] = (v['count'], [(h['source_id'], h['loc']) for h in v['sample']])
+        else:
+            decoded[tag_set] = (v[0], list(zip(v[1::2], v[2::2])))
+    return decoded
+
+# Returns (total count, a random (source_id, loc) from the samples) over all tag-sets, or if tags is
+# given, only the tag-sets with any of those tags, matching a search filtered by them.
+def choose_hit(hits, tags=None):
+    total_count = 0
+    combined_sample = []
+    for (tag_set, (count, sample)) in decode_hits(hits).items():
+        if tags and not set(tag_set.split(',')).intersection(tags):
+            continue
+        total_count += count
+        combined_sample.extend(sample)
+    return (total_count, random.choice(combined_sample))
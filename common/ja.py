@@ -1,11 +1,37 @@
+import os
 import sys
 import re
+import atexit
+import functools
 from collections import Counter
 
-from sudachipy import tokenizer, dictionary
 import jaconv
 
-tokenizer_obj = dictionary.Dictionary().create()
+from .ja_cache import JaAnalysisCache
+
+JA_SPLIT_MODE = 'B'
+
+# The Sudachi dictionary is loaded on first use rather than at import, so that scripts that only use
+# the helpers here don't pay for it.
+_tokenizer_obj = None
+_split_mode = None
+
+def ja_get_tokenizer():
+    global _tokenizer_obj, _split_mode
+    if _tokenizer_obj is None:
+        from sudachipy import tokenizer, dictionary
+        _tokenizer_obj = dictionary.Dictionary().create()
+        _split_mode = getattr(tokenizer.Tokenizer.SplitMode, JA_SPLIT_MODE)
+    return _tokenizer_obj
+
+# Loads the dictionary now. A server that forks its workers should call this before forking (e.g. at
+# import with gunicorn preload_app), so the workers share its pages copy-on-write instead of each
+# loading their own.
+def ja_preload():
+    ja_get_tokenizer()
+
+def ja_tokenize(text):
+    return ja_get_tokenizer().tokenize(text, _split_mode)
 
 KANJI_RE = re.compile(r'[一-龯]')
 def has_any_kanji(s):
@@ -69,24 +95,37 @@ def ja_get_morphemes_normal_stats(morphemes):
 
     return result
 
+# kana pairs (kanji text side, reading side) that we consider a match, as well as identical kana
+FURIGANA_EQUIV_KANA = {('ハ', 'ワ'), ('ヂ', 'ジ'), ('ヅ', 'ズ')}
+
 # returns text with furigana in "Anki format", readings converted to hiragana
-def ja_match_furigana(kanji_text, kana_text, not_start):
-    # We use a non-recursive DFS, storing an explicit stack
+def ja_match_furigana_uncached(kanji_text, kana_text, not_start):
+    # We use a non-recursive DFS, storing an explicit stack of (kanji_idx, kana_idx, result, accum_kana)
     len_kanji_text = len(kanji_text)
     len_kana_text = len(kana_text)
-    stack = [{
-        'kanji_idx': 0,
-        'kana_idx': 0,
-        'result': '',
-        'accum_kana': '',
-    }]
+
+    # normalize to katakana up front rather than per step. hira2kata maps char-for-char,
+    # but if that ever changes we fall back to per-char lists so indexes still line up
+    norm_kanji_text = jaconv.hira2kata(kanji_text)
+    if len(norm_kanji_text) != len_kanji_text:
+        norm_kanji_text = [jaconv.hira2kata(c) for c in kanji_text]
+    norm_kana_text = jaconv.hira2kata(kana_text)
+    if len(norm_kana_text) != len_kana_text:
+        norm_kana_text = [jaconv.hira2kata(c) for c in kana_text]
+
+    # for each index, the index after the end of the run of could-have-reading chars starting there (or None)
+    after_runs = [None]*len_kanji_text
+    after_run_idx = len_kanji_text
+    for idx in range(len_kanji_text - 1, -1, -1):
+        if char_could_have_reading(kanji_text[idx]):
+            after_runs[idx] = after_run_idx
+        else:
+            after_run_idx = idx
+
+    stack = [(0, 0, '', '')]
 
     while stack:
-        top = stack.pop()
-        kanji_idx = top['kanji_idx']
-        kana_idx = top['kana_idx']
-        result = top['result']
-        accum_kana = top['accum_kana']
+        (kanji_idx, kana_idx, result, accum_kana) = stack.pop()
         if kanji_idx == len_kanji_text:
             if kana_idx == len_kana_text:
                 # we found a match!
@@ -100,55 +139,71 @@ def ja_match_furigana(kanji_text, kana_text, not_start):
                 # dead end
                 pass
             else:
-                kanji_char = kanji_text[kanji_idx]
-                kana_char = kana_text[kana_idx]
-                norm_kanji_char = jaconv.hira2kata(kanji_char)
-                norm_kana_char = jaconv.hira2kata(kana_char)
-                if (norm_kanji_char == norm_kana_char) or \
-                  ((norm_kanji_char == 'ハ') and (norm_kana_char == 'ワ')) or \
-                  ((norm_kanji_char == 'ヂ') and (norm_kana_char == 'ジ')) or \
-                  ((norm_kanji_char == 'ヅ') and (norm_kana_char == 'ズ')):
+                norm_kanji_char = norm_kanji_text[kanji_idx]
+                norm_kana_char = norm_kana_text[kana_idx]
+                if (norm_kanji_char == norm_kana_char) or ((norm_kanji_char, norm_kana_char) in FURIGANA_EQUIV_KANA):
                     assert not accum_kana
-                    stack.append({
-                        'kanji_idx': kanji_idx + 1,
-                        'kana_idx': kana_idx + 1,
-                        'result': result + kanji_char,
-                        'accum_kana': '',
-                    })
-                elif char_could_have_reading(kanji_char):
+                    stack.append((kanji_idx + 1, kana_idx + 1, result + kanji_text[kanji_idx], ''))
+                elif after_runs[kanji_idx] is not None:
                     # we didn't check if kana_char is actually kana (as opposed to punctuation)
                     # because analyzer should make those into separate morphemes
 
-                    # find the next index after the end of the kanji run
-                    after_run_idx = kanji_idx + 1
-                    while (after_run_idx < len_kanji_text) and char_could_have_reading(kanji_text[after_run_idx]):
-                        after_run_idx += 1
+                    # index after the end of the kanji run
+                    after_run_idx = after_runs[kanji_idx]
+                    accum_kana += kana_text[kana_idx]
 
                     # NOTE: The order that we push onto the stack is extremely important to not have horrible performance
 
-                    stack.append({
-                        'kanji_idx': kanji_idx,
-                        'kana_idx': kana_idx + 1,
-                        'result': result,
-                        'accum_kana': accum_kana + kana_text[kana_idx],
-                    })
+                    stack.append((kanji_idx, kana_idx + 1, result, accum_kana))
 
-                    stack.append({
-                        'kanji_idx': after_run_idx,
-                        'kana_idx': kana_idx + 1,
-                        'result': result + (' ' if (not_start or result) else '') + kanji_text[kanji_idx:after_run_idx] + '[' + jaconv.kata2hira(accum_kana + kana_text[kana_idx]) + ']',
-                        'accum_kana': '',
-                    })
+                    stack.append((
+                        after_run_idx,
+                        kana_idx + 1,
+                        result + (' ' if (not_start or result) else '') + kanji_text[kanji_idx:after_run_idx] + '[' + jaconv.kata2hira(accum_kana) + ']',
+                        '',
+                    ))
 
     # print('NO MATCHES', repr(kanji_text), repr(kana_text))
     # We occasionally don't match in weird cases, but that's OK
     return kanji_text
 
+# The same (surface, reading) pairs come up over and over across the corpus, so we memoize.
+# Before that, we check an optional precomputed table of the most common pairs (see
+# backend/indexing/build_furigana_table.py), loaded from MASSIF_JA_FURIGANA_TABLE if set.
+FURIGANA_CACHE_SIZE = 200000
+furigana_table = {} # (surface, reading) -> (result, result with not_start)
+
+_ja_match_furigana_memo = functools.lru_cache(maxsize=FURIGANA_CACHE_SIZE)(ja_match_furigana_uncached)
+
+def ja_match_furigana(kanji_text, kana_text, not_start):
+    hit = furigana_table.get((kanji_text, kana_text))
+    if hit is not None:
+        return hit[1 if not_start else 0]
+    return _ja_match_furigana_memo(kanji_text, kana_text, not_start)
+
+# table file is TSV with columns surface, reading, result, result with not_start
+def ja_load_furigana_table(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            (surface, reading, result, result_not_start) = line.rstrip('\n').split('\t')
+            furigana_table[(surface, reading)] = (result, result_not_start)
+
+if os.getenv('MASSIF_JA_FURIGANA_TABLE'):
+    ja_load_furigana_table(os.getenv('MASSIF_JA_FURIGANA_TABLE'))
+
 ADJUSTED_READINGS = {
     '日本': (['名詞', '固有名詞', '地名', '国', '*', '*'], '日本[にほん]'),
     '私': (['代名詞', '*', '*', '*', '*', '*'], '私[わたし]'),
 }
 
+# If there isn't any reading form (for stuff like 'foo')
+# or there aren't any kanji or numerals,
+# or it's _just_ numerals (which ends up being not very useful)
+# then we just copy the surface form rather than matching furigana.
+# This avoids weird bugs where the reading doesn't really match the surface.
+def ja_wants_furigana(surface, reading):
+    return bool(reading) and (has_any_kanji(surface) or has_any_numerals(surface)) and not is_all_numerals(surface)
+
 def ja_get_morphemes_reading(morphemes):
     result_pieces = []
 
@@ -158,27 +213,191 @@ def ja_get_morphemes_reading(morphemes):
             surface = m.surface()
             if (surface in ADJUSTED_READINGS) and all(x == y for (x, y) in zip(pos, ADJUSTED_READINGS[surface][0])):
                 result_pieces.append((' ' if result_pieces else '') + ADJUSTED_READINGS[surface][1])
-            elif (not m.reading_form()) or (not (has_any_kanji(surface) or has_any_numerals(surface))) or is_all_numerals(surface):
-                # If there isn't any reading form (for stuff like 'foo')
-                # or there aren't any kanji or numerals,
-                # or it's _just_ numerals (which ends up being not very useful)
-                # then just copy the surface form.
-                # This avoids weird bugs where the reading doesn't really match the surface.
-                result_pieces.append(surface)
-            else:
+            elif ja_wants_furigana(surface, m.reading_form()):
                 result_pieces.append(ja_match_furigana(surface, m.reading_form(), bool(result_pieces)))
+            else:
+                result_pieces.append(surface)
     except:
         print('ERROR getting reading of', morphemes, file=sys.stderr)
         raise
 
     return ''.join(result_pieces)
 
+# A compact stand-in for a Sudachi Morpheme, holding just the fields we use. It has the same accessor
+# methods, so it can be passed to anything here that takes morphemes.
+class JaMorpheme:
+    __slots__ = ('s', 'n', 'd', 'r', 'p', 'b', 'e')
+
+    def __init__(self, s, n, d, r, p, b, e):
+        self.s = s # surface
+        self.n = n # normalized form
+        self.d = d # dictionary form
+        self.r = r # reading form
+        self.p = p # part of speech tuple (we need all of it for ADJUSTED_READINGS)
+        self.b = b # begin offset
+        self.e = e # end offset
+
+    def surface(self):
+        return self.s
+
+    def normalized_form(self):
+        return self.n
+
+    def dictionary_form(self):
+        return self.d
+
+    def reading_form(self):
+        return self.r
+
+    def part_of_speech(self):
+        return self.p
+
+    def begin(self):
+        return self.b
+
+    def end(self):
+        return self.e
+
+    def to_row(self):
+        return [self.s, self.n, self.d, self.r, ','.join(self.p), self.b, self.e]
+
+    @staticmethod
+    def from_row(row):
+        (s, n, d, r, p, b, e) = row
+        return JaMorpheme(s, n, d, r, tuple(p.split(',')), b, e)
+
+    def __repr__(self):
+        return f'JaMorpheme({self.s!r})'
+
+def ja_compact_morphemes(morphemes):
+    return [JaMorpheme(m.surface(), m.normalized_form(), m.dictionary_form(), m.reading_form(), tuple(m.part_of_speech()), m.begin(), m.end()) for m in morphemes]
+
+def ja_dict_version():
+    try:
+        from importlib import metadata
+        return 'SudachiDict-core-' + metadata.version('SudachiDict-core')
+    except Exception:
+        return 'unknown'
+
+# If an analysis cache is open, ja_get_texts_morphemes reads through it.
+# It can be opened explicitly, or by setting MASSIF_JA_ANALYSIS_CACHE to a SQLite file path.
+analysis_cache = None
+
+def ja_open_analysis_cache(path):
+    global analysis_cache
+    ja_close_analysis_cache()
+    analysis_cache = JaAnalysisCache(path, ja_dict_version(), JA_SPLIT_MODE)
+    return analysis_cache
+
+def ja_close_analysis_cache():
+    global analysis_cache
+    if analysis_cache:
+        analysis_cache.close()
+    analysis_cache = None
+
+atexit.register(ja_close_analysis_cache)
+
+if os.getenv('MASSIF_JA_ANALYSIS_CACHE'):
+    ja_open_analysis_cache(os.getenv('MASSIF_JA_ANALYSIS_CACHE'))
+
+def ja_tokenize_compact(texts):
+    tokenize = ja_get_tokenizer().tokenize
+    return [ja_compact_morphemes(tokenize(text, _split_mode)) for text in texts]
+
+# Runs in pool workers. Returns the JaMorpheme fields as plain tuples, which pickle in half the time
+# of JaMorphemes. Equal part of speech tuples are made the same object, so pickle only sends them once.
+def _ja_tokenize_fields(texts):
+    tokenize = ja_get_tokenizer().tokenize
+    pos_tuples = {}
+    results = []
+    for text in texts:
+        fields = []
+        for m in tokenize(text, _split_mode):
+            pos = tuple(m.part_of_speech())
+            fields.append((m.surface(), m.normalized_form(), m.dictionary_form(), m.reading_form(), pos_tuples.setdefault(pos, pos), m.begin(), m.end()))
+        results.append(fields)
+    return results
+
+JA_POOL_CHUNK_SIZE = 256
+
+# Tokenizes many texts, returning a list of JaMorphemes for each. Everything here gets morphemes from
+# this, since reading each field of a Sudachi morpheme once is cheaper than going back to it (and having
+# it build new Python objects) every time a caller looks at the morpheme.
+#
+# Reads through the analysis cache if one is open. If pool (a multiprocessing Pool) is given, texts not
+# in the cache are tokenized in its workers, chunk_size at a time. Make the pool after ja_preload(), so
+# the workers share the dictionary.
+def ja_get_texts_morphemes(texts, pool=None, chunk_size=JA_POOL_CHUNK_SIZE):
+    results = [None]*len(texts)
+
+    if analysis_cache is None:
+        missed = list(range(len(texts)))
+    else:
+        missed = []
+        for (i, text) in enumerate(texts):
+            rows = analysis_cache.get(text)
+            if rows is None:
+                missed.append(i)
+            else:
+                results[i] = [JaMorpheme.from_row(row) for row in rows]
+
+    missed_texts = [texts[i] for i in missed]
+    if (pool is None) or (len(missed_texts) <= chunk_size):
+        analyzed = ja_tokenize_compact(missed_texts)
+    else:
+        chunks = [missed_texts[i:i+chunk_size] for i in range(0, len(missed_texts), chunk_size)]
+        analyzed = [[JaMorpheme(*f) for f in fields] for chunk in pool.map(_ja_tokenize_fields, chunks) for fields in chunk]
+
+    for (i, morphemes) in zip(missed, analyzed):
+        results[i] = morphemes
+        if analysis_cache is not None:
+            analysis_cache.put(texts[i], [m.to_row() for m in morphemes])
+
+    return results
+
 def ja_get_text_morphemes(text):
-    return tokenizer_obj.tokenize(text, tokenizer.Tokenizer.SplitMode.B)
+    return ja_get_texts_morphemes([text])[0]
+
+JA_SENTENCE_ENDS = '。．！？!?\n'
+JA_SENTENCE_TRAILERS = JA_SENTENCE_ENDS + '」』）)…'
+JA_CHUNK_CHARS = 2000 # Sudachi refuses input over 49149 bytes of UTF-8, so at most 16383 chars
+
+# Splits a long text into chunks of at most max_chars that can be tokenized separately. Each chunk is
+# as many whole sentences as fit, or if a single sentence doesn't fit, is cut at max_chars. texts is an
+# iterable of consecutive pieces of the text (e.g. as it's read from a stream), which may break
+# anywhere, and the chunks only depend on the whole text, so the same text gives the same chunks
+# (and hits the analysis cache).
+def ja_iter_text_chunks(texts, max_chars=JA_CHUNK_CHARS):
+    buf = ''
+    for text in texts:
+        buf += text
+        while len(buf) > max_chars:
+            cut = max_chars
+            for i in range(max_chars, 0, -1):
+                if (buf[i-1] in JA_SENTENCE_ENDS) and (buf[i] not in JA_SENTENCE_TRAILERS):
+                    cut = i
+                    break
+            yield buf[:cut]
+            buf = buf[cut:]
+    if buf:
+        yield buf
+
+# Tokenizes chunks (e.g. from ja_iter_text_chunks), batch_size at a time, yielding a list of
+# JaMorphemes for each. With a pool, each batch is spread over its workers a chunk at a time.
+def ja_iter_chunks_morphemes(chunks, pool=None, batch_size=32):
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            yield from ja_get_texts_morphemes(batch, pool, chunk_size=1)
+            batch = []
+    if batch:
+        yield from ja_get_texts_morphemes(batch, pool, chunk_size=1)
 
 def ja_get_text_tokenization(text):
-    morphemes = ja_get_text_morphemes(text)
+    return ja_get_morphemes_tokenization(ja_get_text_morphemes(text))
 
+def ja_get_morphemes_tokenization(morphemes):
     token_runs = []
     cur_run = []
     for m in morphemes:
@@ -265,5 +484,54 @@ if __name__ == '__main__':
 
     print('TESTING TOKENIZATION')
     print(ja_get_text_tokenization('その口ぶりからすると、あなたは知っているようですね。'))
+    print()
+
+    print('TESTING BATCH')
+    import multiprocessing
+    frags = [frag for (frag, _) in TEST_READING_FRAGMENTS]
+    singly = [[m.to_row() for m in ja_get_text_morphemes(frag)] for frag in frags]
+    ja_preload()
+    with multiprocessing.Pool(2) as pool:
+        for batch in [ja_get_texts_morphemes(frags), ja_get_texts_morphemes(frags, pool, chunk_size=4)]:
+            assert [[m.to_row() for m in morphemes] for morphemes in batch] == singly
+    print()
+
+    print('TESTING CHUNKS')
+    long_text = '「はい。」そうです！！本当に？\n' * 50 + 'あ' * 250 + 'これは私のです。'
+    chunks = list(ja_iter_text_chunks([long_text], 100))
+    assert ''.join(chunks) == long_text
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert chunks[0].endswith('本当に？\n') and chunks[1].startswith('「はい。」')
+    assert list(ja_iter_text_chunks(long_text[i:i+7] for i in range(0, len(long_text), 7))) == list(ja_iter_text_chunks([long_text]))
+    assert list(ja_iter_text_chunks([long_text[i:i+7] for i in range(0, len(long_text), 7)], 100)) == chunks
+    assert sum(len(morphemes) for morphemes in ja_iter_chunks_morphemes(chunks, batch_size=4)) == sum(len(morphemes) for morphemes in ja_get_texts_morphemes(chunks))
+    print()
+
+    print('TESTING ANALYSIS CACHE')
+    uncached = [(ja_get_morphemes_reading(ja_get_text_morphemes(frag)), ja_get_text_tokenization(frag)) for (frag, _) in TEST_READING_FRAGMENTS]
+    ja_open_analysis_cache(':memory:')
+    for _ in range(2): # first time misses, second time hits
+        cached = [(ja_get_morphemes_reading(ja_get_text_morphemes(frag)), ja_get_text_tokenization(frag)) for (frag, _) in TEST_READING_FRAGMENTS]
+        assert cached == uncached
+    assert analysis_cache.hits > 0
+    ja_close_analysis_cache()
+
+    # a cache opened before fork() is written separately by parent and child
+    import sqlite3
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_fn = os.path.join(tmpdir, 'cache.db')
+        ja_open_analysis_cache(cache_fn)
+        ja_get_text_morphemes('猫だ') # pending in the parent
+        pid = os.fork()
+        if pid == 0:
+            ja_get_text_morphemes('犬だ')
+            ja_close_analysis_cache()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        assert [row[0] for row in sqlite3.connect(cache_fn).execute('SELECT text FROM analysis')] == ['犬だ']
+        ja_close_analysis_cache()
+        assert sorted(row[0] for row in sqlite3.connect(cache_fn).execute('SELECT text FROM analysis')) == ['犬だ', '猫だ']
+    print()
 
     print('ALL GOOD')
@@ -0,0 +1,77 @@
+import os
+import json
+import sqlite3
+import threading
+
+# Persistent cache of morphological analyses, keyed by (text, dictionary version, split mode).
+# Values are whatever JSON-able rows the caller stores (see ja.py for the morpheme encoding).
+# Writes are buffered and committed in batches, so call flush() (or close()) when done.
+# It's safe to open before fork() (e.g. gunicorn with preload_app, or before creating a
+# multiprocessing.Pool): a child doesn't use the parent's connection or write out its pending rows,
+# it connects for itself on first use.
+class JaAnalysisCache:
+    FLUSH_COUNT = 1000
+
+    def __init__(self, path, dict_version, split_mode):
+        self.path = path
+        self.dict_version = dict_version
+        self.split_mode = split_mode
+        self.cxn = None # connected on first use
+        self.inherited_cxn = None # the parent's, kept referenced so it isn't closed from under it
+        self.lock = threading.Lock()
+        self.pending = {} # text -> encoded rows, not yet written
+        self.hits = 0
+        self.misses = 0
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self.inherited_cxn = self.cxn
+        self.cxn = None
+        self.lock = threading.Lock() # another thread may have held it at fork()
+        self.pending = {}
+
+    # call with self.lock held
+    def _connect_locked(self):
+        if self.cxn is not None:
+            return
+        self.cxn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.cxn.execute('PRAGMA journal_mode = WAL')
+        self.cxn.execute('CREATE TABLE IF NOT EXISTS analysis (text TEXT NOT NULL, dict_version TEXT NOT NULL, split_mode TEXT NOT NULL, rows TEXT NOT NULL, PRIMARY KEY (text, dict_version, split_mode)) WITHOUT ROWID')
+        self.cxn.commit()
+
+    def get(self, text):
+        with self.lock:
+            encoded = self.pending.get(text)
+            if encoded is None:
+                self._connect_locked()
+                row = self.cxn.execute('SELECT rows FROM analysis WHERE text = ? AND dict_version = ? AND split_mode = ?', (text, self.dict_version, self.split_mode)).fetchone()
+                encoded = row and row[0]
+        if encoded is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(encoded)
+
+    def put(self, text, rows):
+        with self.lock:
+            self.pending[text] = json.dumps(rows, ensure_ascii=False, separators=(',', ':'))
+            if len(self.pending) >= self.FLUSH_COUNT:
+                self._flush_locked()
+
+    def _flush_locked(self):
+        if self.pending:
+            self._connect_locked()
+            self.cxn.executemany('INSERT OR REPLACE INTO analysis (text, dict_version, split_mode, rows) VALUES (?, ?, ?, ?)', ((text, self.dict_version, self.split_mode, encoded) for (text, encoded) in self.pending.items()))
+            self.cxn.commit()
+        self.pending = {}
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def close(self):
+        with self.lock:
+            self._flush_locked()
+            if self.cxn is not None:
+                self.cxn.close()
+            self.cxn = None
@@ -0,0 +1,136 @@
+import os
+import json
+import mmap
+import heapq
+import struct
+import tempfile
+from array import array
+
+# The top fragments (by mscore) for each normal, as /api/get_normal_fragments returns them, precomputed
+# by index_fragments.py so the web app can serve them from a memory-mapped file instead of asking ES.
+#
+# File layout (little-endian):
+#   MAGIC, then a header of normal count, normal index offset, refs offset (u64 each)
+#   records: each fragment's JSON {"text", "normals", "reading"}, back to back, stored once however
+#     many normals it's under
+#   refs: per normal, best first, (record offset u64, record length u32)
+#   names: the normals, UTF-8, back to back
+#   normal index: per normal, sorted by UTF-8 bytes, (name offset u64, name length u32, first ref
+#     u64, ref count u32), which is binary searched
+
+MAGIC = b'MSNFRG1\n'
+HEADER = struct.Struct('<QQQ')
+REF = struct.Struct('<QI')
+INDEX_ENTRY = struct.Struct('<QIQI')
+
+TOP_K = 100
+
+def jdump(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+# Call add for every fragment, then close to write the file. Only the top k per normal are kept in
+# memory, as (score, -record number), with records spooled to a temporary file next to path until
+# the end, when the ones still in some top k are copied into place.
+class NormalFragmentsWriter:
+    def __init__(self, path, k=TOP_K):
+        self.path = path
+        self.k = k
+        self.tops = {} # normal -> min-heap
+        self.spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+        self.spool_offsets = array('Q', [0]) # record number -> offset in spool, plus the end
+
+    def add(self, score, fragment):
+        record_no = None
+        for normal in fragment['normals']:
+            heap = self.tops.setdefault(normal, [])
+            if (len(heap) >= self.k) and (score <= heap[0][0]):
+                continue # ties go to the fragment that came first
+            if record_no is None:
+                record_no = len(self.spool_offsets) - 1
+                self.spool.write(jdump({'text': fragment['text'], 'normals': fragment['normals'], 'reading': fragment['reading']}).encode('utf-8'))
+                self.spool_offsets.append(self.spool.tell())
+            if len(heap) >= self.k:
+                heapq.heapreplace(heap, (score, -record_no))
+            else:
+                heapq.heappush(heap, (score, -record_no))
+
+    def close(self):
+        self.spool.flush()
+        used = sorted(set(-neg_record_no for heap in self.tops.values() for (_, neg_record_no) in heap))
+        with open(self.path, 'wb') as f:
+            f.write(MAGIC + HEADER.pack(0, 0, 0)) # filled in at the end
+
+            record_refs = {} # record number -> (offset, length) in this file
+            if used:
+                with mmap.mmap(self.spool.fileno(), 0, access=mmap.ACCESS_READ) as spool:
+                    for record_no in used:
+                        (start, end) = (self.spool_offsets[record_no], self.spool_offsets[record_no + 1])
+                        record_refs[record_no] = (f.tell(), end - start)
+                        f.write(spool[start:end])
+            self.spool.close()
+
+            names = sorted(normal.encode('utf-8') for normal in self.tops)
+            refs_offset = f.tell()
+            ref_starts = []
+            ref_index = 0
+            for name in names:
+                entries = sorted(self.tops[name.decode('utf-8')], reverse=True)
+                ref_starts.append((ref_index, len(entries)))
+                f.write(b''.join(REF.pack(*record_refs[-neg_record_no]) for (_, neg_record_no) in entries))
+                ref_index += len(entries)
+
+            name_offsets = []
+            for name in names:
+                name_offsets.append(f.tell())
+                f.write(name)
+
+            index_offset = f.tell()
+            for (name, name_offset, (ref_start, ref_count)) in zip(names, name_offsets, ref_starts):
+                f.write(INDEX_ENTRY.pack(name_offset, len(name), ref_start, ref_count))
+
+            f.seek(len(MAGIC))
+            f.write(HEADER.pack(len(names), index_offset, refs_offset))
+        self.tops = {}
+
+class NormalFragmentsFile:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a normal fragments file')
+        (self.normal_count, self.index_offset, self.refs_offset) = HEADER.unpack_from(self.mm, len(MAGIC))
+
+    def _entry(self, i):
+        return INDEX_ENTRY.unpack_from(self.mm, self.index_offset + i*INDEX_ENTRY.size)
+
+    # the JSON (bytes) of the top fragments for normal, best first, or None if normal isn't in the file
+    def get_records(self, normal, limit=None):
+        name = normal.encode('utf-8')
+        (lo, hi) = (0, self.normal_count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (name_offset, name_length, ref_start, ref_count) = self._entry(mid)
+            mid_name = self.mm[name_offset:name_offset+name_length]
+            if mid_name < name:
+                lo = mid + 1
+            elif mid_name > name:
+                hi = mid
+            else:
+                if limit is not None:
+                    ref_count = min(ref_count, limit)
+                records = []
+                for i in range(ref_start, ref_start + ref_count):
+                    (offset, length) = REF.unpack_from(self.mm, self.refs_offset + i*REF.size)
+                    records.append(self.mm[offset:offset+length])
+                return records
+        return None
+
+    # like get_records, but as a JSON array
+    def get_json(self, normal, limit=None):
+        records = self.get_records(normal, limit)
+        if records is None:
+            return None
+        return b'[' + b','.join(records) + b']'
+
+    def close(self):
+        self.mm.close()
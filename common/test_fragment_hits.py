@@ -0,0 +1,37 @@
+import random
+
+from .fragment_hits import encode_hits, decode_hits, choose_hit
+
+tag_sets = {
+    'drama,subs': (7, [(123, 't:1.000-2.000'), (456, 't:3.000-4.500')]),
+    '': (1, [(789, 'a:L3')]),
+}
+
+encoded = encode_hits(tag_sets)
+if encoded != {'drama,subs': [7, 123, 't:1.000-2.000', 456, 't:3.000-4.500'], '': [1, 789, 'a:L3']}:
+    print('FAIL encode', encoded)
+if decode_hits(encoded) != tag_sets:
+    print('FAIL round trip', decode_hits(encoded))
+
+# docs indexed before the compact format
+old = {
+    'drama,subs': {'count': 7, 'sample': [{'source_id': 123, 'loc': 't:1.000-2.000'}, {'source_id': 456, 'loc': 't:3.000-4.500'}]},
+    '': {'count': 1, 'sample': [{'source_id': 789, 'loc': 'a:L3'}]},
+}
+if decode_hits(old) != tag_sets:
+    print('FAIL old format', decode_hits(old))
+
+random.seed(0)
+chosen = set()
+for hits in [encoded, old]*20:
+    (count, hit) = choose_hit(hits)
+    if count != 8:
+        print('FAIL total count', count)
+    chosen.add(hit)
+if chosen != {(123, 't:1.000-2.000'), (456, 't:3.000-4.500'), (789, 'a:L3')}:
+    print('FAIL choose_hit', chosen)
+
+# with a tag filter, only hits from matching tag-sets count and get chosen
+for hits in [encoded, old]:
+    if choose_hit(hits, ['subs', 'news']) not in [(7, (123, 't:1.000-2.000')), (7, (456, 't:3.000-4.500'))]:
+        print('FAIL choose_hit with tags', choose_hit(hits, ['subs', 'news']))
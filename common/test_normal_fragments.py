@@ -0,0 +1,41 @@
+import os
+import json
+import tempfile
+
+from .normal_fragments import NormalFragmentsWriter, NormalFragmentsFile
+
+def frag(text, normals):
+    return {'text': text, 'normals': normals, 'reading': text + '[r]'}
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, 'normal_fragments.bin')
+    writer = NormalFragmentsWriter(path, k=2)
+    writer.add(0.1, frag('a', ['猫', 'だ']))
+    writer.add(0.5, frag('b', ['犬', 'だ']))
+    writer.add(0.3, frag('c', ['猫']))
+    writer.add(0.9, frag('d', ['猫', 'だ']))
+    writer.add(0.3, frag('e', ['猫'])) # ties with c, which came first
+    writer.add(0.0, frag('f', ['鳥']))
+    writer.close()
+    if os.listdir(tmpdir) != ['normal_fragments.bin']:
+        print('FAIL spool file left behind', os.listdir(tmpdir))
+
+    table = NormalFragmentsFile(path)
+    texts = dict((normal, [json.loads(r)['text'] for r in table.get_records(normal)]) for normal in ['猫', 'だ', '犬', '鳥'])
+    if texts != {'猫': ['d', 'c'], 'だ': ['d', 'b'], '犬': ['b'], '鳥': ['f']}:
+        print('FAIL top fragments', texts)
+    if json.loads(table.get_json('だ')) != [frag('d', ['猫', 'だ']), frag('b', ['犬', 'だ'])]:
+        print('FAIL json', table.get_json('だ'))
+    if [json.loads(r)['text'] for r in table.get_records('猫', limit=1)] != ['d']:
+        print('FAIL limit')
+    for normal in ['', 'あ', '猫猫', '鳥a']:
+        if table.get_records(normal) is not None:
+            print('FAIL missing normal', normal)
+    table.close()
+
+    # no fragments at all
+    NormalFragmentsWriter(path).close()
+    table = NormalFragmentsFile(path)
+    if table.get_records('猫') is not None:
+        print('FAIL empty file')
+    table.close()
@@ -1,13 +1,18 @@
 import os
+import re
 import time
-import random
 import json
+import codecs
+import multiprocessing
+from collections import Counter
 
-from flask import Flask, request, render_template, redirect, url_for, escape, send_from_directory, abort, jsonify
+from flask import Flask, Response, request, render_template, redirect, url_for, escape, send_from_directory, abort, jsonify
 from flask_cors import CORS
 import requests
 
-from common.ja import ja_get_text_morphemes, ja_get_morphemes_normal_stats, ja_get_text_tokenization
+from common.fragment_hits import choose_hit
+from common.normal_fragments import NormalFragmentsFile
+from common.ja import ja_preload, ja_get_texts_morphemes, ja_iter_text_chunks, ja_iter_chunks_morphemes, ja_get_morphemes_normal_stats, ja_get_morphemes_tokenization
 
 app = Flask(__name__)
 
@@ -18,6 +23,10 @@ if app.env == 'development':
 # Elastic Beanstalk requires "application" to be set
 application = app
 
+# Every worker needs the Sudachi dictionary, so load it at import. With preload_app (see gunicorn.conf.py)
+# that's once in the master before it forks the workers, which then share it.
+ja_preload()
+
 # Not necessary to keep ASCII, and impedes debugging Japanese
 app.config['JSON_AS_ASCII'] = False
 
@@ -36,6 +45,32 @@ MAX_FRAGMENT_RESULTS_PER_PAGE = 10000
 FRAGMENT_INDEX = 'fragment_ja'
 SOURCE_INDEX = 'source_ja'
 
+SCORE_FIELD_RE = re.compile(r'mscore(_[a-z0-9_]+)?')
+
+# Hits are only counted up to this, past which the count is shown as a lower bound. Counting them all
+# would mean visiting every match, rather than stopping once we have the top ones (by index order).
+TOTAL_HITS_LIMIT = 1000
+
+# Per-tag counts (of matching fragments) are opt-in, since the aggregation has to visit every match.
+# There are only a handful of tags.
+TAG_COUNTS_SIZE = 20
+
+# Texts posted to get_text_normal_counts are capped at this many bytes, and tokenized in chunks of
+# whole sentences. If TOKENIZE_PROCESSES is more than one, each web worker tokenizes the chunks in
+# a pool of that many processes.
+MAX_TEXT_BYTES = int(os.getenv('MAX_TEXT_BYTES', 16*1024*1024))
+TEXT_CHUNK_CHARS = int(os.getenv('TEXT_CHUNK_CHARS', 2000))
+TOKENIZE_PROCESSES = int(os.getenv('TOKENIZE_PROCESSES', 1))
+TEXT_READ_SIZE = 64*1024
+
+NORMAL_FRAGMENTS_SIZE = 100
+
+# Top fragments per normal, written by index_fragments.py --normal-fragments-file. get_normal_fragments
+# serves from this when it can, and only asks ES for other scores or normals that aren't in it (e.g.
+# ones only in fragments indexed since). Mapped at import, so gunicorn workers share the pages.
+NORMAL_FRAGMENTS_FILE = os.getenv('NORMAL_FRAGMENTS_FILE')
+normal_fragments_table = NormalFragmentsFile(NORMAL_FRAGMENTS_FILE) if NORMAL_FRAGMENTS_FILE else None
+
 @app.before_request
 def before_request():
     if not request.is_secure and app.env == 'production':
@@ -54,6 +89,17 @@ def about():
 def ja():
     return render_template('index.html')
 
+# Sort for fragments. By mscore, which is how the index is sorted, so searches can stop early. Or by a
+# named score (mscore_NAME, see backend/indexing/rescore_fragments.py) to try out a different ranking,
+# which has to look at every match. Fragments without that score come last.
+def fragment_sort(score_name):
+    if not score_name:
+        return [{'mscore': 'desc'}]
+    field = 'mscore_' + score_name
+    if not SCORE_FIELD_RE.fullmatch(field):
+        abort(400)
+    return [{field: {'order': 'desc', 'unmapped_type': 'float'}}]
+
 # this is rather complicated, but I didn't immediately see how to get this from libraries
 def format_time(t):
     result = ''
@@ -76,8 +122,11 @@ def ja_fsearch():
     include_tokens = request.args.get('toks') is not None
     max_results = min(int(request.args.get('maxres', DEFAULT_FRAGMENT_RESULTS_PER_PAGE)), MAX_FRAGMENT_RESULTS_PER_PAGE)
     index_suffix = request.args.get('idxsuf', '')
+    score_name = request.args.get('score', '')
+    tags = [t for t in request.args.get('tags', '').split(',') if t] # fragments with hits from sources with any of these
+    include_tag_counts = request.args.get('tagcounts') is not None
 
-    print('query', json.dumps({'query': query, 'format': response_format, 'tokens': include_tokens, 'max_results': max_results, 'index_suffix': index_suffix}, sort_keys=True, ensure_ascii=True), flush=True)
+    print('query', json.dumps({'query': query, 'format': response_format, 'tokens': include_tokens, 'max_results': max_results, 'index_suffix': index_suffix, 'score': score_name, 'tags': tags, 'tag_counts': include_tag_counts}, sort_keys=True, ensure_ascii=True), flush=True)
 
     # PARSE QUERY
     phrases = query.split()
@@ -115,17 +164,19 @@ def ja_fsearch():
                 q = {'bool': {'must_not': q}}
             subqueries.append(q)
 
-    t0 = time.time()
-    main_resp = requests.get(f'{ES_BASE_URL}/{FRAGMENT_INDEX + index_suffix}/_search', json={
+    # in filter context, since it doesn't affect scoring, so ES can cache it
+    tag_filters = [{'terms': {'tags': tags}}] if tags else []
+
+    search_body = {
         'query': {
             'bool': {
                 'must': subqueries,
+                'filter': tag_filters,
             }
         },
-        'sort': [
-            {'mscore': 'desc'},
-        ],
-        # 'track_total_hits': False, # required for early termination
+        'sort': fragment_sort(score_name),
+        'track_total_hits': max(TOTAL_HITS_LIMIT, max_results),
+        '_source': ['text', 'hits'],
         'highlight': {
             'type': 'unified',
             'fields': {
@@ -137,7 +188,12 @@ def ja_fsearch():
             },
         },
         'size': max_results,
-    })
+    }
+    if include_tag_counts:
+        search_body['aggs'] = {'tags': {'terms': {'field': 'tags', 'size': TAG_COUNTS_SIZE}}}
+
+    t0 = time.time()
+    main_resp = requests.get(f'{ES_BASE_URL}/{FRAGMENT_INDEX + index_suffix}/_search', json=search_body)
     dt = time.time() - t0
     main_resp.raise_for_status()
     print('es_request_time', f'{dt}', flush=True)
@@ -147,6 +203,8 @@ def ja_fsearch():
     hitcount_value = main_resp_body['hits']['total']['value']
 
     json_response['hits'] = hitcount_value
+    if include_tag_counts:
+        json_response['tag_counts'] = {b['key']: b['doc_count'] for b in main_resp_body['aggregations']['tags']['buckets']}
 
     if main_resp_body['hits']['total']['relation'] == 'eq':
         hitcount_qual = ''
@@ -165,23 +223,17 @@ def ja_fsearch():
     # FIGURE OUT SOURCE IDS TO FETCH
     source_infos = [] # list of {total_hits, source_id, loc}
     for hit in main_resp_body['hits']['hits']:
-        total_count = 0
-        combined_sample_hits = []
-        for (tag_set_str, tag_set_info) in hit['_source']['hits'].items():
-            total_count += tag_set_info['count']
-            combined_sample_hits.extend(tag_set_info['sample'])
-        chosen_hit = random.choice(combined_sample_hits)
-
+        (total_count, (source_id, loc)) = choose_hit(hit['_source']['hits'], tags)
         source_infos.append({
             'total_hits': total_count,
-            'source_id': chosen_hit['source_id'],
-            'loc': chosen_hit['loc'],
+            'source_id': source_id,
+            'loc': loc,
         })
 
     # FETCH SOURCE RECORDS
     if source_infos:
         unique_source_ids = set(s['source_id'] for s in source_infos)
-        source_resp = requests.get(f'{ES_BASE_URL}/_mget', json={'docs': [{'_index': SOURCE_INDEX + index_suffix, '_id': sid} for sid in unique_source_ids]})
+        source_resp = requests.get(f'{ES_BASE_URL}/_mget', json={'docs': [{'_index': SOURCE_INDEX + index_suffix, '_id': sid, '_source': ['title', 'published', 'url']} for sid in unique_source_ids]})
         source_resp.raise_for_status()
         source_resp_body = source_resp.json()
         source_map = {doc['_id']: doc['_source'] for doc in source_resp_body['docs']}
@@ -193,7 +245,12 @@ def ja_fsearch():
     results_list = []
     json_results_list = []
     assert len(main_resp_body['hits']['hits']) == len(source_infos) # sanity check
-    for (hit, source_info) in zip(main_resp_body['hits']['hits'], source_infos):
+    if include_tokens:
+        # tokenize them all at once, which is quicker than one at a time
+        hit_morphemes = ja_get_texts_morphemes([hit['_source']['text'] for hit in main_resp_body['hits']['hits']])
+    else:
+        hit_morphemes = [None]*len(source_infos)
+    for (hit, source_info, morphemes) in zip(main_resp_body['hits']['hits'], source_infos, hit_morphemes):
         xhit = {}
         json_xhit = {}
 
@@ -225,7 +282,7 @@ def ja_fsearch():
         json_xhit['source_count'] = source_info['total_hits']
 
         if include_tokens:
-            json_xhit['tokens'] = ja_get_text_tokenization(json_xhit['text'])
+            json_xhit['tokens'] = ja_get_morphemes_tokenization(morphemes)
 
         # Uncomment this to add back in tags display
         # source_tags = source_record['tags']
@@ -241,7 +298,7 @@ def ja_fsearch():
     json_response['results'] = json_results_list
 
     if response_format == 'html':
-        return render_template('index.html', query=query, results=results, max_results=max_results if max_results != DEFAULT_FRAGMENT_RESULTS_PER_PAGE else None, index_suffix=index_suffix)
+        return render_template('index.html', query=query, results=results, max_results=max_results if max_results != DEFAULT_FRAGMENT_RESULTS_PER_PAGE else None, index_suffix=index_suffix, tags=','.join(tags))
     elif response_format == 'json':
         response = jsonify(json_response)
         response.headers.add('Access-Control-Allow-Origin', '*')
@@ -331,15 +388,46 @@ def ja_manifold2_path_redir(p):
 # API
 #
 
+# made on first use rather than at import, since a pool's threads don't survive gunicorn forking the worker
+tokenize_pool = None
+
+def get_tokenize_pool():
+    global tokenize_pool
+    if (TOKENIZE_PROCESSES > 1) and (tokenize_pool is None):
+        tokenize_pool = multiprocessing.Pool(TOKENIZE_PROCESSES)
+    return tokenize_pool
+
+# Reads the request body as text, a block at a time, giving up if it's over MAX_TEXT_BYTES
+def iter_request_text():
+    if (request.content_length or 0) > MAX_TEXT_BYTES:
+        abort(413)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    size = 0
+    while True:
+        block = request.stream.read(TEXT_READ_SIZE)
+        size += len(block)
+        if size > MAX_TEXT_BYTES:
+            abort(413)
+        if not block:
+            break
+        yield decoder.decode(block)
+    yield decoder.decode(b'', final=True)
+
+# Takes the text as a JSON object {"text": ...}, or as the whole body if it's text/plain, which is
+# streamed rather than read into memory all at once.
 @app.route("/api/get_text_normal_counts", methods=['POST'])
 def api_get_text_normals():
-    req = request.get_json()
-    text = req['text']
-    morphemes = ja_get_text_morphemes(text)
+    if request.mimetype == 'text/plain':
+        texts = iter_request_text()
+    else:
+        if (request.content_length or 0) > MAX_TEXT_BYTES:
+            abort(413)
+        texts = [request.get_json()['text']]
 
-    normal_counts = {}
-    for (k, v) in ja_get_morphemes_normal_stats(morphemes).items():
-        normal_counts[k] = v['c']
+    normal_counts = Counter()
+    for morphemes in ja_iter_chunks_morphemes(ja_iter_text_chunks(texts, TEXT_CHUNK_CHARS), get_tokenize_pool()):
+        for (k, v) in ja_get_morphemes_normal_stats(morphemes).items():
+            normal_counts[k] += v['c']
 
     return jsonify(normal_counts)
 
@@ -349,16 +437,20 @@ def api_get_normal_fragments():
     req = request.get_json()
     normal = req['normal']
 
+    if normal_fragments_table and not req.get('score'):
+        fragments_json = normal_fragments_table.get_json(normal, NORMAL_FRAGMENTS_SIZE)
+        if fragments_json is not None:
+            return Response(fragments_json, mimetype='application/json')
+
     t0 = time.time()
     main_resp = requests.get(f'{ES_BASE_URL}/{FRAGMENT_INDEX}/_search', json={
         'query': {
             'match_phrase': {'normals': normal},
         },
-        'sort': [
-            {'mscore': 'desc'},
-        ],
+        'sort': fragment_sort(req.get('score')),
         'track_total_hits': False, # allows early termination, because we don't care about result count
-        'size': 100,
+        '_source': ['text', 'normals', 'reading'],
+        'size': NORMAL_FRAGMENTS_SIZE,
     })
     dt = time.time() - t0
     main_resp.raise_for_status()
@@ -0,0 +1,4 @@
+# Read by gunicorn from the working directory, which is how Elastic Beanstalk runs the app. Importing
+# the app in the master before forking lets the workers share the Sudachi dictionary it loads
+# (see ja_preload in common/ja.py), rather than each loading their own copy.
+preload_app = True
@@ -70,11 +70,9 @@ const App: React.FC = () => {
         method: 'POST',
         headers: {
           'Accept': 'application/json',
-          'Content-Type': 'application/json',
+          'Content-Type': 'text/plain; charset=utf-8',
         },
-        body: JSON.stringify({
-          'text': knownText,
-        }),
+        body: knownText, // sent as plain text so the server can stream it
       });
 
       if (!response.ok) {